@@ -18,6 +18,7 @@ class DataCollatorForGlobalPointerNer:
     pad_to_multiple_of: Optional[int] = None
     num_labels: Optional[int] = None
     is_sparse: Optional[bool] = False
+    max_span_width: Optional[int] = None
     ignore_list: Optional[List[str]] = None
 
     def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
@@ -48,6 +49,13 @@ class DataCollatorForGlobalPointerNer:
                 label = sequence_padding([list(l) for l in label])
                 batch_labels.append(label)
             batch_labels = torch.from_numpy(sequence_padding(batch_labels, seq_dims=2))
+        elif self.max_span_width is not None:
+            # 与模型的带状得分对应，(start, end - start) 表示片段 [start, end]，超出最大宽度的实体被忽略
+            batch_labels = torch.zeros(bs, self.num_labels, seqlen, self.max_span_width, dtype=torch.long)
+            for i, lb in enumerate(labels):
+                for start, end, tag in lb:
+                    if 0 <= end - start < self.max_span_width:
+                        batch_labels[i, tag, start, end - start] = 1
         else:
             batch_labels = torch.zeros(bs, self.num_labels, seqlen, seqlen, dtype=torch.long)
             for i, lb in enumerate(labels):
@@ -63,9 +71,10 @@ class GlobalPointerForNerDataModule(NerDataModule):
 
     config_name: str = "global_pointer"
 
-    def __init__(self, *args, sparse: bool = False, **kwargs) -> None:
+    def __init__(self, *args, sparse: bool = False, max_span_width: Optional[int] = None, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.sparse = sparse
+        self.max_span_width = max_span_width
 
     @property
     def collate_fn(self) -> Optional[Callable]:
@@ -74,5 +83,6 @@ class GlobalPointerForNerDataModule(NerDataModule):
             tokenizer=self.tokenizer,
             num_labels=len(self.labels),
             is_sparse=self.sparse,
+            max_span_width=self.max_span_width,
             ignore_list=ignore_list,
         )
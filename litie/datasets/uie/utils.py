@@ -19,13 +19,15 @@ def unify_prompt_name(prompt):
     return prompt
 
 
-def get_id_and_prob(spans, offset_map):
+def get_id_and_prob(spans, offset_map, with_prompt=True):
     prompt_length = 0
-    for i in range(1, len(offset_map)):
-        if offset_map[i] != [0, 0]:
-            prompt_length += 1
-        else:
-            break
+    # 输入只包含文本时（如 SiameseUIE 的文本流）不存在提示部分，无需偏移
+    if with_prompt:
+        for i in range(1, len(offset_map)):
+            if offset_map[i] != [0, 0]:
+                prompt_length += 1
+            else:
+                break
 
     for i in range(1, prompt_length + 1):
         offset_map[i][0] -= (prompt_length + 1)
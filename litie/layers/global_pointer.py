@@ -2,6 +2,7 @@ import math
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from .layer_norm import LayerNorm
 from .position import (
@@ -11,18 +12,56 @@ from .position import (
 )
 
 
+def sliding_window_scores(qw, kw, width):
+    """
+    只计算 qw[i] 与 kw[i + w]（0 <= w < width）之间的内积
+    将序列划分为长度为 width 的块，每个块只与自身及下一个块做矩阵乘法，计算量与显存由 O(L^2) 降为 O(L * width)
+
+    :param qw: shape=[..., seq_len, head_size]
+    :param kw: shape=[..., seq_len, head_size]
+    :return: shape=[..., seq_len, width]，超出序列的位置为 0
+    """
+    seq_len, head_size = qw.shape[-2:]
+    num_chunks = math.ceil(seq_len / width)
+    pad = num_chunks * width - seq_len
+
+    q = F.pad(qw, (0, 0, 0, pad)).reshape(*qw.shape[:-2], num_chunks, width, head_size)
+    k = F.pad(kw, (0, 0, 0, pad + width)).reshape(*kw.shape[:-2], num_chunks + 1, width, head_size)
+    k = torch.cat([k[..., :-1, :, :], k[..., 1:, :, :]], dim=-2)  # [..., num_chunks, width * 2, head_size]
+
+    scores = torch.matmul(q, k.transpose(-1, -2))  # [..., num_chunks, width, width * 2]
+    # 块内第 i 个位置与第 i + w 个位置的内积
+    index = torch.arange(width, device=qw.device)
+    index = (index[:, None] + index[None]).expand(*scores.shape[:-1], width)
+    scores = scores.gather(-1, index)
+    return scores.reshape(*scores.shape[:-3], num_chunks * width, width)[..., :seq_len, :]
+
+
+def get_band_mask(mask, width):
+    """
+    :param mask: shape=[btz, seq_len], padding部分为0
+    :return: shape=[btz, seq_len, width]，(i, w) 表示片段 [i, i + w] 的首尾均不是 padding
+    """
+    mask = mask.long()
+    end_mask = F.pad(mask, (0, width - 1)).unfold(1, width, 1)  # [btz, seq_len, width]
+    return (mask.unsqueeze(-1) * end_mask).bool()
+
+
 class GlobalPointer(nn.Module):
     """全局指针模块
     将序列的每个(start, end)作为整体来进行判断
+    设置 max_span_width 时只计算宽度不超过 max_span_width 的片段，返回 [btz, heads, seq_len, max_span_width] 的带状得分
     参考：https://kexue.fm/archives/8373
     """
 
-    def __init__(self, hidden_size, heads, head_size, use_rope=True, use_bias=True, tril_mask=True):
+    def __init__(self, hidden_size, heads, head_size, use_rope=True, use_bias=True, tril_mask=True,
+                 max_span_width=None):
         super().__init__()
         self.heads = heads
         self.head_size = head_size
         self.use_rope = use_rope
         self.tril_mask = tril_mask
+        self.max_span_width = max_span_width
 
         self.dense = nn.Linear(hidden_size, heads * head_size * 2, bias=use_bias)
         if self.use_rope:
@@ -45,6 +84,15 @@ class GlobalPointer(nn.Module):
             qw = self.position_embedding(qw.transpose(1, -2)).transpose(1, -2)
             kw = self.position_embedding(kw.transpose(1, -2)).transpose(1, -2)
 
+        if self.max_span_width is not None:
+            # [btz, heads, seq_len, max_span_width]，(i, w) 表示片段 [i, i + w]
+            logits = sliding_window_scores(qw.transpose(1, 2), kw.transpose(1, 2), self.max_span_width)
+            if mask is None:
+                mask = torch.ones(logits.shape[0], logits.shape[2], device=logits.device)
+            band_mask = get_band_mask(mask, self.max_span_width).unsqueeze(1)
+            logits = logits.masked_fill(~band_mask, value=-float('inf'))
+            return logits / self.head_size ** 0.5
+
         # 计算内积
         logits = torch.einsum('bmhd,bnhd->bhmn', qw, kw)  # [btz, heads, seq_len, seq_len]
 
@@ -67,14 +115,17 @@ class EfficientGlobalPointer(nn.Module):
     """更加参数高效的GlobalPointer
     参考：https://kexue.fm/archives/8877
     这里实现和GlobalPointer相似，而未采用原版的奇偶位来取qw和kw，个人理解两种方式是无区别的
+    设置 max_span_width 时只计算宽度不超过 max_span_width 的片段，返回 [btz, heads, seq_len, max_span_width] 的带状得分
     """
 
-    def __init__(self, hidden_size, heads, head_size, use_rope=True, use_bias=True, tril_mask=True):
+    def __init__(self, hidden_size, heads, head_size, use_rope=True, use_bias=True, tril_mask=True,
+                 max_span_width=None):
         super().__init__()
         self.heads = heads
         self.head_size = head_size
         self.use_rope = use_rope
         self.tril_mask = tril_mask
+        self.max_span_width = max_span_width
 
         self.p_dense = nn.Linear(hidden_size, head_size * 2, bias=use_bias)
         self.q_dense = nn.Linear(head_size * 2, heads * 2, bias=use_bias)
@@ -94,12 +145,23 @@ class EfficientGlobalPointer(nn.Module):
             qw = self.position_embedding(qw)
             kw = self.position_embedding(kw)
 
-        # 计算内积
-        logits = torch.einsum('bmd,bnd->bmn', qw, kw) / self.head_size ** 0.5  # [btz, seq_len, seq_len], 是否是实体的打分
         bias_input = self.q_dense(sequence_output)  # [..., heads*2]
         bias = torch.stack(
             torch.chunk(bias_input, self.heads, dim=-1), dim=-2
         ).transpose(1, 2) / 2  # [btz, heads, seq_len, 2]
+
+        if self.max_span_width is not None:
+            # [btz, seq_len, max_span_width]，(i, w) 表示片段 [i, i + w]
+            logits = sliding_window_scores(qw, kw, self.max_span_width) / self.head_size ** 0.5
+            end_bias = F.pad(bias[..., 1], (0, self.max_span_width - 1)).unfold(-1, self.max_span_width, 1)
+            logits = logits.unsqueeze(1) + bias[..., :1] + end_bias  # [btz, heads, seq_len, max_span_width]
+            if mask is None:
+                mask = torch.ones(logits.shape[0], logits.shape[2], device=logits.device)
+            band_mask = get_band_mask(mask, self.max_span_width).unsqueeze(1)
+            return logits.masked_fill(~band_mask, value=-float('inf'))
+
+        # 计算内积
+        logits = torch.einsum('bmd,bnd->bmn', qw, kw) / self.head_size ** 0.5  # [btz, seq_len, seq_len], 是否是实体的打分
         logits = logits.unsqueeze(1) + bias[..., :1] + bias[..., 1:].transpose(2, 3)  # [btz, heads, seq_len, seq_len]
 
         # 排除padding
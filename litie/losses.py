@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 from scipy.optimize import linear_sum_assignment
 
 
@@ -444,36 +445,37 @@ class HungarianMatcher(nn.Module):
         """
         with torch.no_grad():
             bsz, num_generated_triples = outputs["pred_rel_logits"].shape[:2]
-            # We flatten to compute the cost matrices in a batch
-            pred_rel = outputs["pred_rel_logits"].flatten(0, 1).softmax(
-                -1)  # [bsz * num_generated_triples, num_classes]
-            gold_rel = torch.cat([v["relation"] for v in targets])
-            # after masking the pad token
-            pred_head_start = outputs["head_start_logits"].flatten(0, 1).softmax(-1)
-            pred_head_end = outputs["head_end_logits"].flatten(0, 1).softmax(-1)
-            pred_tail_start = outputs["tail_start_logits"].flatten(0, 1).softmax(-1)
-            pred_tail_end = outputs["tail_end_logits"].flatten(0, 1).softmax(-1)
-
-            gold_head_start = torch.cat([v["head_start_index"] for v in targets])
-            gold_head_end = torch.cat([v["head_end_index"] for v in targets])
-            gold_tail_start = torch.cat([v["tail_start_index"] for v in targets])
-            gold_tail_end = torch.cat([v["tail_end_index"] for v in targets])
-
-            if self.matcher == "avg":
-                cost = - self.cost_relation * pred_rel[:, gold_rel]
-                cost -= self.cost_head * 1 / 2 * (pred_head_start[:, gold_head_start] + pred_head_end[:, gold_head_end])
-                cost -= self.cost_tail * 1 / 2 * (pred_tail_start[:, gold_tail_start] + pred_tail_end[:, gold_tail_end])
-            elif self.matcher == "min":
-                cost = torch.cat([pred_head_start[:, gold_head_start].unsqueeze(1),
-                                  pred_rel[:, gold_rel].unsqueeze(1),
-                                  pred_head_end[:, gold_head_end].unsqueeze(1),
-                                  pred_tail_start[:, gold_tail_start].unsqueeze(1),
-                                  pred_tail_end[:, gold_tail_end].unsqueeze(1)], dim=1)
-                cost = - torch.min(cost, dim=1)[0]
-            else:
-                raise ValueError("Wrong matcher")
-            cost = cost.view(bsz, num_generated_triples, -1).cpu()
             num_gold_triples = [len(v["relation"]) for v in targets]
-            indices = [linear_sum_assignment(c[i]) for i, c in enumerate(cost.split(num_gold_triples, -1))]
+            max_gold_triples = max(num_gold_triples, default=0)
+
+            def gather(logits, key):
+                """ 只计算每个样本内部预测与标注之间的代价：[bsz, num_generated_triples, max_gold_triples] """
+                gold = pad_sequence([v[key] for v in targets], batch_first=True).to(logits.device).long()
+                return logits.softmax(-1).gather(2, gold.unsqueeze(1).expand(-1, num_generated_triples, -1))
+
+            if max_gold_triples == 0:
+                cost = outputs["pred_rel_logits"].new_zeros(bsz, num_generated_triples, 0)
+            else:
+                pred_rel = gather(outputs["pred_rel_logits"], "relation")
+                pred_head_start = gather(outputs["head_start_logits"], "head_start_index")
+                pred_head_end = gather(outputs["head_end_logits"], "head_end_index")
+                pred_tail_start = gather(outputs["tail_start_logits"], "tail_start_index")
+                pred_tail_end = gather(outputs["tail_end_logits"], "tail_end_index")
+
+                if self.matcher == "avg":
+                    cost = - self.cost_relation * pred_rel
+                    cost -= self.cost_head * 1 / 2 * (pred_head_start + pred_head_end)
+                    cost -= self.cost_tail * 1 / 2 * (pred_tail_start + pred_tail_end)
+                elif self.matcher == "min":
+                    cost = torch.stack(
+                        [pred_head_start, pred_rel, pred_head_end, pred_tail_start, pred_tail_end], dim=-1
+                    )
+                    cost = - torch.min(cost, dim=-1)[0]
+                else:
+                    raise ValueError("Wrong matcher")
+
+            # 一次性拷贝到 CPU 后逐个样本求解
+            cost = cost.float().cpu().numpy()
+            indices = [linear_sum_assignment(c[:, :n]) for c, n in zip(cost, num_gold_triples)]
 
             return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
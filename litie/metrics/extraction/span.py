@@ -63,22 +63,14 @@ def get_bool_ids_greater_than(probs, limit=0.5, return_prob=False):
     Returns:
         List[List[int]]: The index of the last dimension meet the conditions.
     """
-    probs = np.array(probs)
-    dim_len = len(probs.shape)
-    if dim_len > 1:
-        result = []
-        for p in probs:
-            result.append(get_bool_ids_greater_than(p, limit, return_prob))
-        return result
-    else:
-        result = []
-        for i, p in enumerate(probs):
-            if p > limit:
-                if return_prob:
-                    result.append((i, p))
-                else:
-                    result.append(i)
-        return result
+    probs = np.asarray(probs)
+    if probs.ndim > 1:
+        return [get_bool_ids_greater_than(p, limit, return_prob) for p in probs]
+
+    ids = np.flatnonzero(probs > limit)
+    if return_prob:
+        return list(zip(ids.tolist(), probs[ids]))
+    return ids.tolist()
 
 
 class SpanEvaluator(object):
@@ -33,6 +33,10 @@ class AutoNerModel(BaseModel):
         kwargs = {}
         if data_args.is_sparse:
             kwargs = {"sparse": True}
+        # 带状 GlobalPointer 的标签需要与模型的最大实体宽度一致
+        max_span_width = (self.model_config_kwargs or {}).get("max_span_width")
+        if max_span_width is not None:
+            kwargs["max_span_width"] = max_span_width
 
         return AutoNerDataModule.create(
             self.task_model_name,
@@ -1,4 +1,8 @@
-from typing import List, Tuple
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Any
+
+import numpy as np
+import torch
 
 
 def get_entities(seq: List[str], *, suffix: bool = False) -> List[Tuple[str, int, int]]:
@@ -77,6 +81,74 @@ def start_of_chunk(prev_tag: str, tag: str, prev_type: str, type_: str) -> bool:
     return chunk_start
 
 
+def get_entity_arrays(
+    tag_ids: Any,
+    lengths: Any,
+    id2label: Dict[int, str],
+    *,
+    suffix: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Gets entities from a batch of tag ids, the results are identical to `get_entities`.
+    Args:
+        tag_ids: [batch_size, seq_len] tag ids.
+        lengths: number of leading tokens of each sequence to decode.
+        id2label: mapping from tag id to label.
+        suffix: if type as the suffix
+    Returns:
+        (batch_ids, chunk_types, chunk_starts, chunk_ends), chunks of each sequence are in the same order as
+        `get_entities`.
+    """
+    if isinstance(tag_ids, torch.Tensor):
+        tag_ids = tag_ids.detach().cpu().numpy()
+    if isinstance(lengths, torch.Tensor):
+        lengths = lengths.detach().cpu().numpy()
+    tag_ids, lengths = np.asarray(tag_ids, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+
+    # 标签 id -> (标记字符, 类型 id)，最后一个位置表示 'O'
+    tags, types = [], []
+    num_tags = max(id2label) + 1 if id2label else 0
+    for i in range(num_tags + 1):
+        chunk = id2label.get(i, 'O') if i < num_tags else 'O'
+        tags.append(chunk[-1] if suffix else chunk[0])
+        types.append(chunk.split('-')[0] if suffix else chunk.split('-')[-1])
+    tag_chars, tag_codes = np.unique(np.asarray(tags), return_inverse=True)
+    type_names, type_codes = np.unique(np.asarray(types), return_inverse=True)
+
+    def code(c):
+        idx = np.flatnonzero(tag_chars == c)
+        return idx[0] if len(idx) else -1
+
+    # 每个序列后面补一个 'O'，超出长度的位置同样视为 'O'
+    batch_size, seq_len = tag_ids.shape
+    ids = np.full((batch_size, seq_len + 1), num_tags, dtype=np.int64)
+    valid = np.arange(seq_len)[None] < lengths[:, None]
+    ids[:, :seq_len][valid] = tag_ids[valid]
+
+    tag, type_ = tag_codes[ids], type_codes[ids]
+    prev_tag = np.concatenate([np.full((batch_size, 1), code('O')), tag[:, :-1]], 1)
+    prev_type = np.concatenate([np.full((batch_size, 1), -1), type_[:, :-1]], 1)
+
+    b, i, o, e, s, dot = (code(c) for c in "BIOES.")
+    is_in = np.isin
+    type_changed = prev_type != type_
+    chunk_end = (is_in(prev_tag, [b, i]) & is_in(tag, [b, s, o])) | is_in(prev_tag, [e, s])
+    chunk_end |= (prev_tag != o) & (prev_tag != dot) & type_changed
+    chunk_start = is_in(tag, [b, s]) | (is_in(prev_tag, [e, s, o]) & is_in(tag, [e, i]))
+    chunk_start |= (tag != o) & (tag != dot) & type_changed
+
+    width = seq_len + 1
+    batch_ids, end_positions = np.nonzero(chunk_end)
+    start_keys = np.flatnonzero(chunk_start)
+    # 开始位置取当前位置之前最近一次出现的开始，没有时为 0
+    idx = np.searchsorted(start_keys, batch_ids * width + end_positions, side="left") - 1
+    last_start = start_keys[np.maximum(idx, 0)] if len(start_keys) else np.zeros_like(idx)
+    same_row = (idx >= 0) & (last_start // width == batch_ids)
+    starts = np.where(same_row, last_start % width, 0)
+
+    chunk_types = type_names[prev_type[batch_ids, end_positions]]
+    return batch_ids, chunk_types, starts, end_positions - 1
+
+
 def is_overlapped(chunk1: tuple, chunk2: tuple):
     (_, s1, e1), (_, s2, e2) = chunk1, chunk2
     return s1 < e2 and s2 < e1
@@ -94,10 +166,244 @@ def is_clashed(chunk1: tuple, chunk2: tuple, allow_nested: bool = True):
         return is_overlapped(chunk1, chunk2)
 
 
+class _MaxSegmentTree:
+    """ 支持单点更新（取最大值）与区间最大值查询的线段树 """
+
+    def __init__(self, size: int, fill: int):
+        self.size, self.fill = size, fill
+        self.tree = [fill] * (2 * size)
+
+    def update(self, index: int, value: int):
+        index += self.size
+        if value <= self.tree[index]:
+            return
+        self.tree[index] = value
+        index >>= 1
+        while index:
+            self.tree[index] = max(self.tree[2 * index], self.tree[2 * index + 1])
+            index >>= 1
+
+    def query(self, lo: int, hi: int) -> int:
+        """ 区间 [lo, hi) 内的最大值 """
+        res = self.fill
+        lo, hi = lo + self.size, hi + self.size
+        while lo < hi:
+            if lo & 1:
+                res = max(res, self.tree[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                res = max(res, self.tree[hi])
+            lo, hi = lo >> 1, hi >> 1
+        return res
+
+
+def filter_clashed_spans(starts: Any, ends: Any, allow_nested: bool = True) -> List[int]:
+    """
+    按优先级（输入顺序）依次接受与已接受片段不冲突的片段，返回被接受片段的下标，冲突的判定与 `is_clashed` 相同
+
+    将坐标离散化后用线段树维护已接受片段：
+        + 不允许嵌套时，冲突等价于已接受片段中开始位置小于 end 的片段的最大结束位置大于 start
+        + 允许嵌套时，冲突等价于存在交叉的片段，即开始位置在 (start, end) 内且结束位置大于 end，
+          或结束位置在 (start, end) 内且开始位置小于 start
+    """
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    if len(starts) == 0:
+        return []
+
+    coords, ranks = np.unique(np.concatenate([starts, ends]), return_inverse=True)
+    starts, ends = ranks[:len(starts)].tolist(), ranks[len(starts):].tolist()
+    size = len(coords)
+
+    max_end_by_start = _MaxSegmentTree(size, -1)
+    neg_min_start_by_end = _MaxSegmentTree(size, -size)
+
+    accepted = []
+    for i, (s, e) in enumerate(zip(starts, ends)):
+        if allow_nested:
+            clashed = max_end_by_start.query(s + 1, e) > e or neg_min_start_by_end.query(s + 1, e) > -s
+        else:
+            clashed = max_end_by_start.query(0, e) > s
+        if not clashed:
+            accepted.append(i)
+            max_end_by_start.update(s, e)
+            neg_min_start_by_end.update(e, -s)
+
+    return accepted
+
+
 def filter_clashed_by_priority(chunks, allow_nested: bool = True):
-    filtered_chunks = []
-    for ck in chunks:
-        if all(not is_clashed(ck, ex_ck, allow_nested=allow_nested) for ex_ck in filtered_chunks):
-            filtered_chunks.append(ck)
+    if len(chunks) == 0:
+        return []
+    starts, ends = [ck[1] for ck in chunks], [ck[2] for ck in chunks]
+    return [chunks[i] for i in filter_clashed_spans(starts, ends, allow_nested=allow_nested)]
+
+
+def offset_mapping_to_array(offset_mapping: Any, seq_len: int) -> np.ndarray:
+    """
+    将一个批次的 offset_mapping 转换为 [batch_size, seq_len, 2] 的数组，便于按下标批量查找字符位置，不足部分补 0
+    """
+    if isinstance(offset_mapping, torch.Tensor):
+        return offset_mapping.detach().cpu().numpy()
+
+    array = np.zeros((len(offset_mapping), seq_len, 2), dtype=np.int64)
+    for i, mapping in enumerate(offset_mapping):
+        mapping = np.asarray(mapping, dtype=np.int64).reshape(-1, 2)[:seq_len]
+        array[i, :len(mapping)] = mapping
+    return array
+
+
+def extract_sparse_candidates(
+    scores: torch.Tensor,
+    threshold: Optional[float] = None,
+    *,
+    attention_mask: Optional[torch.Tensor] = None,
+    position_dims: Tuple[int, ...] = (-2, -1),
+    upper_triangular: bool = False,
+    values: Optional[torch.Tensor] = None,
+) -> Tuple[np.ndarray, ...]:
+    """
+    在得分张量所在的设备上筛选并压缩候选位置，只将稀疏的候选行拷贝到 CPU，避免拷贝整个 [B, H, L, L] 的得分矩阵
+    Args:
+        scores: [batch_size, ...] 的得分张量，`threshold` 为 None 时视为布尔张量
+        threshold: 得分严格大于阈值的位置为候选
+        attention_mask: [batch_size, seq_len]，给定时排除 `position_dims` 上位于 [CLS]、[SEP]、padding 的候选
+        position_dims: 表示 token 位置的维度
+        upper_triangular: 是否要求 `position_dims` 中前一个位置不大于后一个位置
+        values: 与 `scores` 形状相同，额外取出候选位置上的值（如得分、标签）
+    Returns:
+        候选位置每一维的下标数组，给定 `values` 时最后附加候选位置上的值
+    """
+    hits = scores if threshold is None else scores > threshold
+    index = torch.nonzero(hits)  # [num_candidates, ndim]
+
+    if attention_mask is not None or upper_triangular:
+        keep = torch.ones_like(index[:, 0], dtype=torch.bool)
+        if attention_mask is not None:
+            seq_lens = attention_mask.sum(1)[index[:, 0]]
+            for dim in position_dims:
+                keep &= (index[:, dim] > 0) & (index[:, dim] < seq_lens - 1)
+        if upper_triangular:
+            keep &= index[:, position_dims[0]] <= index[:, position_dims[1]]
+        index = index[keep]
+
+    outputs = tuple(index.detach().cpu().numpy().T)
+    if values is not None:
+        values = values[index.unbind(1)].detach()
+        outputs += (values.float() if values.is_floating_point() else values).cpu().numpy(),
+    return outputs
+
+
+@lru_cache(maxsize=64)
+def get_shaking_index(seq_len: int, device: torch.device = torch.device("cpu")) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    `HandshakingKernel` 按矩阵上三角逐行展开 token 对，返回每个展开位置对应的 (行下标, 列下标)，按序列长度与设备缓存
+    """
+    rows, cols = torch.triu_indices(seq_len, seq_len, device=device)
+    return rows, cols
+
+
+def join_indices(left_keys: np.ndarray, right_keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    两组整数键的等值连接（多对多），返回所有满足 left_keys[i] == right_keys[j] 的下标对 (i, j)
+    """
+    order = np.argsort(right_keys, kind="stable")
+    sorted_keys = right_keys[order]
+    lo = np.searchsorted(sorted_keys, left_keys, side="left")
+    counts = np.searchsorted(sorted_keys, left_keys, side="right") - lo
+
+    left_idx = np.repeat(np.arange(len(left_keys)), counts)
+    # 每个左侧下标对应右侧有序数组中连续的一段 [lo, lo + count)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_idx = order[np.repeat(lo, counts) + offsets]
+    return left_idx, right_idx
+
+
+def match_nearest_end(
+    start_groups: np.ndarray,
+    start_positions: np.ndarray,
+    end_groups: np.ndarray,
+    end_positions: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    就近原则匹配片段：对每个开始位置，在同一分组（句子、主体、类型等的组合编号）内找到位置不小于它的第一个结束位置
+    Returns:
+        start_idx: 成功匹配的开始位置在输入中的下标
+        end_positions: 与之匹配的结束位置
+    """
+    if len(end_positions) == 0 or len(start_positions) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # 按 (分组, 位置) 排序后二分查找，分组编号作为高位
+    seq_len = int(max(start_positions.max(), end_positions.max())) + 1
+    end_keys = np.sort(end_groups * seq_len + end_positions)
+    idx = np.searchsorted(end_keys, start_groups * seq_len + start_positions, side="left")
+    idx = np.minimum(idx, len(end_keys) - 1)
+
+    start_idx = np.flatnonzero(end_keys[idx] // seq_len == start_groups)
+    # idx 截断到最后一个结束位置时可能小于开始位置
+    start_idx = start_idx[end_keys[idx[start_idx]] % seq_len >= start_positions[start_idx]]
+    return start_idx, end_keys[idx[start_idx]] % seq_len
+
+
+def _get_spots(preds: Any) -> np.ndarray:
+    """
+    取出边界标记的 (句子下标, 位置, 标签)，preds 为 [batch_size, seq_len, num_labels] 的布尔矩阵、
+    [batch_size, seq_len] 的布尔矩阵（单一标签）或 [batch_size, seq_len] 的整数标签（0 表示非边界）
+    """
+    if not isinstance(preds, torch.Tensor):
+        preds = torch.from_numpy(np.asarray(preds))
+
+    if preds.dim() == 2 and preds.dtype != torch.bool:
+        return np.stack(extract_sparse_candidates(preds, values=preds.long()))
+
+    spots = extract_sparse_candidates(preds)
+    if preds.dim() == 2:
+        spots += (np.zeros_like(spots[0]),)
+    return np.stack(spots)
+
+
+def extract_nearest_spans(
+    start_preds: Any,
+    end_preds: Any,
+    seq_lens: Any,
+    exclude_special_tokens: bool = True,
+    unique_end: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    按就近原则批量解码片段：对每个开始位置，匹配同一句子、同一标签下位置不小于它的第一个结束位置
+
+    Args:
+        start_preds: 开始位置预测，布尔矩阵或整数标签，参考 `_get_spots`
+        end_preds: 结束位置预测，格式与 `start_preds` 相同
+        seq_lens: 每个句子的实际长度
+        exclude_special_tokens: 是否排除首尾的 [CLS]、[SEP]
+        unique_end: 多个开始位置匹配到同一个结束位置时，是否只保留最靠后的开始位置（UIE 的解码方式）
+    Returns:
+        (batch_ids, labels, starts, ends)
+    """
+    seq_lens = np.asarray(seq_lens.detach().cpu() if isinstance(seq_lens, torch.Tensor) else seq_lens)
+    seq_lens = seq_lens.astype(np.int64)
+    start_batch_ids, starts, start_labels = _get_spots(start_preds)
+    end_batch_ids, ends, end_labels = _get_spots(end_preds)
+
+    lower, upper = (1, seq_lens - 1) if exclude_special_tokens else (0, seq_lens)
+    keep = (starts >= lower) & (starts < upper[start_batch_ids])
+    start_batch_ids, starts, start_labels = start_batch_ids[keep], starts[keep], start_labels[keep]
+    keep = ends < upper[end_batch_ids]
+    end_batch_ids, ends, end_labels = end_batch_ids[keep], ends[keep], end_labels[keep]
+
+    num_labels = int(max(start_labels.max(initial=0), end_labels.max(initial=0))) + 1
+    start_idx, ends = match_nearest_end(
+        start_batch_ids * num_labels + start_labels, starts, end_batch_ids * num_labels + end_labels, ends,
+    )
+    batch_ids, labels, starts = start_batch_ids[start_idx], start_labels[start_idx], starts[start_idx]
+
+    if unique_end and len(starts) > 0:
+        order = np.lexsort((starts, ends, labels, batch_ids))
+        batch_ids, labels, starts, ends = batch_ids[order], labels[order], starts[order], ends[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (batch_ids[1:] != batch_ids[:-1]) | (labels[1:] != labels[:-1]) | (ends[1:] != ends[:-1])
+        batch_ids, labels, starts, ends = batch_ids[last], labels[last], starts[last], ends[last]
 
-    return filtered_chunks
+    return batch_ids, labels, starts, ends
@@ -6,47 +6,38 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates, join_indices
 from ..model_utils import RelationExtractionOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_numpy
+from ...datasets.utils import tensor_to_cpu
 from ...layers.global_pointer import EfficientGlobalPointer
 from ...losses import SparseMultilabelCategoricalCrossentropy
 
 
-class DedupList(list):
-    """ 定义去重的 list """
-    def append(self, x):
-        if x not in self:
-            super(DedupList, self).append(x)
-
-
-def neighbors(host, argus, links):
-    """ 构建邻集（host节点与其所有邻居的集合） """
-    results = [host]
-    for argu in argus:
-        if host[2:] + argu[2:] in links:
-            results.append(argu)
-    return list(sorted(results))
+def clique_search(adjacency: np.ndarray) -> List[List[int]]:
+    """搜索每个节点所属的极大完全子图作为独立事件
+    搜索思路：带枢轴的 Bron–Kerbosch 算法，枚举论元链接图中的全部极大完全子图。
+    Args:
+        adjacency: [num_argus, num_argus] 的布尔邻接矩阵
+    Returns:
+        每个极大完全子图包含的论元下标（升序）
+    """
+    neighbors = [set(np.flatnonzero(row).tolist()) - {i} for i, row in enumerate(adjacency)]
+    cliques = []
 
+    def expand(clique, candidates, excluded):
+        if not candidates and not excluded:
+            cliques.append(sorted(clique))
+            return
+        # 枢轴的邻居必然与其共同出现在某个更大的完全子图中，只需从非邻居开始扩展
+        pivot = max(candidates | excluded, key=lambda u: len(neighbors[u] & candidates))
+        for v in list(candidates - neighbors[pivot]):
+            expand(clique + [v], candidates & neighbors[v], excluded & neighbors[v])
+            candidates.remove(v)
+            excluded.add(v)
 
-def clique_search(argus, links):
-    """搜索每个节点所属的完全子图作为独立事件
-    搜索思路：找出不相邻的节点，然后分别构建它们的邻集，递归处理。
-    """
-    Argus = DedupList()
-    for i1, (_, _,  h1, t1) in enumerate(argus):
-        for i2, (_, _, h2, t2) in enumerate(argus):
-            if i2 > i1:
-                if (h1, t1, h2, t2) not in links:
-                    Argus.append(neighbors(argus[i1], argus, links))
-                    Argus.append(neighbors(argus[i2], argus, links))
-    if Argus:
-        results = DedupList()
-        for A in Argus:
-            for a in clique_search(A, links):
-                results.append(a)
-        return results
-    else:
-        return [list(sorted(argus))]
+    if len(neighbors) > 0:
+        expand([], set(range(len(neighbors))), set())
+    return sorted(cliques)
 
 
 def get_auto_gplinker_ee_model(
@@ -137,56 +128,49 @@ def get_auto_gplinker_ee_model(
             )
 
         def decode(self, argu_logits, head_logits, tail_logits, masks, texts, offset_mapping):
-            all_event_list = []
-            batch_size = argu_logits.shape[0]
-            masks = tensor_to_numpy(masks)
-
-            entity_logits = tensor_to_numpy(argu_logits)
-            head_logits = tensor_to_numpy(head_logits)
-            tail_logits = tensor_to_numpy(tail_logits)
             decode_thresh = getattr(self.config, "decode_thresh", 0.0)
+            id2predicate = {int(v): k.rsplit('@', 1) for k, v in self.config.predicate2id.items()}
+
+            # 抽取整个批次的论元，排除[CLS]、[SEP]、[PAD]
+            batch_ids, p, h, t = extract_sparse_candidates(argu_logits, decode_thresh, attention_mask=masks)
+
+            # 同一句子中论元两两之间的链接：首首、尾尾得分均超过阈值
+            i, j = join_indices(batch_ids, batch_ids)
+            index = torch.from_numpy(np.stack([
+                batch_ids[i], np.minimum(h[i], h[j]), np.maximum(h[i], h[j]),
+                np.minimum(t[i], t[j]), np.maximum(t[i], t[j]),
+            ])).to(head_logits.device)
+            linked = (head_logits[index[0], 0, index[1], index[2]] > decode_thresh) & \
+                     (tail_logits[index[0], 0, index[3], index[4]] > decode_thresh)
+            linked = tensor_to_cpu(linked).numpy()
+
+            # torch.nonzero 按批次顺序返回，每个句子的论元以及论元对都是连续的一段
+            sentence_ids = np.arange(argu_logits.shape[0])
+            argu_bounds = np.searchsorted(batch_ids, sentence_ids, side="left"), \
+                np.searchsorted(batch_ids, sentence_ids, side="right")
+            pair_bounds = np.searchsorted(i, argu_bounds[0], side="left"), np.searchsorted(i, argu_bounds[1], side="left")
 
-            id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
-            for bs in range(batch_size):
-                l = masks[bs].sum()
+            all_event_list = []
+            for bs, (lo, hi, pair_lo, pair_hi) in enumerate(zip(*argu_bounds, *pair_bounds)):
                 text, mapping = texts[bs], offset_mapping[bs]
+                argus = [
+                    (*id2predicate[_p], _h, _t)
+                    for _p, _h, _t in zip(p[lo: hi].tolist(), h[lo: hi].tolist(), t[lo: hi].tolist())
+                ]
+                adjacency = np.zeros((hi - lo, hi - lo), dtype=bool)
+                adjacency[i[pair_lo: pair_hi] - lo, j[pair_lo: pair_hi] - lo] = linked[pair_lo: pair_hi]
 
-                # 抽取论元
-                argus = set()
-                _entity_logits = entity_logits[bs]
-                for p, h, t in zip(*np.where(_entity_logits > decode_thresh)):
-                    if h >= (l - 1) or t >= (l - 1) or 0 in [h, t]:  # 排除[CLS]、[SEP]、[PAD]
-                        continue
-                    p = id2predicate[p].rsplit('@', 1)
-                    argus.add((*p, h, t))
-
-                # 构建链接
-                links = set()
-                _head_logits, _tail_logits = head_logits[bs], tail_logits[bs]
-                for i1, (_, _, h1, t1) in enumerate(argus):
-                    for i2, (_, _, h2, t2) in enumerate(argus):
-                        if i2 > i1:
-                            if _head_logits[0, min(h1, h2), max(h1, h2)] > decode_thresh and _tail_logits[
-                                    0, min(t1, t2), max(t1, t2)] > decode_thresh:
-                                links.add((h1, t1, h2, t2))
-                                links.add((h2, t2, h1, t1))
                 # 析出事件
                 events = []
-                for _, sub_argus in groupby(sorted(argus), key=lambda s: s[0]):
-                    for event in clique_search(list(sub_argus), links):
+                order = sorted(range(len(argus)), key=lambda k: argus[k])
+                for _, group in groupby(order, key=lambda k: argus[k][0]):
+                    group = list(group)
+                    for event in clique_search(adjacency[np.ix_(group, group)]):
                         events.append([])
-                        for argu in event:
+                        for argu in sorted(argus[group[k]] for k in event):
                             start, end = mapping[argu[2]][0], mapping[argu[3]][1]
-                            events[-1].append(
-                                (
-                                    argu[0],
-                                    argu[1],
-                                    text[start: end],
-                                    start,
-                                    end
-                                )
-                            )
-                        if self.has_trigger and all([argu[1] != "触发词" for argu in event]):
+                            events[-1].append((argu[0], argu[1], text[start: end], start, end))
+                        if self.has_trigger and all([argu[1] != "触发词" for argu in events[-1]]):
                             events.pop()
 
                 all_event_list.append(events)
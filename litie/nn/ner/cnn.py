@@ -1,13 +1,14 @@
 from typing import Optional, List, Any
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
 from transformers import PreTrainedModel
 
-from ..decode_utils import filter_clashed_by_priority
+from ..decode_utils import extract_sparse_candidates, filter_clashed_spans, get_shaking_index
 from ..model_utils import SequenceLabelingOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_cpu, seq_len_to_mask, tensor_to_list
+from ...datasets.utils import tensor_to_cpu, seq_len_to_mask
 from ...utils.imports import TORCH_SCATTER_AVAILABLE
 
 if TORCH_SCATTER_AVAILABLE:
@@ -243,38 +244,35 @@ def get_auto_cnn_ner_model(
                 attentions=outputs.attentions,
             )
 
-        @staticmethod
-        def spans_from_upper_triangular(seq_len: int):
-            """Spans from the upper triangular area.
+        def _decode(self, span_pred, lengths, allow_nested=False, thresh=0.5):
             """
-            for start in range(seq_len):
-                for end in range(start, seq_len):
-                    yield start, end
+            一次取出批量中所有超过阈值的上三角片段，按置信度从高到低排序后过滤冲突的片段
+            返回每个句子的 (句子下标, 开始位置, 结束位置) 数组
+            """
+            seq_len = span_pred.size(1)
+            rows, cols = get_shaking_index(seq_len, span_pred.device)
+            tmp_scores = span_pred[:, rows, cols]  # [batch_size, seq_len * (seq_len + 1) / 2]
+
+            lengths = torch.as_tensor(lengths, device=span_pred.device)
+            batch_ids, ids, confidences = extract_sparse_candidates(
+                (tmp_scores >= thresh) & (cols[None] < lengths[:, None]), values=tmp_scores
+            )
+            starts, ends = (x.numpy()[ids] for x in get_shaking_index(seq_len))
+
+            # 同一句子内按 (置信度, 开始, 结束) 从大到小排序
+            order = np.lexsort((-ends, -starts, -confidences, batch_ids))
+            batch_ids, starts, ends = batch_ids[order], starts[order], ends[order]
 
-        def _decode(self, scores, lengths, allow_nested=False, thresh=0.5):
             batch_chunks = []
-            for idx, (_scores, l) in enumerate(zip(scores, lengths)):
-                curr_non_mask = scores.new_ones(l, l, dtype=bool).triu()
-                tmp_scores = _scores[:l, :l][curr_non_mask]
-
-                confidences, label_ids = tmp_scores, tmp_scores >= thresh
-                labels = list(label_ids)
-                chunks = [(label, start, end) for label, (start, end) in
-                          zip(labels, self.spans_from_upper_triangular(l)) if label != 0]
-                confidences = [conf for label, conf in zip(labels, confidences) if label != 0]
-
-                assert len(confidences) == len(chunks)
-                chunks = [ck for _, ck in sorted(zip(confidences, chunks), reverse=True)]
-                chunks = filter_clashed_by_priority(chunks, allow_nested=allow_nested)
-                if len(chunks):
-                    batch_chunks.append(set([(s, e, l) for l, s, e in chunks]))
-                else:
-                    batch_chunks.append(set())
+            bounds = np.searchsorted(batch_ids, np.arange(span_pred.size(0) + 1))
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                keep = filter_clashed_spans(starts[lo:hi], ends[lo:hi], allow_nested=allow_nested)
+                keep = lo + np.asarray(keep, dtype=np.int64)
+                batch_chunks.append((batch_ids[keep], starts[keep], ends[keep]))
             return batch_chunks
 
         def decode(self, scores, lengths, texts):
-            all_entity_list = []
-            scores, lengths = tensor_to_cpu(torch.sigmoid(scores)), tensor_to_list(lengths)
+            scores = torch.sigmoid(scores)
             scores = (scores + scores.transpose(1, 2)) / 2
             span_pred = scores.max(dim=-1)[0]
 
@@ -283,14 +281,17 @@ def get_auto_cnn_ner_model(
             id2label = {int(v): k for k, v in self.config.cnn_label2id.items()}
 
             span_ents = self._decode(span_pred, lengths, allow_nested=allow_nested, thresh=decode_thresh)
-            for span_ent, _scores, text in zip(span_ents, scores, texts):
-                entity_set = set()
-                for s, e, l in span_ent:
-                    score = _scores[s, e]
-                    _type = score.argmax()
-                    if score[_type] >= decode_thresh:
-                        entity_set.add((id2label[_type.item()], s, e + 1, text[s: e + 1]))
-                all_entity_list.append(entity_set)
+            batch_ids, starts, ends = (np.concatenate(x) for x in zip(*span_ents))
+            index = [torch.from_numpy(x).to(scores.device) for x in (batch_ids, starts, ends)]
+            span_scores, span_types = scores[index[0], index[1], index[2]].max(-1)
+            span_scores, span_types = tensor_to_cpu(span_scores).numpy(), tensor_to_cpu(span_types).numpy()
+
+            all_entity_list = [set() for _ in range(scores.size(0))]
+            for b, s, e, _type, score in zip(
+                batch_ids.tolist(), starts.tolist(), ends.tolist(), span_types.tolist(), span_scores.tolist()
+            ):
+                if score >= decode_thresh:
+                    all_entity_list[b].add((id2label[_type], s, e + 1, texts[b][s: e + 1]))
 
             return all_entity_list
 
@@ -4,7 +4,7 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
-from ..decode_utils import get_entities
+from ..decode_utils import get_entity_arrays, offset_mapping_to_array
 from ..model_utils import SequenceLabelingOutput, MODEL_MAP
 from ...datasets.utils import sequence_padding, tensor_to_cpu
 from ...layers import CrfLayer
@@ -98,16 +98,18 @@ def get_auto_crf_ner_model(
 
         def decode(self, logits, mask, texts, offset_mapping):
             decode_ids = self.crf.decode(logits, mask.bool()).squeeze(0)  # (batch_size, seq_length)
-            decode_ids, mask = tensor_to_cpu(decode_ids), tensor_to_cpu(mask)
             id2label = {int(v): k for k, v in self.config.bio_label2id.items()}
 
-            decode_labels = []
-            for text, ids, mask, mapping in zip(texts, decode_ids, mask, offset_mapping):
-                decode_label = [id2label[_id.item()] for _id, m in zip(ids, mask) if m > 0][:-1]  # [CLS], [SEP]
-                decode_label = get_entities(decode_label)
-                decode_label = [(l[0], mapping[l[1]][0], mapping[l[2]][1], text[mapping[l[1]][0]: mapping[l[2]][1]]) for
-                                l in decode_label]
-                decode_labels.append(set(decode_label))
+            # 去掉 [SEP]
+            batch_ids, chunk_types, starts, ends = get_entity_arrays(decode_ids, mask.sum(1) - 1, id2label)
+            mapping = offset_mapping_to_array(offset_mapping, mask.size(1))
+            char_starts, char_ends = mapping[batch_ids, starts, 0], mapping[batch_ids, ends, 1]
+
+            decode_labels = [set() for _ in range(len(texts))]
+            for b, _type, _start, _end in zip(
+                batch_ids.tolist(), chunk_types.tolist(), char_starts.tolist(), char_ends.tolist()
+            ):
+                decode_labels[b].add((_type, _start, _end, texts[b][_start: _end]))
 
             return decode_labels
 
@@ -202,14 +204,12 @@ def get_auto_cascade_crf_ner_model(model_type: str = "bert"):
             BIO_MAP = getattr(self.config, 'BIO_MAP', {0: "O", 1: "B-ENT", 2: "I-ENT"})
             id2label = {int(v): k for k, v in self.config.bio_label2id.items()}
 
-            entity_ids = []
-            for ids, mask in zip(decode_ids, mask):
-                decode_label = [BIO_MAP[_id.item()] for _id, m in zip(ids, mask) if m > 0][:-1]  # [CLS], [SEP]
-                decode_label = get_entities(decode_label)
-                if len(decode_label) > 0:
-                    entity_ids.append([[l[1], l[2]] for l in decode_label])
-                else:
-                    entity_ids.append([[0, 0]])
+            # 去掉 [SEP]
+            batch_ids, _, starts, ends = get_entity_arrays(decode_ids, mask.sum(1) - 1, BIO_MAP)
+            entity_ids = [[] for _ in range(decode_ids.size(0))]
+            for b, s, e in zip(batch_ids.tolist(), starts.tolist(), ends.tolist()):
+                entity_ids[b].append([s, e])
+            entity_ids = [ids if len(ids) > 0 else [[0, 0]] for ids in entity_ids]
 
             entity_ids = torch.from_numpy(sequence_padding(entity_ids)).to(sequence_output.device)
             entity_logits = self.get_entity_logits(sequence_output, entity_ids)
@@ -312,17 +312,19 @@ def get_auto_softmax_ner_model(model_type: str = "bert"):
             )
 
         def decode(self, logits, mask, texts, offset_mapping):
-            logits, mask = tensor_to_cpu(logits), tensor_to_cpu(mask)
             decode_ids = torch.argmax(logits, -1)  # (batch_size, seq_length)
             id2label = {int(v): k for k, v in self.config.bio_label2id.items()}
 
-            decode_labels = []
-            for text, ids, mask, mapping in zip(texts, decode_ids, mask, offset_mapping):
-                decode_label = [id2label[_id.item()] for _id, m in zip(ids, mask) if m > 0][:-1]  # [CLS], [SEP]
-                decode_label = get_entities(decode_label)
-                decode_label = [(l[0], mapping[l[1]][0], mapping[l[2]][1], text[mapping[l[1]][0]: mapping[l[2]][1]]) for
-                                l in decode_label]
-                decode_labels.append(set(decode_label))
+            # 去掉 [SEP]
+            batch_ids, chunk_types, starts, ends = get_entity_arrays(decode_ids, mask.sum(1) - 1, id2label)
+            mapping = offset_mapping_to_array(offset_mapping, mask.size(1))
+            char_starts, char_ends = mapping[batch_ids, starts, 0], mapping[batch_ids, ends, 1]
+
+            decode_labels = [set() for _ in range(len(texts))]
+            for b, _type, _start, _end in zip(
+                batch_ids.tolist(), chunk_types.tolist(), char_starts.tolist(), char_ends.tolist()
+            ):
+                decode_labels[b].add((_type, _start, _end, texts[b][_start: _end]))
             return decode_labels
 
         def compute_loss(self, inputs):
@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates, offset_mapping_to_array
 from ..model_utils import SequenceLabelingOutput, MODEL_MAP
 from ...datasets.utils import tensor_to_cpu
 from ...layers import GlobalPointer, EfficientGlobalPointer, Biaffine, UnlabeledEntity
@@ -47,20 +48,27 @@ def get_auto_global_pointer_ner_model(
             self.dropout = nn.Dropout(classifier_dropout)
 
             head_type = getattr(config, 'head_type', 'efficient_global_pointer')
+            # 实体的最大宽度，设置后只计算并返回 [batch_size, num_labels, seq_len, max_span_width] 的带状得分
+            max_span_width = getattr(config, 'max_span_width', None)
+            if max_span_width is not None and head_type not in ["efficient_global_pointer", "global_pointer"]:
+                raise ValueError(f"`max_span_width` is not supported by head type {head_type}")
+
             # token对特征的计算方式
             if head_type == "efficient_global_pointer":
                 self.global_pointer = EfficientGlobalPointer(
                     config.hidden_size,
                     config.num_labels,
                     config.head_size,
-                    use_rope=config.use_rope
+                    use_rope=config.use_rope,
+                    max_span_width=max_span_width,
                 )
             elif head_type == "global_pointer":
                 self.global_pointer = GlobalPointer(
                     config.hidden_size,
                     config.num_labels,
                     config.head_size,
-                    use_rope=config.use_rope
+                    use_rope=config.use_rope,
+                    max_span_width=max_span_width,
                 )
             elif head_type == "biaffine":
                 self.global_pointer = Biaffine(config.hidden_size, config.head_size, config.num_labels)
@@ -110,23 +118,32 @@ def get_auto_global_pointer_ner_model(
             )
 
         def decode(self, logits, masks, texts, offset_mapping):
-            all_entity_list = []
-            seq_lens, logits = tensor_to_cpu(masks.sum(1)), tensor_to_cpu(logits).float()
             id2label = {int(v): k for k, v in self.config.global_pointer_label2id.items()}
-
             decode_thresh = getattr(self.config, "decode_thresh", 0.0)
-            for _logits, l, text, mapping in zip(logits, seq_lens, texts, offset_mapping):
-                entity_list = set()
-                l = l.item()
-
-                for label_id, start_idx, end_idx in zip(*torch.where(_logits > decode_thresh)):
-                    label_id, start_idx, end_idx = label_id.item(), start_idx.item(), end_idx.item()
-                    if start_idx >= (l - 1) or end_idx >= (l - 1) or 0 in [start_idx, end_idx]:
-                        continue
-                    label = id2label[label_id]
-                    _start, _end = mapping[start_idx][0], mapping[end_idx][1]
-                    entity_list.add((label, _start, _end, text[_start: _end]))
-                all_entity_list.append(set(entity_list))
+
+            # 在设备上对整个批次筛选候选片段，过滤 [CLS]、[SEP]、padding 以及 start > end 的片段
+            # 只将稀疏的候选片段拷贝到 CPU
+            if getattr(self.config, "max_span_width", None) is None:
+                batch_ids, label_ids, starts, ends = extract_sparse_candidates(
+                    logits, decode_thresh, attention_mask=masks, upper_triangular=True
+                )
+            else:
+                # 带状得分中 (i, w) 表示片段 [i, i + w]
+                batch_ids, label_ids, starts, widths = extract_sparse_candidates(
+                    logits, decode_thresh, attention_mask=masks, position_dims=(-2,)
+                )
+                ends = starts + widths
+                keep = ends < tensor_to_cpu(masks.sum(1)).numpy()[batch_ids] - 1
+                batch_ids, label_ids, starts, ends = batch_ids[keep], label_ids[keep], starts[keep], ends[keep]
+
+            mapping = offset_mapping_to_array(offset_mapping, logits.shape[2])
+            char_starts, char_ends = mapping[batch_ids, starts, 0], mapping[batch_ids, ends, 1]
+
+            all_entity_list = [set() for _ in range(logits.shape[0])]
+            for b, label_id, _start, _end in zip(
+                batch_ids.tolist(), label_ids.tolist(), char_starts.tolist(), char_ends.tolist()
+            ):
+                all_entity_list[b].add((id2label[label_id], _start, _end, texts[b][_start: _end]))
 
             return all_entity_list
 
@@ -141,7 +158,14 @@ def get_auto_global_pointer_ner_model(
                 return loss_fct(preds.reshape(shape[0] * self.config.num_labels, -1),
                                 target.reshape(shape[0] * self.config.num_labels, -1))
             else:
-                target = target[..., 0] * shape[2] + target[..., 1]  # [bsz, heads, num_spoes]
+                if getattr(self.config, "max_span_width", None) is None:
+                    target = target[..., 0] * shape[2] + target[..., 1]  # [bsz, heads, num_spoes]
+                else:
+                    # 带状得分中片段 [i, j] 位于 (i, j - i)，超出最大宽度的片段无法预测，与填充的 (0, 0) 一样被忽略
+                    widths = target[..., 1] - target[..., 0]
+                    target = torch.where(
+                        (widths >= 0) & (widths < shape[3]), target[..., 0] * shape[3] + widths, torch.zeros_like(widths)
+                    )
                 preds = preds.reshape(shape[0], -1, np.prod(shape[2:]))
                 loss_fct = SparseMultilabelCategoricalCrossentropy(mask_zero=True)
                 return loss_fct(preds, target).sum(dim=1).mean()
@@ -160,6 +184,7 @@ def get_global_pointer_ner_model_config(labels: list, **kwargs):
         "is_sparse": False,
         "head_type": "efficient_global_pointer",
         "decode_thresh": 0.,
+        "max_span_width": None,
     }
     model_config.update(kwargs)
     return model_config
@@ -4,8 +4,8 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_nearest_spans, offset_mapping_to_array
 from ..model_utils import SpanOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_cpu
 from ...layers import LabelFusionForToken, Classifier, MLPForMultiLabel
 from ...losses import SpanLossForMultiLabel
 
@@ -68,6 +68,7 @@ def get_auto_lear_ner_model(
             offset_mapping: Optional[List[Any]] = None,
             target: Optional[List[Any]] = None,
             return_decoded_labels: Optional[bool] = True,
+            label_hidden_states: Optional[torch.Tensor] = None,
         ) -> SpanOutput:
 
             token_features = getattr(self, self.base_model_prefix)(
@@ -77,11 +78,12 @@ def get_auto_lear_ner_model(
             )[0]
             token_features = self.dropout(token_features)
 
-            label_features = getattr(self, self.base_model_prefix)(
-                label_input_ids,
-                attention_mask=label_attention_mask,
-                token_type_ids=label_token_type_ids,
-            )[0]
+            # 推理时标签描述的编码与输入无关，可以传入预先计算好的`label_hidden_states`
+            if label_hidden_states is None:
+                label_hidden_states = self.encode_labels(
+                    label_input_ids, label_attention_mask, label_token_type_ids
+                )
+            label_features = label_hidden_states
 
             fused_features = self.label_fusion_layer(token_features, label_features, label_attention_mask)
 
@@ -118,36 +120,36 @@ def get_auto_lear_ner_model(
                 predictions=predictions,
                 groundtruths=target)
 
+        def encode_labels(self, label_input_ids, label_attention_mask=None, label_token_type_ids=None):
+            """ 编码所有标签的文本描述，返回 [num_labels, label_len, hidden_size] """
+            return getattr(self, self.base_model_prefix)(
+                label_input_ids,
+                attention_mask=label_attention_mask,
+                token_type_ids=label_token_type_ids,
+            )[0]
+
         def decode(self, start_logits, end_logits, span_logits, attention_mask, texts, offset_mapping):
             decode_labels = []
             id2label = {int(i): v for i, v in enumerate(self.config.labels)}
 
             if not self.config.nested:
-                seqlens = tensor_to_cpu(attention_mask.sum(1))
                 start_preds, end_preds = torch.sigmoid(start_logits), torch.sigmoid(end_logits)
-                start_preds, end_preds = tensor_to_cpu(start_preds), tensor_to_cpu(end_preds)
 
                 start_thresh = getattr(self.config, "start_thresh", 0.5)
                 end_thresh = getattr(self.config, "end_thresh", 0.5)
 
-                for starts, ends, l, text, mapping in zip(start_preds, end_preds, seqlens, texts, offset_mapping):
-                    l = l.item()
-                    decode_label = set()
-                    starts, ends = torch.where(starts > start_thresh), torch.where(ends > end_thresh)
-                    for _start, c1 in zip(*starts):
-                        _start, c1 = _start.item(), c1.item()
-                        if _start == 0 or _start >= l - 1:
-                            continue
-                        for _end, c2 in zip(*ends):
-                            _end, c2 = _end.item(), c2.item()
-                            if _start <= _end < l - 1 and c1 == c2:
-                                s, e = mapping[_start][0], mapping[_end][1]
-                                decode_label.add((
-                                    id2label[c1], s, e, text[s: e]
-                                ))
-                                break  # 就近原则
-                    decode_labels.append(decode_label)
-
+                # 就近原则
+                batch_ids, labels, starts, ends = extract_nearest_spans(
+                    start_preds > start_thresh, end_preds > end_thresh, attention_mask.sum(1)
+                )
+                mapping = offset_mapping_to_array(offset_mapping, attention_mask.size(1))
+                char_starts, char_ends = mapping[batch_ids, starts, 0], mapping[batch_ids, ends, 1]
+
+                decode_labels = [set() for _ in range(start_logits.size(0))]
+                for b, label, _start, _end in zip(
+                    batch_ids.tolist(), labels.tolist(), char_starts.tolist(), char_ends.tolist()
+                ):
+                    decode_labels[b].add((id2label[label], _start, _end, texts[b][_start: _end]))
                 return decode_labels
 
             bs, seq_len, num_labels = start_logits.shape
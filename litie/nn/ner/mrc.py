@@ -4,8 +4,8 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_nearest_spans, offset_mapping_to_array
 from ..model_utils import SpanOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_cpu
 from ...layers import LayerNorm
 from ...losses import SpanLoss
 
@@ -116,7 +116,6 @@ def get_auto_mrc_ner_model(
             )
 
         def decode(self, start_logits, end_logits, token_type_ids, attention_mask, texts, offset_mapping):
-            decoded_labels = []
             batch_size = start_logits.shape[0]
             labels = list(self.config.labels.keys())
             entity_types = labels * (batch_size // self.config.num_labels)
@@ -124,34 +123,17 @@ def get_auto_mrc_ner_model(
             starts = torch.argmax(start_logits, -1) * token_type_ids
             ends = torch.argmax(end_logits, -1) * token_type_ids
 
-            starts, ends = tensor_to_cpu(starts), tensor_to_cpu(ends)
-            seqlens = tensor_to_cpu(attention_mask.sum(1))
-
-            for _starts, _ends, l, text, mapping, _type in zip(starts, ends, seqlens, texts, offset_mapping,
-                                                               entity_types):
-                entities = set()
-                l = l.item()
-                for i, s in enumerate(_starts):
-                    s = s.item()
-                    if s == 0 or i >= l - 1:
-                        continue
-                    for j, e in enumerate(_ends[i:]):
-                        e = e.item()
-                        if i + j >= l - 1:
-                            continue
-                        if s == e:
-                            _start, _end = mapping[i][0], mapping[i + j][1]
-                            entities.add((
-                                _type,
-                                _start,
-                                _end,
-                                text[_start: _end])
-                            )
-                            break
-                decoded_labels.append(entities)
-
-            return [set.union(*decoded_labels[i: i + self.config.num_labels]) for i in
-                    range(0, batch_size, self.config.num_labels)]
+            batch_ids, _, starts, ends = extract_nearest_spans(starts, ends, attention_mask.sum(1))
+            mapping = offset_mapping_to_array(offset_mapping, attention_mask.size(1))
+            char_starts, char_ends = mapping[batch_ids, starts, 0], mapping[batch_ids, ends, 1]
+
+            # 每 num_labels 个样本对应同一个句子的不同实体类型
+            decoded_labels = [set() for _ in range(0, batch_size, self.config.num_labels)]
+            for b, _start, _end in zip(batch_ids.tolist(), char_starts.tolist(), char_ends.tolist()):
+                decoded_labels[b // self.config.num_labels].add(
+                    (entity_types[b], _start, _end, texts[b][_start: _end])
+                )
+            return decoded_labels
 
         def compute_loss(self, inputs):
             start_logits, end_logits, start_positions, end_positions, masks = inputs[:5]
@@ -4,8 +4,8 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_nearest_spans, offset_mapping_to_array
 from ..model_utils import SpanOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_cpu
 from ...losses import SpanLoss
 
 
@@ -91,32 +91,17 @@ def get_auto_span_ner_model(
 
         def decode(self, start_logits, end_logits, sequence_mask, texts, offset_mapping):
             start_labels, end_labels = torch.argmax(start_logits, -1), torch.argmax(end_logits, -1)
-            start_labels, end_labels = tensor_to_cpu(start_labels), tensor_to_cpu(end_labels)
             id2label = {int(v): k for k, v in self.config.span_label2id.items()}
 
-            decode_labels = []
-            seqlens = tensor_to_cpu(sequence_mask.sum(1))
-            for _starts, _ends, l, text, mapping in zip(start_labels, end_labels, seqlens, texts, offset_mapping):
-                l = l.item()
-                decode_label = set()
-                for i, s in enumerate(_starts):
-                    s = s.item()
-                    if s == 0 or i >= l - 1 or i == 0:
-                        continue
-                    for j, e in enumerate(_ends[i:]):
-                        e = e.item()
-                        if i + j >= l - 1:
-                            continue
-                        if s == e:
-                            _start, _end = mapping[i][0], mapping[i + j][1]
-                            decode_label.add((
-                                id2label[s],
-                                _start,
-                                _end,
-                                text[_start: _end])
-                            )
-                            break
-                decode_labels.append(decode_label)
+            batch_ids, labels, starts, ends = extract_nearest_spans(start_labels, end_labels, sequence_mask.sum(1))
+            mapping = offset_mapping_to_array(offset_mapping, sequence_mask.size(1))
+            char_starts, char_ends = mapping[batch_ids, starts, 0], mapping[batch_ids, ends, 1]
+
+            decode_labels = [set() for _ in range(start_logits.size(0))]
+            for b, label, _start, _end in zip(
+                batch_ids.tolist(), labels.tolist(), char_starts.tolist(), char_ends.tolist()
+            ):
+                decode_labels[b].add((id2label[label], _start, _end, texts[b][_start: _end]))
             return decode_labels
 
         def compute_loss(self, inputs):
@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates, get_shaking_index, offset_mapping_to_array
 from ..model_utils import SequenceLabelingOutput, MODEL_MAP
 from ...datasets.utils import tensor_to_cpu
 from ...layers import HandshakingKernel
@@ -91,51 +92,36 @@ def get_auto_tplinker_ner_model(
             )
 
         def decode(self, shaking_logits, attention_mask, texts, offset_mapping):
-            all_entity_list = []
             seq_len = attention_mask.shape[1]
-
-            seqlens, shaking_logits = tensor_to_cpu(attention_mask.sum(1)), tensor_to_cpu(shaking_logits)
-            shaking_idx2matrix_idx = [(s, e) for s in range(seq_len) for e in list(range(seq_len))[s:]]
             id2label = {int(v): k for k, v in self.config.tplinker_label2id.items()}
 
-            for _shaking_logits, l, text, mapping in zip(shaking_logits, seqlens, texts, offset_mapping):
-                entities = set()
-                l = l.item()
-                matrix_spots = self.get_spots_fr_shaking_tag(shaking_idx2matrix_idx, _shaking_logits)
-
-                for e in matrix_spots:
-                    tag = id2label[e[2]]
-                    # for an entity, the start position can not be larger than the end pos.
-                    if e[0] > e[1] or 0 in [e[0], e[1]] or e[0] >= l - 1 or e[1] >= l - 1:
-                        continue
-                    _start, _end = mapping[e[0]][0], mapping[e[1]][1]
-                    entities.add(
-                        (
-                            tag,
-                            _start,
-                            _end,
-                            text[_start: _end]
-                        )
-                    )
-                all_entity_list.append(entities)
+            batch_ids, starts, ends, tag_ids = self.get_spots_fr_shaking_tag(shaking_logits, seq_len)
+            # 上三角展开保证 start <= end，过滤 [CLS]、[SEP] 与 padding
+            seq_lens = tensor_to_cpu(attention_mask.sum(1)).numpy()[batch_ids]
+            keep = (starts > 0) & (ends < seq_lens - 1)
+            batch_ids, starts, ends, tag_ids = batch_ids[keep], starts[keep], ends[keep], tag_ids[keep]
+
+            mapping = offset_mapping_to_array(offset_mapping, seq_len)
+            char_starts, char_ends = mapping[batch_ids, starts, 0], mapping[batch_ids, ends, 1]
+
+            all_entity_list = [set() for _ in range(shaking_logits.shape[0])]
+            for b, tag_id, _start, _end in zip(
+                batch_ids.tolist(), tag_ids.tolist(), char_starts.tolist(), char_ends.tolist()
+            ):
+                all_entity_list[b].add((id2label[tag_id], _start, _end, texts[b][_start: _end]))
 
             return all_entity_list
 
-        def get_spots_fr_shaking_tag(self, shaking_idx2matrix_idx, shaking_outputs):
+        def get_spots_fr_shaking_tag(self, shaking_logits, seq_len):
             """
-            shaking_tag -> spots
-            shaking_tag: (shaking_seq_len, tag_id)
-            spots: [(start, end, tag), ]
+            shaking_logits -> spots
+            shaking_logits: (batch_size, shaking_seq_len, tag_size)
+            spots: (batch_ids, pos1, pos2, tag_ids)，只将超过阈值的稀疏位置拷贝到 CPU
             """
-            spots = []
-            pred_shaking_tag = (shaking_outputs > self.config.decode_thresh).long()
-            nonzero_points = torch.nonzero(pred_shaking_tag, as_tuple=False)
-            for point in nonzero_points:
-                shaking_idx, tag_idx = point[0].item(), point[1].item()
-                pos1, pos2 = shaking_idx2matrix_idx[shaking_idx]
-                spot = (pos1, pos2, tag_idx)
-                spots.append(spot)
-            return spots
+            decode_thresh = getattr(self.config, "decode_thresh", 0.0)
+            batch_ids, shaking_ids, tag_ids = extract_sparse_candidates(shaking_logits, decode_thresh)
+            rows, cols = (x.numpy() for x in get_shaking_index(seq_len))
+            return batch_ids, rows[shaking_ids], cols[shaking_ids], tag_ids
 
         def compute_loss(self, inputs):
             shaking_logits, labels = inputs[:2]
@@ -1,13 +1,15 @@
 from typing import Optional, List, Any
 
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates
 from ..model_utils import SequenceLabelingOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_cpu
 from ...layers import DilateConvLayer, LayerNorm
+from ...utils.logger import logger
 
 
 class MLP(nn.Module):
@@ -77,6 +79,58 @@ class CoPredictor(nn.Module):
         return o1 + o2
 
 
+def get_reachability(forward: np.ndarray) -> np.ndarray:
+    """
+    计算 NNW 邻接矩阵（只包含 i < j 的边）的传递闭包，reach[i, j] 表示沿 NNW 边能否从 i 走到 j
+    """
+    reach = forward.copy()
+    # 边总是指向后面的位置，按位置从后往前即可由后继的结果得到当前位置的结果
+    for i in np.flatnonzero(forward.any(1))[::-1]:
+        reach[i] |= reach[forward[i]].any(0)
+    return reach
+
+
+def find_entity_paths(
+    forward: np.ndarray,
+    reach: np.ndarray,
+    head: int,
+    tails: np.ndarray,
+    max_paths: Optional[int] = None,
+) -> List[List[int]]:
+    """
+    找出从 head 出发、沿 NNW 边到达 tails 中任一位置的所有路径
+
+    只保留能够到达某个尾部的位置作为搜索空间，用显式栈迭代搜索，路径数量达到 max_paths 时提前停止
+    """
+    is_tail = np.zeros(forward.shape[0], dtype=bool)
+    is_tail[tails] = True
+    alive = is_tail | reach[:, tails].any(1)
+    if not alive[head]:
+        return []
+
+    successors = {}
+    paths, path, stack = [], [], [iter([head])]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            if path:
+                path.pop()
+            continue
+
+        path.append(node)
+        if is_tail[node]:
+            paths.append(path.copy())
+            if max_paths is not None and len(paths) >= max_paths:
+                break
+
+        if node not in successors:
+            successors[node] = np.flatnonzero(forward[node] & alive).tolist()
+        stack.append(iter(successors[node]))
+
+    return paths
+
+
 def get_auto_w2ner_ner_model(
     model_type: Optional[str] = "bert",
     base_model: Optional[PreTrainedModel] = None,
@@ -212,54 +266,58 @@ def get_auto_w2ner_ner_model(
             )
 
         def decode(self, logits, input_lengths, texts):
-            decode_labels = []
-            logits, input_lengths = tensor_to_cpu(logits.argmax(-1)), tensor_to_cpu(input_lengths)
             id2label = {int(v): k for k, v in self.config.w2ner_label2id.items()}
-
-            for _logits, length, text in zip(logits, input_lengths, texts):
-                forward_dict, head_dict, ht_type_dict = {}, {}, {}
-                for i in range(length):
-                    for j in range(i + 1, length):
-                        if _logits[i, j].item() == 1:  # NNW
-                            if i not in forward_dict:
-                                forward_dict[i] = [j]
-                            else:
-                                forward_dict[i].append(j)
-
-                for i in range(length):
-                    for j in range(i, length):
-                        if _logits[j, i].item() > 1:  # THW
-                            ht_type_dict[(i, j)] = _logits[j, i].item()
-                            if i not in head_dict:
-                                head_dict[i] = {j}
-                            else:
-                                head_dict[i].add(j)
-
-                predicts = []
-
-                def find_entity(key, entity, tails):
-                    entity.append(key)
-                    if key in tails:
-                        predicts.append(entity.copy())
-                    if key not in forward_dict:
-                        entity.pop()
-                        return
-                    for k in forward_dict[key]:
-                        find_entity(k, entity, tails)
-                    entity.pop()
-
-                for head in head_dict:
-                    find_entity(head, [], head_dict[head])
-
-                entities = set()
-                for _entity in predicts:
-                    entities.add((
-                        id2label[ht_type_dict[(_entity[0], _entity[-1])]],
-                        _entity[0],
-                        _entity[-1] + 1,
-                        ''.join([text[i] for i in _entity]),
+            max_paths = getattr(self.config, "max_decode_paths", None)
+
+            grid = logits.argmax(-1)  # [batch_size, seq_len, seq_len]
+            batch_size, seq_len = grid.shape[:2]
+            positions = torch.arange(seq_len, device=grid.device)
+            valid = positions[None] < input_lengths.to(grid.device)[:, None]
+            valid = valid.unsqueeze(2) & valid.unsqueeze(1)
+
+            # NNW：上三角中 (i, j) 表示 i 的下一个字为 j
+            nnw = (grid == 1) & valid & (positions[:, None] < positions[None])
+            nnw_batch_ids, nnw_rows, nnw_cols = extract_sparse_candidates(nnw)
+            # THW：下三角（含对角线）中 (j, i) 表示以 i 开头、以 j 结尾的实体
+            thw = (grid > 1) & valid & (positions[:, None] >= positions[None])
+            thw_batch_ids, tails, heads, thw_labels = extract_sparse_candidates(thw, values=grid)
+
+            forward = np.zeros((batch_size, seq_len, seq_len), dtype=bool)
+            forward[nnw_batch_ids, nnw_rows, nnw_cols] = True
+
+            decode_labels = [set() for _ in range(batch_size)]
+            if len(heads) == 0:
+                return decode_labels
+
+            # 按 (句子, 实体头) 分组
+            order = np.lexsort((tails, heads, thw_batch_ids))
+            thw_batch_ids, heads, tails, thw_labels = (x[order] for x in (thw_batch_ids, heads, tails, thw_labels))
+            bounds = np.flatnonzero(np.diff(thw_batch_ids * seq_len + heads)) + 1
+
+            reach, num_truncated = {}, 0
+            for group in np.split(np.arange(len(heads)), bounds):
+                b, head = int(thw_batch_ids[group[0]]), int(heads[group[0]])
+                if b not in reach:
+                    reach[b] = get_reachability(forward[b])
+
+                tail2label = dict(zip(tails[group].tolist(), thw_labels[group].tolist()))
+                text = texts[b]
+                paths = find_entity_paths(forward[b], reach[b], head, tails[group], max_paths=max_paths)
+                if max_paths is not None and len(paths) >= max_paths:
+                    num_truncated += 1
+                for path in paths:
+                    decode_labels[b].add((
+                        id2label[tail2label[path[-1]]],
+                        head,
+                        path[-1] + 1,
+                        ''.join([text[i] for i in path]),
                     ))
-                decode_labels.append(entities)
+
+            if num_truncated > 0:
+                logger.warning(
+                    f"The number of entity paths reaches `max_decode_paths` ({max_paths}) "
+                    f"for {num_truncated} entity heads, the remaining paths are skipped."
+                )
 
             return decode_labels
 
@@ -293,6 +351,7 @@ def get_w2ner_model_config(labels: list, **kwargs):
         "conv_hidden_size": 96,
         "biaffine_size": 512,
         "ffn_hidden_size": 288,
+        "max_decode_paths": None,  # 每个实体头最多搜索的路径数，None 表示不限制
     }
     model_config.update(kwargs)
     return model_config
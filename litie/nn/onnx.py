@@ -0,0 +1,162 @@
+import inspect
+import os
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+from ..utils.imports import ONNXRUNTIME_AVAILABLE
+from ..utils.logger import logger
+
+if ONNXRUNTIME_AVAILABLE:
+    import onnxruntime as ort
+
+
+ONNX_INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+DYNAMIC_AXES = {0: "batch_size", 1: "sequence_length"}
+
+
+class _BackboneForExport(nn.Module):
+    """ 导出编码器时使用的包装，输出 last_hidden_state、pooler_output（可选）以及各层 hidden_states（可选） """
+
+    def __init__(self, backbone, output_hidden_states=False):
+        super().__init__()
+        self.backbone = backbone
+        self.output_hidden_states = output_hidden_states
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        outputs = self.backbone(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            output_hidden_states=self.output_hidden_states,
+            return_dict=True,
+        )
+        results = [outputs.last_hidden_state]
+        if outputs.pooler_output is not None:
+            results.append(outputs.pooler_output)
+        if self.output_hidden_states:
+            results.extend(outputs.hidden_states)
+        return tuple(results)
+
+
+class _UIEForExport(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        outputs = self.model(input_ids, token_type_ids=token_type_ids, attention_mask=attention_mask)
+        return outputs[0], outputs[1]
+
+
+def _dummy_inputs(batch_size=2, seq_len=16):
+    input_ids = torch.ones((batch_size, seq_len), dtype=torch.long)
+    return input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids)
+
+
+def _export(module, output_path, output_names, opset_version=14):
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    dynamic_axes = {name: DYNAMIC_AXES for name in ONNX_INPUT_NAMES}
+    dynamic_axes.update({name: DYNAMIC_AXES if name != "pooler_output" else {0: "batch_size"} for name in output_names})
+
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False  # 使用基于 TorchScript 的导出，支持 dynamic_axes
+
+    module.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            _dummy_inputs(),
+            output_path,
+            input_names=ONNX_INPUT_NAMES,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+            **export_kwargs,
+        )
+    logger.info(f">>> [ONNX] Model exported to {output_path}")
+    return output_path
+
+
+def export_backbone_to_onnx(model, output_path: str, opset_version: int = 14) -> str:
+    """
+    导出任务模型的编码器（`base_model_prefix` 对应的模块）为 ONNX 格式，batch 与序列长度为动态维度
+
+    任务头与解码仍由原模型在 PyTorch 中完成，加载时使用 `OnnxBackbone` 替换编码器即可
+    """
+    backbone = getattr(model, model.base_model_prefix)
+    output_hidden_states = bool(
+        getattr(model.config, "output_hidden_states", False) or getattr(model.config, "use_last_4_layers", False)
+    )
+
+    with torch.no_grad():
+        outputs = _BackboneForExport(backbone, output_hidden_states).eval()(*_dummy_inputs())
+
+    output_names = ["last_hidden_state"]
+    if getattr(backbone, "pooler", None) is not None:
+        output_names.append("pooler_output")
+    output_names.extend(f"hidden_states.{i}" for i in range(len(outputs) - len(output_names)))
+
+    return _export(_BackboneForExport(backbone, output_hidden_states), output_path, output_names, opset_version)
+
+
+def export_uie_to_onnx(model, output_path: str, opset_version: int = 14) -> str:
+    """
+    导出 `UIEModel` 为 ONNX 格式，输出 start_prob 与 end_prob
+    """
+    return _export(_UIEForExport(model), output_path, ["start_prob", "end_prob"], opset_version)
+
+
+def create_onnx_session(onnx_path: str, device: str = "cpu"):
+    if not ONNXRUNTIME_AVAILABLE:
+        raise ImportError("`onnxruntime` is required for the onnx backend, please install it first.")
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if device in ["cuda", "gpu"] \
+        else ["CPUExecutionProvider"]
+    return ort.InferenceSession(onnx_path, sess_options, providers=providers)
+
+
+class OnnxBackbone(nn.Module):
+    """
+    使用 ONNX Runtime 运行导出的编码器，接口与 `transformers` 的编码器一致，可以直接替换任务模型中的编码器
+    """
+
+    def __init__(self, onnx_path: str, device: str = "cpu"):
+        super().__init__()
+        self.session = create_onnx_session(onnx_path, device=device)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    def forward(
+        self,
+        input_ids: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        token_type_ids: Optional[torch.Tensor] = None,
+        **kwargs,
+    ) -> BaseModelOutputWithPooling:
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        inputs = {k: v.cpu().numpy() for k, v in inputs.items() if k in self.input_names}
+        outputs = dict(zip(self.output_names, self.session.run(self.output_names, inputs)))
+        outputs = {k: torch.from_numpy(v).to(input_ids.device) for k, v in outputs.items()}
+
+        hidden_states: Optional[Tuple[torch.Tensor]] = None
+        if "hidden_states.0" in outputs:
+            hidden_states = tuple(v for k, v in outputs.items() if k.startswith("hidden_states."))
+
+        return BaseModelOutputWithPooling(
+            last_hidden_state=outputs["last_hidden_state"],
+            pooler_output=outputs.get("pooler_output"),
+            hidden_states=hidden_states,
+        )
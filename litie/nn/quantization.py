@@ -0,0 +1,33 @@
+import torch
+import torch.nn as nn
+from torch.ao.quantization import default_dynamic_qconfig, float_qparams_weight_only_qconfig, quantize_dynamic
+
+from ..utils.logger import logger
+
+QUANTIZE_TYPES = ["dynamic_int8", "dynamic_int8_embedding"]
+
+
+def quantize_model(model: nn.Module, quantize: str = "dynamic_int8") -> nn.Module:
+    """
+    CPU 推理的 INT8 动态量化，无需校准数据
+
+    Args:
+        model: 待量化的模型
+        quantize (str): 量化方式
+            + `dynamic_int8`: 编码器与任务头中的 `nn.Linear` 权重量化为 INT8，激活值在推理时动态量化
+            + `dynamic_int8_embedding`: 在 `dynamic_int8` 的基础上将词向量（`word_embeddings`）的权重按行量化为 INT8（仅权重量化）
+    Returns:
+        量化后的模型
+    """
+    assert quantize in QUANTIZE_TYPES, f"The quantize must be one of {QUANTIZE_TYPES}."
+
+    qconfig_spec = {nn.Linear: default_dynamic_qconfig}
+    if quantize == "dynamic_int8_embedding":
+        # 只量化词向量：未传入 token_type_ids 时 BERT 使用 expand() 得到的非连续张量查询 token_type_embeddings，
+        # 而量化后的 Embedding 要求输入连续；位置与类型向量很小，量化的收益也可以忽略
+        for name, module in model.named_modules():
+            if isinstance(module, nn.Embedding) and name.split(".")[-1] == "word_embeddings":
+                qconfig_spec[name] = float_qparams_weight_only_qconfig
+
+    logger.info(f">>> [Quantization] Apply {quantize} quantization ...")
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
@@ -4,7 +4,9 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates, match_nearest_end, offset_mapping_to_array
 from ..model_utils import RelationExtractionOutput, MODEL_MAP
+from ...datasets.utils import tensor_to_cpu
 from ...layers.layer_norm import LayerNorm
 
 
@@ -111,88 +113,89 @@ def get_auto_casrel_re_model(
                 attentions=outputs.attentions,
             )
 
-        def extract_subjects(self, subject_preds, attention_mask):
-            """批量数据抽取出每个句子中的所有主体"""
-            batch_subjects = []
-            for subject_pred, mask in zip(subject_preds, attention_mask):
-                length = mask.sum()
-                start_thresh = getattr(self.config, "start_thresh", 0.5)
-                end_thresh = getattr(self.config, "end_thresh", 0.5)
-
-                start = torch.where(subject_pred[:, 0] > start_thresh)[0]
-                end = torch.where(subject_pred[:, 1] > end_thresh)[0]
-
-                subjects = []
-                for s in start:
-                    if s == 0 or s > length - 2:  # 排除[CLS]、[SEP]、[PAD]
-                        continue
-                    e = end[end >= s]
-                    if len(e) > 0:
-                        e = e[0]  # 就近原则
-                        if e > length - 2:
-                            continue
-                        subjects.append((s, e))
-                batch_subjects.append(subjects)
-            return batch_subjects
+        def extract_subjects(self, subject_preds, seq_lens):
+            """批量数据抽取出每个句子中的所有主体，返回 (句子下标, 开始位置, 结束位置)"""
+            start_thresh = getattr(self.config, "start_thresh", 0.5)
+            end_thresh = getattr(self.config, "end_thresh", 0.5)
+
+            start_batch_ids, starts = extract_sparse_candidates(subject_preds[..., 0], start_thresh)
+            end_batch_ids, ends = extract_sparse_candidates(subject_preds[..., 1], end_thresh)
+
+            # 排除[CLS]、[SEP]、[PAD]
+            keep = (starts > 0) & (starts <= seq_lens[start_batch_ids] - 2)
+            start_batch_ids, starts = start_batch_ids[keep], starts[keep]
+
+            # 就近原则
+            start_idx, ends = match_nearest_end(start_batch_ids, starts, end_batch_ids, ends)
+            batch_ids, starts = start_batch_ids[start_idx], starts[start_idx]
+
+            keep = ends <= seq_lens[batch_ids] - 2
+            return batch_ids[keep], starts[keep], ends[keep]
 
         def decode(self, texts, sequence_output, attention_mask, offset_mapping):
             """
             解码出批量中每个句子中的三元组
             """
+            seq_lens = tensor_to_cpu(attention_mask.sum(1)).numpy()
             # [batch_size, seq_len, 2]
             subject_preds = torch.sigmoid(self.subject_tagger(sequence_output))
             subject_preds = subject_preds * attention_mask.unsqueeze(-1)  # 排除padding
-            batch_subjects = self.extract_subjects(subject_preds, attention_mask)
-
-            decode_labels = []
-            for i, subjects in enumerate(batch_subjects):
-                spoes = set()
-                if subjects:
-                    subjects = torch.tensor(subjects).to(attention_mask.device)
-                    # 根据一个句子中出现的所有主体重新构造输入
-                    masks = attention_mask[i].unsqueeze(0).expand(len(subjects), attention_mask.size(1))
-                    sequence_outputs = sequence_output[i].unsqueeze(0)
-                    sequence_outputs = sequence_outputs.expand(len(subjects), sequence_output.size(1),
-                                                               sequence_output.size(2))
-
-                    sub_start_output = self.gather(sequence_outputs, subjects[:, 0])
-                    sub_end_output = self.gather(sequence_outputs, subjects[:, 1])
-                    sub_output = torch.cat([sub_start_output, sub_end_output], 1)
-
-                    conditional_output = self.layer_norm((sequence_outputs, sub_output))
-                    object_preds = self.object_tagger(conditional_output)
-                    object_preds = object_preds.reshape(subjects.size(0), -1, self.config.num_predicates, 2)
-
-                    text, mapping = texts[i], offset_mapping[i]
-                    spoes = self.extract_spoes(subjects, object_preds, masks, text, mapping)
-                decode_labels.append(spoes)
+            subjects = self.extract_subjects(subject_preds, seq_lens)
+
+            decode_labels = [set() for _ in range(sequence_output.size(0))]
+            if len(subjects[0]) == 0:
+                return decode_labels
+
+            # 将整个批次中的所有主体展平，根据主体所在的句子重新构造输入
+            batch_ids, sub_starts, sub_ends = (torch.from_numpy(x).to(sequence_output.device) for x in subjects)
+            sequence_outputs = sequence_output[batch_ids]  # [num_subjects, seq_len, hidden_size]
+
+            sub_start_output = sequence_output[batch_ids, sub_starts]
+            sub_end_output = sequence_output[batch_ids, sub_ends]
+            sub_output = torch.cat([sub_start_output, sub_end_output], 1)
+
+            conditional_output = self.layer_norm((sequence_outputs, sub_output))
+            object_preds = self.object_tagger(conditional_output)
+            object_preds = object_preds.reshape(len(subjects[0]), -1, self.config.num_predicates, 2)
+
+            spoes = self.extract_spoes(subjects, object_preds, seq_lens)
+            mapping = offset_mapping_to_array(offset_mapping, attention_mask.size(1))
+
+            id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
+            for b, sh, st, oh, ot, p in zip(*(x.tolist() for x in spoes)):
+                text = texts[b]
+                spo = (
+                    id2predicate[p],
+                    text[mapping[b, sh, 0]: mapping[b, st, 1]],
+                    text[mapping[b, oh, 0]: mapping[b, ot, 1]],
+                )
+                decode_labels[b].add(spo)
             return decode_labels
 
-        def extract_spoes(self, subjects, object_preds, masks, text, mapping):
-            """ 单个句子抽取三元组
+        def extract_spoes(self, subjects, object_preds, seq_lens):
+            """ 批量抽取三元组，返回 (句子下标, 主体开始, 主体结束, 客体开始, 客体结束, 关系) 数组
             """
             start_thresh = getattr(self.config, "start_thresh", 0.5)
             end_thresh = getattr(self.config, "end_thresh", 0.5)
-            id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
-            spoes = set()
-            for subject, object_pred, mask in zip(subjects, object_preds, masks):
-                start = torch.where(object_pred[:, :, 0] > start_thresh)
-                end = torch.where(object_pred[:, :, 1] > end_thresh)
-                for _start, predicate1 in zip(*start):
-                    _start, predicate1 = _start.item(), predicate1.item()
-                    if _start == 0 or _start > mask.sum() - 2:
-                        continue
-                    for _end, predicate2 in zip(*end):
-                        _end, predicate2 = _end.item(), predicate2.item()
-                        if _start <= _end <= mask.sum() - 2 and predicate1 == predicate2:
-                            label = id2predicate[predicate1]
-                            s_h, s_t = mapping[subject[0].item()][0], mapping[subject[1].item()][1]
-                            o_h, o_t = mapping[_start][0], mapping[_end][1]
-                            spoes.add(
-                                (label, text[s_h: s_t], text[o_h: o_t])
-                            )
-                            break  # 就近原则
-            return spoes
+            batch_ids, sub_starts, sub_ends = subjects
+            num_predicates = self.config.num_predicates
+
+            # [num, 3]：(主体下标, 位置, 关系)
+            start_sub_ids, starts, start_ps = extract_sparse_candidates(object_preds[..., 0], start_thresh)
+            end_sub_ids, ends, end_ps = extract_sparse_candidates(object_preds[..., 1], end_thresh)
+
+            keep = (starts > 0) & (starts <= seq_lens[batch_ids[start_sub_ids]] - 2)
+            start_sub_ids, starts, start_ps = start_sub_ids[keep], starts[keep], start_ps[keep]
+
+            # 同一主体、同一关系下就近匹配
+            start_idx, ends = match_nearest_end(
+                start_sub_ids * num_predicates + start_ps, starts, end_sub_ids * num_predicates + end_ps, ends,
+            )
+            sub_ids, starts, ps = start_sub_ids[start_idx], starts[start_idx], start_ps[start_idx]
+
+            keep = ends <= seq_lens[batch_ids[sub_ids]] - 2
+            sub_ids, starts, ends, ps = sub_ids[keep], starts[keep], ends[keep], ps[keep]
+            return batch_ids[sub_ids], sub_starts[sub_ids], sub_ends[sub_ids], starts, ends, ps
 
         def compute_loss(self, inputs):
             """ 计算损失函数，总损失为主体损失与客体损失之和
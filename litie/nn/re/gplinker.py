@@ -1,4 +1,3 @@
-import itertools
 from typing import Optional, List, Any
 
 import numpy as np
@@ -6,8 +5,8 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates, join_indices, offset_mapping_to_array
 from ..model_utils import RelationExtractionOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_numpy
 from ...layers.global_pointer import EfficientGlobalPointer
 from ...losses import SparseMultilabelCategoricalCrossentropy
 
@@ -116,44 +115,37 @@ def get_auto_gplinker_re_model(
             )
 
         def decode(self, entity_logits, head_logits, tail_logits, masks, texts, offset_mapping):
-            all_spo_list = []
-            batch_size = entity_logits.shape[0]
-            masks = tensor_to_numpy(masks)
-
-            entity_logits = tensor_to_numpy(entity_logits)
-            head_logits = tensor_to_numpy(head_logits)
-            tail_logits = tensor_to_numpy(tail_logits)
             decode_thresh = getattr(self.config, "decode_thresh", 0.0)
-
             id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
-            for bs in range(batch_size):
-                # 抽取主体和客体
-                subjects, objects = set(), set()
-                _entity_logits = entity_logits[bs]
-                l = masks[bs].sum()
-                text, mapping = texts[bs], offset_mapping[bs]
-                for r, h, t in zip(*np.where(_entity_logits > decode_thresh)):
-                    if h >= (l - 1) or t >= (l - 1) or 0 in [h, t]:  # 排除[CLS]、[SEP]、[PAD]
-                        continue
-                    if r == 0:
-                        subjects.add((h, t))
-                    else:
-                        objects.add((h, t))
-
-                # 识别对应的关系类型
-                spoes = set()
-                _head_logits, _tail_logits = head_logits[bs], tail_logits[bs]
-                for (sh, st), (oh, ot) in itertools.product(subjects, objects):
-                    p1s = np.where(_head_logits[:, sh, oh] > decode_thresh)[0]
-                    p2s = np.where(_tail_logits[:, st, ot] > decode_thresh)[0]
-                    ps = set(p1s) & set(p2s)
-                    for p in ps:
-                        spoes.add((
-                            id2predicate[p],
-                            text[mapping[sh][0]: mapping[st][1]],
-                            text[mapping[oh][0]: mapping[ot][1]]
-                        ))
-                all_spo_list.append(spoes)
+
+            # 抽取整个批次的主体（r=0）和客体（r=1），排除[CLS]、[SEP]、[PAD]
+            batch_ids, r, h, t = extract_sparse_candidates(entity_logits, decode_thresh, attention_mask=masks)
+
+            # 同一句子中主体与客体的所有组合
+            is_subject = r == 0
+            i, j = join_indices(batch_ids[is_subject], batch_ids[~is_subject])
+            b, sh, st = batch_ids[is_subject][i], h[is_subject][i], t[is_subject][i]
+            oh, ot = h[~is_subject][j], t[~is_subject][j]
+
+            # 一次性取出所有组合在各关系下的首首、尾尾得分：[num_pairs, num_predicates]
+            index = torch.from_numpy(np.stack([b, sh, st, oh, ot])).to(head_logits.device)
+            pair_head_logits = head_logits[index[0], :, index[1], index[3]]
+            pair_tail_logits = tail_logits[index[0], :, index[2], index[4]]
+            pair_ids, predicate_ids = extract_sparse_candidates(
+                (pair_head_logits > decode_thresh) & (pair_tail_logits > decode_thresh)
+            )
+            b, sh, st, oh, ot = b[pair_ids], sh[pair_ids], st[pair_ids], oh[pair_ids], ot[pair_ids]
+
+            mapping = offset_mapping_to_array(offset_mapping, masks.shape[1])
+            subj_start, subj_end = mapping[b, sh, 0], mapping[b, st, 1]
+            obj_start, obj_end = mapping[b, oh, 0], mapping[b, ot, 1]
+
+            all_spo_list = [set() for _ in range(entity_logits.shape[0])]
+            for _b, p, _ss, _se, _os, _oe in zip(
+                b.tolist(), predicate_ids.tolist(), subj_start.tolist(), subj_end.tolist(),
+                obj_start.tolist(), obj_end.tolist(),
+            ):
+                all_spo_list[_b].add((id2predicate[p], texts[_b][_ss: _se], texts[_b][_os: _oe]))
             return all_spo_list
 
         def compute_loss(self, inputs):
@@ -1,11 +1,12 @@
 from typing import Optional, List, Any
 
+import numpy as np
 import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates, join_indices, offset_mapping_to_array
 from ..model_utils import RelationExtractionOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_cpu
 from ...layers.transformer import TransformerDecoderLayer
 
 
@@ -118,57 +119,60 @@ def get_auto_grte_re_model(
             )
 
         def decode(self, logits, masks, texts, offset_mapping):
-            logits = tensor_to_cpu(logits.argmax(-1))
-            seqlens = tensor_to_cpu(masks.sum(1))
+            label2id, num_predicates = self.config.grte_label2id, self.config.num_predicates
             id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
 
-            triples = []
-            for _logits, length, text, mapping in zip(logits, seqlens, texts, offset_mapping):
-                tmp = []
-                length = length.item()
-                for s, e, r in zip(*torch.where(_logits != self.config.grte_label2id["N/A"])):
-                    s, e, r = s.item(), e.item(), r.item()
-                    if length - 1 <= s or length - 1 <= e or 0 in [s, e]:
-                        continue
-                    tmp.append((s, e, r))
-
-                spoes = set()
-                for s, e, r in tmp:
-                    if _logits[s, e, r] == self.config.grte_label2id["SS"]:
-                        spoes.add((
-                            id2predicate[r],
-                            text[mapping[s][0]: mapping[s][1]],
-                            text[mapping[e][0]: mapping[e][1]]
-                        ))
-                    elif _logits[s, e, r] == self.config.grte_label2id["SMH"]:
-                        for s_, e_, r_ in tmp:
-                            if r == r_ and _logits[s_, e_, r_] == self.config.grte_label2id["SMT"] and s_ == s and e_ > e:
-                                spoes.add((
-                                    id2predicate[r],
-                                    text[mapping[s][0]: mapping[s][1]],
-                                    text[mapping[e][0]: mapping[e_][1]]
-                                ))
-                                break
-                    elif _logits[s, e, r] == self.config.grte_label2id["MMH"]:
-                        for s_, e_, r_ in tmp:
-                            if r == r_ and _logits[s_, e_, r_] == self.config.grte_label2id["MMT"] and s_ > s and e_ > e:
-                                spoes.add((
-                                    id2predicate[r],
-                                    text[mapping[s][0]: mapping[s_][1]],
-                                    text[mapping[e][0]: mapping[e_][1]]
-                                ))
-                                break
-                    elif _logits[s, e, r] == self.config.grte_label2id["MSH"]:
-                        for s_, e_, r_ in tmp:
-                            if r == r_ and _logits[s_, e_, r_] == self.config.grte_label2id["MST"] and s_ > s and e_ == e:
-                                spoes.add((
-                                    id2predicate[r],
-                                    text[mapping[s][0]: mapping[s_][1]],
-                                    text[mapping[e][0]: mapping[e][1]]
-                                ))
-                                break
-                triples.append(spoes)
-            return triples
+            tags = logits.argmax(-1)  # [batch_size, seq_len, seq_len, num_predicates]
+            # 排除[CLS]、[SEP]、[PAD]
+            batch_ids, s, e, r, tag_ids = extract_sparse_candidates(
+                tags != label2id["N/A"], attention_mask=masks, position_dims=(1, 2), values=tags
+            )
+
+            def spots_of(tag):
+                m = tag_ids == label2id[tag]
+                return batch_ids[m], r[m], s[m], e[m]
+
+            # (batch_id, 关系, 主体首, 主体尾, 客体首, 客体尾)
+            b, rel, hs, he = spots_of("SS")
+            triples = [(b, rel, hs, hs, he, he)]
+
+            for head_tag, tail_tag in [("SMH", "SMT"), ("MMH", "MMT"), ("MSH", "MST")]:
+                hb, hr, hs, he = spots_of(head_tag)
+                tb, tr, ts, te = spots_of(tail_tag)
+                i, j = join_indices(hb * num_predicates + hr, tb * num_predicates + tr)
+                if head_tag == "SMH":
+                    cond = (ts[j] == hs[i]) & (te[j] > he[i])
+                elif head_tag == "MMH":
+                    cond = (ts[j] > hs[i]) & (te[j] > he[i])
+                else:
+                    cond = (ts[j] > hs[i]) & (te[j] == he[i])
+                i, j = i[cond], j[cond]
+
+                # 与逐个扫描时一样，取按 (行, 列) 顺序第一个满足条件的尾部标记
+                order = np.lexsort((te[j], ts[j], i))
+                i, j = i[order], j[order]
+                first = np.ones(len(i), dtype=bool)
+                first[1:] = i[1:] != i[:-1]
+                i, j = i[first], j[first]
+
+                if head_tag == "SMH":
+                    triples.append((hb[i], hr[i], hs[i], hs[i], he[i], te[j]))
+                elif head_tag == "MMH":
+                    triples.append((hb[i], hr[i], hs[i], ts[j], he[i], te[j]))
+                else:
+                    triples.append((hb[i], hr[i], hs[i], ts[j], he[i], he[i]))
+
+            b, rel, sh, st, oh, ot = (np.concatenate(x) for x in zip(*triples))
+            mapping = offset_mapping_to_array(offset_mapping, masks.shape[1])
+            subj_start, subj_end = mapping[b, sh, 0], mapping[b, st, 1]
+            obj_start, obj_end = mapping[b, oh, 0], mapping[b, ot, 1]
+
+            all_spo_list = [set() for _ in range(logits.shape[0])]
+            for _b, _r, _ss, _se, _os, _oe in zip(
+                b.tolist(), rel.tolist(), subj_start.tolist(), subj_end.tolist(), obj_start.tolist(), obj_end.tolist()
+            ):
+                all_spo_list[_b].add((id2predicate[_r], texts[_b][_ss: _se], texts[_b][_os: _oe]))
+            return all_spo_list
 
     return GRTE
 
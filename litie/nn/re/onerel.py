@@ -5,8 +5,8 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates, join_indices, offset_mapping_to_array
 from ..model_utils import RelationExtractionOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_numpy
 
 
 def get_auto_onerel_re_model(
@@ -105,39 +105,43 @@ def get_auto_onerel_re_model(
             )
 
         def decode(self, logits, masks, texts, offset_mapping):
-            all_spo_list = []
-            batch_size = logits.shape[0]
-            masks = tensor_to_numpy(masks)
-            logits = tensor_to_numpy(torch.argmax(logits, dim=-1).permute(0, 3, 1, 2))
-
+            seq_len, num_predicates = masks.shape[1], self.config.num_predicates
             id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
-            for bs in range(batch_size):
-                _logits = logits[bs]
-                l = masks[bs].sum()
-                text, mapping = texts[bs], offset_mapping[bs]
-
-                hs, hts, ts = {}, {}, {}
-                for obj, tag in [(hs, 1), (hts, 2), (ts, 3)]:
-                    for p, h, t in zip(*np.where(_logits == filter)):
-                        if h >= (l - 1) or t >= (l - 1) or 0 in [h, t]:  # 排除[CLS]、[SEP]、[PAD]
-                            continue
-                        if p not in obj:
-                            obj[p] = []
-                        obj[p].append((h, t))
-
-                spoes = set()
-                for p in hs.keys() & ts.keys() & hts.keys():
-                    ht_list = hts[p]
-                    for sh, oh in hs[p]:
-                        for st, ot in ts[p]:
-                            if sh <= st and oh <= ot:
-                                if (sh, ot) in ht_list:
-                                    spoes.add((
-                                        id2predicate[p],
-                                        text[mapping[sh][0]: mapping[st][1]],
-                                        text[mapping[oh][0]: mapping[ot][1]]
-                                    ))
-                all_spo_list.append(spoes)
+
+            # [batch_size, num_predicates, seq_len, seq_len]，1: HB-TB，2: HB-TE，3: HE-TE
+            tags = torch.argmax(logits, dim=-1).permute(0, 3, 1, 2)
+            # 排除[CLS]、[SEP]、[PAD]
+            batch_ids, p, h, t, tag_ids = extract_sparse_candidates(tags > 0, attention_mask=masks, values=tags)
+
+            def spots_of(tag):
+                m = tag_ids == tag
+                return batch_ids[m], p[m], h[m], t[m]
+
+            hs_b, hs_p, sh, oh = spots_of(1)
+            hts_b, hts_p, hts_h, hts_t = spots_of(2)
+            ts_b, ts_p, st, ot = spots_of(3)
+
+            # 同一句子、同一关系下的首首与尾尾组合
+            i, j = join_indices(hs_b * num_predicates + hs_p, ts_b * num_predicates + ts_p)
+            b, rel, sh, oh, st, ot = hs_b[i], hs_p[i], sh[i], oh[i], st[j], ot[j]
+            keep = (sh <= st) & (oh <= ot)
+
+            # 主体首与客体尾之间同样需要存在链接
+            def key(_b, _p, _h, _t):
+                return ((_b * num_predicates + _p) * seq_len + _h) * seq_len + _t
+
+            keep &= np.isin(key(b, rel, sh, ot), key(hts_b, hts_p, hts_h, hts_t))
+            b, rel, sh, oh, st, ot = (x[keep] for x in (b, rel, sh, oh, st, ot))
+
+            mapping = offset_mapping_to_array(offset_mapping, seq_len)
+            subj_start, subj_end = mapping[b, sh, 0], mapping[b, st, 1]
+            obj_start, obj_end = mapping[b, oh, 0], mapping[b, ot, 1]
+
+            all_spo_list = [set() for _ in range(logits.shape[0])]
+            for _b, _p, _ss, _se, _os, _oe in zip(
+                b.tolist(), rel.tolist(), subj_start.tolist(), subj_end.tolist(), obj_start.tolist(), obj_end.tolist()
+            ):
+                all_spo_list[_b].add((id2predicate[_p], texts[_b][_ss: _se], texts[_b][_os: _oe]))
             return all_spo_list
 
         def compute_loss(self, inputs):
@@ -1,10 +1,11 @@
 from typing import Optional, List, Any
 
+import numpy as np
 import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
-from ..decode_utils import get_entities
+from ..decode_utils import extract_sparse_candidates, get_entity_arrays, join_indices, offset_mapping_to_array
 from ..model_utils import RelationExtractionOutput, MODEL_MAP
 from ...datasets.utils import tensor_to_numpy
 
@@ -226,51 +227,60 @@ def get_auto_prgc_re_model(
             rel_threshold = getattr(self.config, "rel_threshold", 0.1)
             corres_threshold = getattr(self.config, "corres_threshold", 0.5)
 
-            id2label = {int(v): k for k, v in self.config.prgc_label2id.items()}
-            id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
+            decode_labels = [set() for _ in range(bs)]
+            # 整个批次中所有的潜在关系：(句子下标, 关系)
+            batch_ids, rels = torch.nonzero(rel_pred > rel_threshold, as_tuple=True)
+            if len(batch_ids) == 0:
+                return decode_labels
+
+            # 每个潜在关系对应一行输入，一次性完成主体、客体的序列标注
+            seq_out = sequence_output[batch_ids]  # [num_rels, seq_len, hidden_size]
+            rel_emb = self.rel_embedding(rels).unsqueeze(1).expand(-1, seq_len, -1)
+            output_sub, output_obj = self.get_sub_obj(seq_out, rel_emb)
 
-            decode_labels = []
-            for i in range(bs):
-                spoes = set()
-                rels = torch.where(rel_pred[i] > rel_threshold)[0]
-                if len(rels) > 0:
-                    seq_out = sequence_output[i].unsqueeze(0).expand(len(rels), -1, -1)
-                    rel_emb = self.rel_embedding(rels)
-                    rel_emb = rel_emb.unsqueeze(1).expand(-1, seq_len, -1)
-                    output_sub, output_obj = self.get_sub_obj(seq_out, rel_emb)
-
-                    pred_seq_sub = torch.argmax(output_sub, dim=-1)
-                    pred_seq_obj = torch.argmax(output_obj, dim=-1)
-
-                    _corres_pred = torch.sigmoid(corres_pred[i]) * corres_mask[i]
-                    pre_corres = torch.where(_corres_pred > corres_threshold, torch.ones_like(_corres_pred),
-                                             torch.zeros_like(_corres_pred))
-
-                    rels = rels.detach().cpu().numpy()
-                    pred_seq_sub = tensor_to_numpy(pred_seq_sub)
-                    pred_seq_obj = tensor_to_numpy(pred_seq_obj)
-                    pre_corres = tensor_to_numpy(pre_corres)
-                    spoes = self.get_triples(rels, pred_seq_sub, pred_seq_obj, pre_corres,
-                                             texts[i], offset_mapping[i], id2label, id2predicate)
-                decode_labels.append(spoes)
+            pred_seq_sub = torch.argmax(output_sub, dim=-1)
+            pred_seq_obj = torch.argmax(output_obj, dim=-1)
+            # 只取出超过阈值的主体-客体首首对齐位置
+            pre_corres = extract_sparse_candidates(torch.sigmoid(corres_pred) * corres_mask, corres_threshold)
 
+            batch_ids, rels = tensor_to_numpy(batch_ids), tensor_to_numpy(rels)
+            triples = self.get_triples(batch_ids, rels, pred_seq_sub, pred_seq_obj, pre_corres)
+
+            mapping = offset_mapping_to_array(offset_mapping, seq_len)
+            id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
+            for b, p, sh, st, oh, ot in zip(*(x.tolist() for x in triples)):
+                text = texts[b]
+                decode_labels[b].add(
+                    (
+                        id2predicate[p],
+                        text[mapping[b, sh, 0]: mapping[b, st, 1]],
+                        text[mapping[b, oh, 0]: mapping[b, ot, 1]],
+                    )
+                )
             return decode_labels
 
-        def get_triples(self, rels, pred_seq_sub, pred_seq_obj, pre_corres, text, mapping, id2label, id2predicate):
-            triples = set()
-            for i in range(len(rels)):
-                seq_sub_tags = [id2label[t] for t in pred_seq_sub[i]]
-                seq_obj_tags = [id2label[t] for t in pred_seq_obj[i]]
-                subjects, objects = get_entities(seq_sub_tags), get_entities(seq_obj_tags)
-                for h in subjects:
-                    for t in objects:
-                        if pre_corres[h[1]][t[1]] == 1:
-                            triples.add((
-                                id2predicate[rels[i]],
-                                text[mapping[h[1]][0]: mapping[h[2]][1]],
-                                text[mapping[t[1]][0]: mapping[t[2]][1]]
-                            ))
-            return triples
+        def get_triples(self, batch_ids, rels, pred_seq_sub, pred_seq_obj, pre_corres):
+            """ 批量组合每个潜在关系下的主体与客体，并通过首首对齐位置 pre_corres（句子下标, 主体开始, 客体开始）过滤
+            返回 (句子下标, 关系, 主体开始, 主体结束, 客体开始, 客体结束) 数组
+            """
+            id2label = {int(v): k for k, v in self.config.prgc_label2id.items()}
+            seq_len = pred_seq_sub.shape[1]
+            lengths = np.full(len(rels), seq_len)
+            sub_rows, _, sub_starts, sub_ends = get_entity_arrays(pred_seq_sub, lengths, id2label)
+            obj_rows, _, obj_starts, obj_ends = get_entity_arrays(pred_seq_obj, lengths, id2label)
+
+            # 同一潜在关系下主体与客体的笛卡尔积
+            sub_idx, obj_idx = join_indices(sub_rows, obj_rows)
+            rows = sub_rows[sub_idx]
+            sub_starts, sub_ends = sub_starts[sub_idx], sub_ends[sub_idx]
+            obj_starts, obj_ends = obj_starts[obj_idx], obj_ends[obj_idx]
+
+            def corres_key(_b, _sub, _obj):
+                return (_b * seq_len + _sub) * seq_len + _obj
+
+            keep = np.isin(corres_key(batch_ids[rows], sub_starts, obj_starts), corres_key(*pre_corres))
+            rows = rows[keep]
+            return batch_ids[rows], rels[rows], sub_starts[keep], sub_ends[keep], obj_starts[keep], obj_ends[keep]
 
         def compute_loss(self, inputs, targets):
             output_sub, output_obj, corres_pred, rel_pred, mask = inputs
@@ -4,86 +4,47 @@ import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import offset_mapping_to_array
 from ..model_utils import RelationExtractionOutput, MODEL_MAP
-from ...datasets.utils import tensor_to_list
+from ...datasets.utils import tensor_to_cpu
 from ...layers.set_decoder import SetDecoder
 from ...losses import SetCriterion
 
 
-def _get_best_indexes(logits, n_best_size):
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+def _get_best_indexes(probs, n_best_size):
+    """ 批量取出概率最大的`n_best_size`个位置，概率相同时位置靠前者优先 """
+    return probs.sort(dim=-1, descending=True, stable=True)[1][..., :n_best_size]
 
 
 def generate_span(start_logits, end_logits, masks, config):
-    seq_lens = tensor_to_list(masks.sum(1))  # including [CLS] and [SEP]
-    outputs = []
-
-    start_probs = tensor_to_list(start_logits.softmax(-1))  # [b, n, l]
-    end_probs = tensor_to_list(end_logits.softmax(-1))
-    for (start_prob, end_prob, seq_len) in zip(start_probs, end_probs, seq_lens):
-        output = {}
-        for triple_id in range(config.num_generated_triples):
-            predictions = []
-            start_indexes = _get_best_indexes(start_prob[triple_id], config.n_best_size)
-            end_indexes = _get_best_indexes(end_prob[triple_id], config.n_best_size)
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the sentence. We throw out all
-                    # invalid predictions.
-                    if start_index >= (seq_len - 1):  # [SEP]
-                        continue
-                    if end_index >= (seq_len - 1):
-                        continue
-                    if start_index == 0 or end_index == 0:
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > config.max_span_length:
-                        continue
-                    predictions.append((start_index, end_index))
-            output[triple_id] = predictions
-        outputs.append(output)
-    return outputs
-
-
-def generate_relation(pred_rel_logits, config):
-    _, pred_rels = torch.max(pred_rel_logits.softmax(-1), dim=2)
-    pred_rels = tensor_to_list(pred_rels)
-    outputs = []
-    for pred_rel in pred_rels:
-        output = {triple_id: pred_rel[triple_id] for triple_id in range(config.num_generated_triples)}
-
-        outputs.append(output)
-    return outputs
-
-
-def generate_strategy(pred_rel, pred_head, pred_tail, text, mapping, num_predicates, id2predicate):
-    if pred_rel != num_predicates and pred_head and pred_tail:
-        for ele in pred_head:
-            if ele[0] != 0:
-                break
-        # noinspection PyUnboundLocalVariable
-        head = ele
-        for ele in pred_tail:
-            if ele[0] != 0:
-                break
-        tail = ele
-        return (
-            id2predicate[pred_rel],
-            text[mapping[head[0]][0]: mapping[head[1]][1]],
-            text[mapping[tail[0]][0]: mapping[tail[1]][1]]
-        )
-    else:
-        return
+    """
+    批量解码每个生成三元组对应的实体跨度
+    在概率最大的若干个开始位置和结束位置的组合中，按（开始位置排名，结束位置排名）的顺序选取第一个合法跨度
+
+    Returns:
+        (has_span, starts, ends)，形状均为 [b, n]
+    """
+    seq_lens = masks.sum(1)[:, None, None, None]  # including [CLS] and [SEP]
+    start_indexes = _get_best_indexes(start_logits.softmax(-1), config.n_best_size)  # [b, n, k]
+    end_indexes = _get_best_indexes(end_logits.softmax(-1), config.n_best_size)
+
+    # [b, n, k, k]，排除 [CLS]、[SEP]、padding，以及结束位置在开始位置之前或过长的跨度
+    _starts, _ends = start_indexes.unsqueeze(-1), end_indexes.unsqueeze(-2)
+    valid = (_starts > 0) & (_starts < seq_lens - 1) & (_ends > 0) & (_ends < seq_lens - 1)
+    valid &= (_ends >= _starts) & (_ends - _starts < config.max_span_length)
+    valid = valid.flatten(-2)
+
+    # argmax 返回第一个最大值的下标，即排名最靠前的合法跨度
+    best = valid.int().argmax(-1, keepdim=True)
+    k = end_indexes.size(-1)
+    starts = start_indexes.gather(-1, torch.div(best, k, rounding_mode="floor")).squeeze(-1)
+    ends = end_indexes.gather(-1, best % k).squeeze(-1)
+    return valid.any(-1), starts, ends
+
+
+def generate_relation(pred_rel_logits):
+    """ 每个生成三元组对应的关系类型，[b, n] """
+    return torch.max(pred_rel_logits.softmax(-1), dim=2)[1]
 
 
 def get_auto_spn_re_model(
@@ -199,23 +160,34 @@ def get_auto_spn_re_model(
                     "tail_entity": config.tail_ent_loss_weight}
 
         def decode(self, preds, masks, texts, offset_mapping):
-            pred_head_ent_dict = generate_span(preds["head_start_logits"], preds["head_end_logits"], masks, self.config)
-            pred_tail_ent_dict = generate_span(preds["tail_start_logits"], preds["tail_end_logits"], masks, self.config)
-            pred_rel_dict = generate_relation(preds['pred_rel_logits'], self.config)
+            head_valid, head_starts, head_ends = generate_span(
+                preds["head_start_logits"], preds["head_end_logits"], masks, self.config
+            )
+            tail_valid, tail_starts, tail_ends = generate_span(
+                preds["tail_start_logits"], preds["tail_end_logits"], masks, self.config
+            )
+            pred_rels = generate_relation(preds['pred_rel_logits'])
+
+            # 排除预测为空关系或没有合法实体跨度的三元组
+            keep = (pred_rels != self.config.num_predicates) & head_valid & tail_valid
+            batch_ids = torch.nonzero(keep)[:, 0]
+            spots = torch.stack(
+                [batch_ids, pred_rels[keep], head_starts[keep], head_ends[keep], tail_starts[keep], tail_ends[keep]]
+            )
+
+            mapping = offset_mapping_to_array(offset_mapping, masks.size(1))
             id2predicate = {int(v): k for k, v in self.config.predicate2id.items()}
 
-            triples = []
-            for i in range(len(pred_rel_dict)):
-                spoes = set()
-                text, mapping = texts[i], offset_mapping[i]
-                for triple_id in range(self.config.num_generated_triples):
-                    pred_rel = pred_rel_dict[i][triple_id]
-                    pred_head = pred_head_ent_dict[i][triple_id]
-                    pred_tail = pred_tail_ent_dict[i][triple_id]
-                    triple = generate_strategy(pred_rel, pred_head, pred_tail, text, mapping, self.config.num_predicates, id2predicate)
-                    if triple:
-                        spoes.add(triple)
-                triples.append(spoes)
+            triples = [set() for _ in range(masks.size(0))]
+            for b, p, sh, st, oh, ot in zip(*tensor_to_cpu(spots).tolist()):
+                text = texts[b]
+                triples[b].add(
+                    (
+                        id2predicate[p],
+                        text[mapping[b, sh, 0]: mapping[b, st, 1]],
+                        text[mapping[b, oh, 0]: mapping[b, ot, 1]],
+                    )
+                )
             return triples
 
     return SPN
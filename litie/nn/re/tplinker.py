@@ -1,15 +1,42 @@
 import itertools
-from typing import Optional, List, Any
+from functools import lru_cache
+from typing import Optional, List, Any, Tuple
 
+import numpy as np
 import torch
 import torch.nn as nn
 from transformers import PreTrainedModel
 
+from ..decode_utils import extract_sparse_candidates, get_shaking_index, join_indices, offset_mapping_to_array
 from ..model_utils import RelationExtractionOutput, MODEL_MAP
 from ...datasets.utils import tensor_to_cpu
 from ...layers.global_pointer import HandshakingKernel
 from ...losses import MultilabelCategoricalCrossentropy
 
+LINK_TYPES = [
+    "SH2OH",  # subject head to object head
+    "OH2SH",  # object head to subject head
+    "ST2OT",  # subject tail to object tail
+    "OT2ST",  # object tail to subject tail
+    "EH2ET",  # entity head to entity tail
+]
+
+
+@lru_cache(maxsize=8)
+def get_tag_arrays(label2id: Tuple[Tuple[str, int], ...]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    将 `rel=link_type` 形式的标签预先转换为整数数组：标签 id -> 关系 id、标签 id -> `LINK_TYPES` 中的链接类型 id
+    """
+    predicates = sorted({tag.split("=")[0] for tag, _ in label2id if not tag.endswith("=EH2ET")})
+    tag2predicate = np.full(len(label2id), -1, dtype=np.int64)
+    tag2link = np.full(len(label2id), -1, dtype=np.int64)
+    for tag, idx in label2id:
+        rel, link_type = tag.split("=")
+        tag2link[idx] = LINK_TYPES.index(link_type)
+        if link_type != "EH2ET":
+            tag2predicate[idx] = predicates.index(rel)
+    return predicates, tag2predicate, tag2link
+
 
 def get_auto_tplinker_re_model(
     model_type: Optional[str] = "bert",
@@ -87,112 +114,68 @@ def get_auto_tplinker_re_model(
             )
 
         def decode(self, shaking_logits, attention_mask, texts, offset_mapping):
-            all_spo_list = []
             seq_len = attention_mask.shape[1]
-            seqlens, shaking_logits = tensor_to_cpu(attention_mask.sum(1)), tensor_to_cpu(shaking_logits)
-            shaking_idx2matrix_idx = [(s, e) for s in range(seq_len) for e in list(range(seq_len))[s:]]
-
-            id2label = {int(v): k for k, v in self.config.tplinker_label2id.items()}
-            for _shaking_logits, l, text, mapping in zip(shaking_logits, seqlens, texts, offset_mapping):
-                head_ind2entities = {}
-                spoes = set()
-                l = l.item()
-
-                matrix_spots = self.get_spots_fr_shaking_tag(shaking_idx2matrix_idx, _shaking_logits)
-                for sp in matrix_spots:
-                    tag = id2label[sp[2]]
-                    ent_type, link_type = tag.split("=")
-                    # for an entity, the start position can not be larger than the end pos.
-                    if link_type != "EH2ET" or sp[0] > sp[1] or 0 in [sp[0], sp[1]] or sp[0] >= l - 1 or sp[1] >= l - 1:
-                        continue
-
-                    entity = {
-                        "type": ent_type,
-                        "tok_span": [sp[0], sp[1]],
-                    }
-                    # take ent_head_pos as the key to entity list
-                    head_key = sp[0]
-                    if head_key not in head_ind2entities:
-                        head_ind2entities[head_key] = []
-                    head_ind2entities[head_key].append(entity)
-
-                # tail link
-                tail_link_memory_set = set()
-                for sp in matrix_spots:
-                    tag = id2label[sp[2]]
-                    rel, link_type = tag.split("=")
-
-                    if link_type == "ST2OT":
-                        tail_link_memory = (rel, sp[0], sp[1])
-                        tail_link_memory_set.add(tail_link_memory)
-                    elif link_type == "OT2ST":
-                        tail_link_memory = (rel, sp[1], sp[0])
-                        tail_link_memory_set.add(tail_link_memory)
-
-                # head link
-                for sp in matrix_spots:
-                    tag = id2label[sp[2]]
-                    rel, link_type = tag.split("=")
-
-                    if link_type == "SH2OH":
-                        subj_head_key, obj_head_key = sp[0], sp[1]
-                    elif link_type == "OH2SH":
-                        subj_head_key, obj_head_key = sp[1], sp[0]
-                    else:
-                        continue
-
-                    if (
-                        subj_head_key not in head_ind2entities
-                        or obj_head_key not in head_ind2entities
-                    ):
-                        # no entity start with subj_head_key and obj_head_key
-                        continue
-
-                    # all entities start with this subject head
-                    subj_list = head_ind2entities[subj_head_key]
-                    # all entities start with this object head
-                    obj_list = head_ind2entities[obj_head_key]
-
-                    for subj, obj in itertools.product(subj_list, obj_list):
-                        tail_link_memory = (rel, subj["tok_span"][1], obj["tok_span"][1])
-
-                        if tail_link_memory not in tail_link_memory_set:
-                            # no such relation
-                            continue
-                        spoes.add(
-                            (
-                                rel,
-                                text[
-                                mapping[subj["tok_span"][0]][0]: mapping[
-                                    subj["tok_span"][1]
-                                ][1]
-                                ],
-                                text[
-                                mapping[obj["tok_span"][0]][0]: mapping[
-                                    obj["tok_span"][1]
-                                ][1]
-                                ],
-                            )
-                        )
-                all_spo_list.append(set(spoes))
+            predicates, tag2predicate, tag2link = get_tag_arrays(tuple(self.config.tplinker_label2id.items()))
+
+            batch_ids, pos1, pos2, tag_ids = self.get_spots_fr_shaking_tag(shaking_logits, seq_len)
+            seq_lens = tensor_to_cpu(attention_mask.sum(1)).numpy()
+            rels, links = tag2predicate[tag_ids], tag2link[tag_ids]
+
+            # 实体首尾链接，上三角展开保证 start <= end，过滤 [CLS]、[SEP] 与 padding
+            is_ent = (links == LINK_TYPES.index("EH2ET")) & (pos1 > 0) & (pos2 < seq_lens[batch_ids] - 1)
+            ent_b, ent_head, ent_tail = batch_ids[is_ent], pos1[is_ent], pos2[is_ent]
+
+            def links_of(forward_link, backward_link):
+                """ 统一为 (batch_id, rel, 主体位置, 客体位置) """
+                fw, bw = links == LINK_TYPES.index(forward_link), links == LINK_TYPES.index(backward_link)
+                return (
+                    np.concatenate([batch_ids[fw], batch_ids[bw]]),
+                    np.concatenate([rels[fw], rels[bw]]),
+                    np.concatenate([pos1[fw], pos2[bw]]),
+                    np.concatenate([pos2[fw], pos1[bw]]),
+                )
+
+            head_b, head_rel, subj_head, obj_head = links_of("SH2OH", "OH2SH")
+            tail_b, tail_rel, subj_tail, obj_tail = links_of("ST2OT", "OT2ST")
+
+            # 首首链接分别与以主体首、客体首开头的实体连接
+            ent_keys = ent_b * seq_len + ent_head
+            i, j = join_indices(head_b * seq_len + subj_head, ent_keys)
+            b, rel, subj_head, obj_head, subj_end = head_b[i], head_rel[i], subj_head[i], obj_head[i], ent_tail[j]
+            i, j = join_indices(b * seq_len + obj_head, ent_keys)
+            b, rel, subj_head, obj_head, subj_end = b[i], rel[i], subj_head[i], obj_head[i], subj_end[i]
+            obj_end = ent_tail[j]
+
+            # 保留尾尾链接同样存在的三元组
+            def tail_key(_b, _rel, _subj, _obj):
+                return ((_b * len(predicates) + _rel) * seq_len + _subj) * seq_len + _obj
+
+            keep = np.isin(tail_key(b, rel, subj_end, obj_end), tail_key(tail_b, tail_rel, subj_tail, obj_tail))
+            b, rel, subj_head, obj_head, subj_end, obj_end = (
+                x[keep] for x in (b, rel, subj_head, obj_head, subj_end, obj_end)
+            )
+
+            mapping = offset_mapping_to_array(offset_mapping, seq_len)
+            subj_start, subj_end = mapping[b, subj_head, 0], mapping[b, subj_end, 1]
+            obj_start, obj_end = mapping[b, obj_head, 0], mapping[b, obj_end, 1]
+
+            all_spo_list = [set() for _ in range(shaking_logits.shape[0])]
+            for _b, _rel, _ss, _se, _os, _oe in zip(
+                b.tolist(), rel.tolist(), subj_start.tolist(), subj_end.tolist(), obj_start.tolist(), obj_end.tolist()
+            ):
+                all_spo_list[_b].add((predicates[_rel], texts[_b][_ss: _se], texts[_b][_os: _oe]))
             return all_spo_list
 
-        def get_spots_fr_shaking_tag(self, shaking_idx2matrix_idx, shaking_outputs):
+        def get_spots_fr_shaking_tag(self, shaking_logits, seq_len):
             """
-            shaking_tag -> spots
-            shaking_tag: (shaking_seq_len, tag_id)
-            spots: [(start, end, tag), ]
+            shaking_logits -> spots
+            shaking_logits: (batch_size, shaking_seq_len, tag_size)
+            spots: (batch_ids, pos1, pos2, tag_ids)，只将超过阈值的稀疏位置拷贝到 CPU
             """
-            spots = []
             decode_thresh = getattr(self.config, "decode_thresh", 0.0)
-            pred_shaking_tag = (shaking_outputs > decode_thresh).long()
-            nonzero_points = torch.nonzero(pred_shaking_tag, as_tuple=False)
-            for point in nonzero_points:
-                shaking_idx, tag_idx = point[0].item(), point[1].item()
-                pos1, pos2 = shaking_idx2matrix_idx[shaking_idx]
-                spot = (pos1, pos2, tag_idx)
-                spots.append(spot)
-            return spots
+            batch_ids, shaking_ids, tag_ids = extract_sparse_candidates(shaking_logits, decode_thresh)
+            rows, cols = (x.numpy() for x in get_shaking_index(seq_len))
+            return batch_ids, rows[shaking_ids], cols[shaking_ids], tag_ids
 
         def compute_loss(self, inputs):
             shaking_logits, labels = inputs[:2]
@@ -203,13 +186,7 @@ def get_auto_tplinker_re_model(
 
 
 def get_tplinker_re_model_config(predicates, **kwargs):
-    link_types = [
-        "SH2OH",  # subject head to object head
-        "OH2SH",  # object head to subject head
-        "ST2OT",  # subject tail to object tail
-        "OT2ST",  # object tail to subject tail
-    ]
-    tags = ["=".join([rel, lk]) for lk, rel in itertools.product(link_types, predicates)]
+    tags = ["=".join([rel, lk]) for lk, rel in itertools.product(LINK_TYPES[:4], predicates)]
     tags.append("DEFAULT=EH2ET")
 
     label2id = {t: idx for idx, t in enumerate(tags)}
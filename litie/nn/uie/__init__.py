@@ -1,2 +1,3 @@
 from .convert import convert_uie_checkpoint
 from .model import UIEModel
+from .siamese_uie import get_auto_siamese_uie_model, get_siamese_uie_model_config
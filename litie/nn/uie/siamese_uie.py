@@ -55,41 +55,37 @@ def get_auto_siamese_uie_model(
         def set_crossattention_layer(self, num_hidden_layers=6):
             crossattention_config = deepcopy(self.config)
             crossattention_config.num_hidden_layers = num_hidden_layers
-            self.config.num_hidden_layers -= num_hidden_layers
+            # 不修改 config.num_hidden_layers，保证 save_pretrained 后可以重新加载
+            num_text_layers = self.config.num_hidden_layers - num_hidden_layers
             self.crossattention = BertEncoder(crossattention_config)
-            self.crossattention.layer = self.backbone.encoder.layer[self.config.num_hidden_layers:]
-            self.backbone.encoder.layer = self.backbone.encoder.layer[:self.config.num_hidden_layers]
+            self.crossattention.layer = self.backbone.encoder.layer[num_text_layers:]
+            self.backbone.encoder.layer = self.backbone.encoder.layer[:num_text_layers]
 
-        def forward(
-            self,
-            input_ids: Optional[torch.Tensor] = None,
-            attention_mask: Optional[torch.Tensor] = None,
-            token_type_ids: Optional[torch.Tensor] = None,
-            prompt_input_ids: Optional[torch.Tensor] = None,
-            cross_attention_mask: Optional[torch.Tensor] = None,
-            start_positions: Optional[torch.Tensor] = None,
-            end_positions: Optional[torch.Tensor] = None,
-        ) -> UIEModelOutput:
-
-            # text states
-            outputs = getattr(self, self.base_model_prefix)(
+        def get_text_sequence_output(self, input_ids, attention_mask=None, token_type_ids=None):
+            """ 双流部分：编码文本 """
+            outputs = self.backbone(
                 input_ids,
                 attention_mask=attention_mask,
                 token_type_ids=token_type_ids,
             )
-
-            sequence_output = self.dropout(outputs[0])
-
-            # prompt states
-            position_ids = torch.arange(prompt_input_ids.size(1)).expand(1, -1) + input_ids.size(1).to(input_ids.device)
-            prompt_sequence_output = getattr(self, self.base_model_prefix)(
+            return self.dropout(outputs[0]), outputs
+
+        def get_prompt_sequence_output(self, prompt_input_ids, cross_attention_mask, position_offset):
+            """ 双流部分：编码提示，位置编码接在长度为`position_offset`（整数或 [batch_size]）的文本之后 """
+            position_ids = torch.arange(prompt_input_ids.size(1), device=prompt_input_ids.device).expand(1, -1)
+            if isinstance(position_offset, torch.Tensor):
+                position_offset = position_offset.to(prompt_input_ids.device).unsqueeze(-1)
+            position_ids = position_ids + position_offset
+            return self.backbone(
                 prompt_input_ids,
                 attention_mask=cross_attention_mask,
                 token_type_ids=torch.ones_like(cross_attention_mask),
                 position_ids=position_ids,
-            )
+            )[0]
 
-            # fusion states
+        def get_fusion_output(self, sequence_output, attention_mask, prompt_sequence_output, cross_attention_mask):
+            """ 单流部分：文本与提示拼接后经过`crossattention`层，返回文本部分的首尾 logits """
+            text_length = sequence_output.size(1)
             sequence_output = torch.cat([sequence_output, prompt_sequence_output], dim=1)
             cat_attention_mask = torch.cat([attention_mask, cross_attention_mask], dim=1)
             cat_attention_mask = self.backbone.get_extended_attention_mask(
@@ -98,10 +94,37 @@ def get_auto_siamese_uie_model(
             )
             sequence_output = self.crossattention(
                 hidden_states=sequence_output, attention_mask=cat_attention_mask
-            )[0][:, :input_ids.size()[1], :]
+            )[0][:, :text_length, :]
 
             start_logits = self.head(sequence_output).squeeze(-1)
             end_logits = self.tail(sequence_output).squeeze(-1)
+            return start_logits, end_logits
+
+        def forward(
+            self,
+            input_ids: Optional[torch.Tensor] = None,
+            attention_mask: Optional[torch.Tensor] = None,
+            token_type_ids: Optional[torch.Tensor] = None,
+            prompt_input_ids: Optional[torch.Tensor] = None,
+            cross_attention_mask: Optional[torch.Tensor] = None,
+            start_positions: Optional[torch.Tensor] = None,
+            end_positions: Optional[torch.Tensor] = None,
+        ) -> UIEModelOutput:
+
+            # text states
+            sequence_output, outputs = self.get_text_sequence_output(
+                input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids,
+            )
+
+            # prompt states
+            prompt_sequence_output = self.get_prompt_sequence_output(
+                prompt_input_ids, cross_attention_mask, input_ids.size(1)
+            )
+
+            # fusion states
+            start_logits, end_logits = self.get_fusion_output(
+                sequence_output, attention_mask, prompt_sequence_output, cross_attention_mask
+            )
 
             start_prob = self.sigmoid(start_logits)
             end_prob = self.sigmoid(end_logits)
@@ -1,5 +1,8 @@
+from .async_pipeline import AsyncPipeline
 from .ee import EventExtractionPipeline
 from .ner import NerPipeline
 from .re import RelationExtractionPipeline
 from .tc import TextClassificationPipeline
+from .siamese_uie import SiameseUIEPipeline
 from .uie import UIEPipeline
+from .utils import stream_jsonl
@@ -0,0 +1,114 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Union
+
+from ..utils.logger import logger
+
+
+class AsyncPipeline(object):
+    """
+    异步微批处理封装：将并发的 `await pipe(text)` 请求合并为一个批次，在独立线程中调用原有的同步 pipeline
+
+    Args:
+        pipeline: 同步 pipeline，例如 `NerPipeline`、`RelationExtractionPipeline`、`UIEPipeline`，
+            需要支持 `pipeline(List[str]) -> List[Any]`
+        max_batch_size (int): 每个批次合并的最大请求数
+        max_wait_ms (float): 收到第一个请求后等待更多请求的最长时间（毫秒）
+
+    Example:
+        >>> pipe = AsyncPipeline(NerPipeline(...), max_batch_size=32, max_wait_ms=5)
+        >>> result = await pipe("结果上周六他们主场0：3惨败给了中游球队瓦拉多利德。")
+    """
+
+    def __init__(self, pipeline, max_batch_size: int = 32, max_wait_ms: float = 5.0) -> None:
+        assert max_batch_size > 0, "The `max_batch_size` must be positive."
+
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        # pipeline 内部保存了 input_mapping 等状态，因此只使用一个线程串行执行
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._worker = None
+
+    async def __call__(self, inputs: Union[str, List[str]]) -> Union[Any, List[Any]]:
+        if isinstance(inputs, str):
+            return await self._submit(inputs)
+        return list(await asyncio.gather(*[self._submit(text) for text in inputs]))
+
+    async def _submit(self, text: str) -> Any:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._batch_loop())
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _batch_loop(self):
+        while True:
+            batch = await self._collect_batch()
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch):
+        # 跳过已被调用方取消的请求
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            return
+
+        texts = [text for text, _ in batch]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self._executor, self.pipeline, texts)
+            if len(results) != len(texts):
+                raise RuntimeError(f"The pipeline returned {len(results)} results for {len(texts)} inputs.")
+        except Exception as e:
+            if len(batch) > 1:
+                # 逐条重新推理，只让出错的请求失败，不影响合并到同一批次的其他请求
+                logger.warning(f">>> [AsyncPipeline] Batch of {len(texts)} failed: {e}, retrying one by one ...")
+                for item in batch:
+                    await self._run_batch([item])
+                return
+
+            _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -1,11 +1,61 @@
+import os
+import queue
+import threading
+from collections import deque
 from collections.abc import Mapping
-from typing import Union, Any, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Any, Dict, List, Optional, Iterable, Iterator, Tuple
 
 import torch
 from transformers.modeling_utils import PreTrainedModel
 from transformers.tokenization_utils_base import PreTrainedTokenizerBase
 
-from ..utils.logger import logger
+from ..utils.logger import logger, tqdm
+
+
+def length_bucketed_batches(
+    lengths: List[int],
+    batch_size: int = 64,
+    max_tokens: Optional[int] = None,
+) -> List[List[int]]:
+    """
+    按照 token 长度从长到短排序后划分批次，长度相近的样本放在同一批次中以减少 padding
+    Args:
+        lengths (List[int]): 每个样本编码后的长度
+        batch_size (int): 每个批次的最大样本数
+        max_tokens (int): 每个批次 padding 后的最大 token 数（样本数 * 批次内最大长度），为 None 时仅按 batch_size 划分
+    Returns:
+        List[List[int]]: 每个批次包含的样本在原始输入中的下标
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches, batch = [], []
+    for idx in order:
+        # 样本按长度降序排列，批次内的最大长度即为第一个样本的长度
+        batch_len = lengths[batch[0]] if batch else lengths[idx]
+        if batch and (
+            len(batch) >= batch_size or (max_tokens is not None and batch_len * (len(batch) + 1) > max_tokens)
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+class StreamMixin(object):
+    """
+    为 pipeline 提供流式推理接口，按块消费输入并按顺序产出结果，内存占用只与 `chunk_size` 有关
+    """
+
+    def stream(self, inputs: Iterable[str], chunk_size: int = 1024) -> Iterator[Any]:
+        from .utils import batch_iterator
+
+        for chunk in batch_iterator(inputs, chunk_size):
+            yield from self(chunk)
 
 
 class BasePredictor(object):
@@ -21,13 +71,27 @@ class BasePredictor(object):
         device: str = "cpu",
         use_fp16: bool = False,
         load_weights: bool = True,
+        backend: str = "pytorch",
+        onnx_model_path: Optional[str] = None,
+        quantize: Optional[str] = None,
+        decode_workers: int = 0,
     ):
+        assert backend in ["pytorch", "onnx"], "The backend must be pytorch or onnx."
+        assert quantize is None or device == "cpu", "The quantized model only supports cpu inference."
+
+        if backend == "onnx" and (quantize is not None or use_fp16):
+            raise ValueError("The `quantize` and `use_fp16` options only support pytorch backend.")
+
         self.model = model
         self.model_name_or_path = model_name_or_path
         self.tokenizer = tokenizer
         self.load_weights = load_weights
         self.device = device
         self.use_fp16 = use_fp16
+        self.backend = backend
+        self.onnx_model_path = onnx_model_path
+        self.quantize = quantize
+        self.decode_workers = decode_workers
 
         self._prepare_predictor()
 
@@ -44,9 +108,17 @@ class BasePredictor(object):
 
         self.model.eval()
 
+        if self.backend == "onnx":
+            self._prepare_onnx_backbone()
+
+        if self.quantize is not None:
+            from ..nn.quantization import quantize_model
+
+            self.model = quantize_model(self.model, self.quantize)
+
         if self.device == 'cuda':
             logger.info(">>> [PyTorchInferBackend] Use GPU to inference ...")
-            if self.use_fp16:
+            if self.use_fp16 and self.backend == "pytorch":
                 logger.info(
                     ">>> [PyTorchInferBackend] Use FP16 to inference ...")
                 self.model = self.model.half()
@@ -55,6 +127,24 @@ class BasePredictor(object):
             logger.info(">>> [PyTorchInferBackend] Use CPU to inference ...")
         logger.info(">>> [PyTorchInferBackend] Engine Created ...")
 
+    def _prepare_onnx_backbone(self):
+        """
+        使用 ONNX Runtime 运行编码器，任务头与解码仍使用原模型，模型文件不存在时先导出
+        """
+        from ..nn.onnx import OnnxBackbone, export_backbone_to_onnx
+
+        onnx_model_path = self.onnx_model_path
+        if onnx_model_path is None:
+            assert self.model_name_or_path is not None, \
+                "The `model_name_or_path` or `onnx_model_path` should be specified to use onnx backend."
+            onnx_model_path = os.path.join(self.model_name_or_path, "onnx", "backbone.onnx")
+
+        if not os.path.exists(onnx_model_path):
+            export_backbone_to_onnx(self.model, onnx_model_path)
+
+        logger.info(f">>> [OnnxInferBackend] Load onnx model from {onnx_model_path} ...")
+        setattr(self.model, self.model.base_model_prefix, OnnxBackbone(onnx_model_path, device=self.device))
+
     def _prepare_input(self, data: Union[torch.Tensor, Any]) -> Union[torch.Tensor, Any]:
         """
         Prepares one `data` before feeding it to the model, be it a tensor or a nested list/dictionary of tensors.
@@ -64,10 +154,24 @@ class BasePredictor(object):
         elif isinstance(data, (tuple, list)):
             return type(data)(self._prepare_input(v) for v in data)
         elif isinstance(data, torch.Tensor):
-            kwargs = dict(device=self.device)
+            kwargs = dict(device=self.device, non_blocking=True)
             return data.to(**kwargs)
         return data
 
+    def _pin_memory(self, data: Union[torch.Tensor, Any]) -> Union[torch.Tensor, Any]:
+        """
+        GPU 推理时将 CPU 上的输入放入锁页内存，使主机到设备的拷贝可以异步进行，已在设备上或已锁页的张量保持不变
+        """
+        if self.device != "cuda":
+            return data
+        if isinstance(data, Mapping):
+            return type(data)({k: self._pin_memory(v) for k, v in data.items()})
+        elif isinstance(data, (tuple, list)):
+            return type(data)(self._pin_memory(v) for v in data)
+        elif isinstance(data, torch.Tensor) and data.device.type == "cpu" and not data.is_pinned():
+            return data.pin_memory()
+        return data
+
     def _prepare_inputs(self, inputs: Dict[str, Union[torch.Tensor, Any]]) -> Dict[str, Union[torch.Tensor, Any]]:
         """
         Prepare `inputs` before feeding them to the model, converting them to tensors if they are not already and
@@ -80,6 +184,132 @@ class BasePredictor(object):
             )
         return inputs
 
+    def _batch_encode(
+        self,
+        texts: List[str],
+        text_pairs: Optional[List[str]] = None,
+        max_length: int = 512,
+        batch_size: int = 64,
+        max_tokens: Optional[int] = None,
+        truncation: Union[bool, str] = True,
+        return_offsets_mapping: bool = True,
+        group_size: int = 1,
+    ):
+        """
+        一次性编码全部输入，按照长度分桶后逐批次 padding，返回 (样本下标, 批次输入) 的迭代器
+
+        当 group_size > 1 时，每 group_size 条连续输入视为同一个样本（例如 MRC 中同一句子的多个问题），
+        同一样本的输入始终位于同一批次中且保持原有顺序，batch_size 与返回的下标均以样本为单位
+        """
+        encoded_inputs = self.tokenizer(
+            texts,
+            text_pairs,
+            max_length=max_length,
+            truncation=truncation,
+            return_offsets_mapping=return_offsets_mapping,
+        )
+        offset_mapping = encoded_inputs.pop("offset_mapping", None)
+        lengths = [len(ids) for ids in encoded_inputs["input_ids"]]
+        # 以样本为单位计算长度，一个样本 padding 后占用 group_size * 最大长度 个 token
+        lengths = [
+            max(lengths[i: i + group_size]) * group_size for i in range(0, len(lengths), group_size)
+        ]
+
+        for batch_indices in tqdm(length_bucketed_batches(lengths, batch_size, max_tokens), desc="Predicting"):
+            rows = [i * group_size + j for i in batch_indices for j in range(group_size)]
+            batch_inputs = self.tokenizer.pad(
+                [{k: v[i] for k, v in encoded_inputs.items()} for i in rows],
+                padding=True,
+                return_tensors="pt",
+            )
+            if offset_mapping is not None:
+                seq_len = batch_inputs["input_ids"].shape[1]
+                batch_inputs["offset_mapping"] = [
+                    [list(o) for o in offset_mapping[i]] + [[0, 0]] * (seq_len - len(offset_mapping[i]))
+                    for i in rows
+                ]
+            yield batch_indices, batch_inputs
+
+    def _can_decode_outside_model(self) -> bool:
+        """
+        模型是否支持 `return_decoded_labels=False` 并由 `_decode` 在模型外部完成解码
+        """
+        return False
+
+    def _decode(self, outputs: Any, batch_inputs: Dict[str, Any]) -> List[Any]:
+        """
+        由模型输出（`return_decoded_labels=False`）与批次输入解码得到预测结果
+        """
+        raise NotImplementedError('Method [_decode] should be implemented.')
+
+    def _run_batches(
+        self, batches: Iterator[Tuple[List[int], Dict[str, Any]]], prefetch: int = 2,
+    ) -> Iterator[Tuple[List[int], List[Any]]]:
+        """
+        对 (样本下标, 批次输入) 迭代器逐批推理，按批次顺序返回 (样本下标, 预测结果) 的迭代器
+
+        + decode_workers 为 0 时串行执行：准备输入、前向计算、模型内解码
+        + decode_workers > 0 时流水线执行：后台线程提前准备之后 prefetch 个批次的输入（GPU 推理时放入锁页内存），
+          主线程只负责拷贝输入与前向计算，前一批次的解码交给 decode_workers 个解码线程
+        """
+        if self.decode_workers <= 0 or not self._can_decode_outside_model():
+            for batch_indices, batch_inputs in batches:
+                batch_inputs = self._prepare_inputs(batch_inputs)
+                yield batch_indices, self.model(**batch_inputs)['predictions']
+            return
+
+        batch_queue, stop, errors, end = queue.Queue(maxsize=prefetch), threading.Event(), [], object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
+            try:
+                for batch_indices, batch_inputs in batches:
+                    if stop.is_set():
+                        return
+                    put((batch_indices, self._pin_memory(batch_inputs)))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put(end)
+
+        decode = torch.no_grad()(self._decode)  # 梯度开关是线程级别的
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        pending = deque()
+        try:
+            with ThreadPoolExecutor(self.decode_workers) as executor:
+                while True:
+                    item = batch_queue.get()
+                    if item is end:
+                        break
+
+                    batch_indices, batch_inputs = item
+                    batch_inputs = self._prepare_inputs(batch_inputs)
+                    outputs = self.model(**batch_inputs, return_decoded_labels=False)
+                    pending.append((batch_indices, executor.submit(decode, outputs, batch_inputs)))
+
+                    # 限制等待解码的批次数量，避免模型输出堆积占用显存
+                    while pending and (len(pending) > self.decode_workers or pending[0][1].done()):
+                        batch_indices, future = pending.popleft()
+                        yield batch_indices, future.result()
+
+                if errors:
+                    raise errors[0]
+
+                while pending:
+                    batch_indices, future = pending.popleft()
+                    yield batch_indices, future.result()
+        finally:
+            stop.set()
+
     @torch.no_grad()
     def predict(self, text, **kwargs):
         raise NotImplementedError('Method [predict] should be implemented.')
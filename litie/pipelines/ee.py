@@ -1,10 +1,10 @@
-from typing import List, Union, Any
+from typing import List, Union, Any, Optional
 
 import torch
 
-from .base import BasePredictor
+from .base import BasePredictor, StreamMixin
 from ..nn.ee import AutoEventExtractionTaskModel
-from ..utils.logger import tqdm, logger
+from ..utils.logger import logger
 
 
 class DedupList(list):
@@ -57,6 +57,7 @@ class EventExtractionPredictor(BasePredictor):
         inputs: Union[str, List[str]],
         batch_size: int = 64,
         max_length: int = 512,
+        max_tokens: Optional[int] = None,
     ) -> Union[List[Any]]:
 
         if isinstance(inputs, str):
@@ -64,26 +65,16 @@ class EventExtractionPredictor(BasePredictor):
 
         infer_inputs = [t.replace(" ", "-") for t in inputs]  # 防止空格导致位置预测偏移
 
-        outputs = []
-        total_batch = len(infer_inputs) // batch_size + (1 if len(infer_inputs) % batch_size > 0 else 0)
-        for batch_id in tqdm(range(total_batch), desc="Predicting"):
-            batch_inputs = infer_inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-
-            batch_inputs = self.tokenizer(
-                batch_inputs,
-                max_length=max_length,
-                truncation=True,
-                return_offsets_mapping=True,
-                padding=True,
-                return_tensors="pt",
-            )
-
-            batch_inputs['texts'] = inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-            batch_inputs["offset_mapping"] = batch_inputs["offset_mapping"].tolist()
+        outputs = [None] * len(inputs)
+        for batch_indices, batch_inputs in self._batch_encode(
+            infer_inputs, max_length=max_length, batch_size=batch_size, max_tokens=max_tokens,
+        ):
+            batch_inputs['texts'] = [inputs[i] for i in batch_indices]
 
             batch_inputs = self._prepare_inputs(batch_inputs)
             batch_outputs = self.model(**batch_inputs)
-            outputs.extend(batch_outputs['predictions'])
+            for i, o in zip(batch_indices, batch_outputs['predictions']):
+                outputs[i] = o
 
         return [set2json(o) for o in outputs]
 
@@ -101,7 +92,7 @@ def get_auto_ee_predictor(
     return EventExtractionPredictor(model=model, **kwargs)
 
 
-class EventExtractionPipeline(object):
+class EventExtractionPipeline(StreamMixin):
     def __init__(
         self,
         task_model_name="gplinker",
@@ -115,6 +106,9 @@ class EventExtractionPipeline(object):
         batch_size=64,
         split_sentence=False,
         load_weights=True,
+        max_tokens=None,
+        backend="pytorch",
+        quantize=None,
     ) -> None:
 
         self._model_name = task_model_name
@@ -128,6 +122,9 @@ class EventExtractionPipeline(object):
         self._batch_size = batch_size
         self._split_sentence = split_sentence
         self._load_weights = load_weights
+        self._max_tokens = max_tokens
+        self._backend = backend
+        self._quantize = quantize
 
         self._prepare_predictor()
 
@@ -142,6 +139,8 @@ class EventExtractionPipeline(object):
             device=self._device,
             use_fp16=self._use_fp16,
             load_weights=self._load_weights,
+            backend=self._backend,
+            quantize=self._quantize,
         )
 
     def __call__(self, inputs):
@@ -151,7 +150,7 @@ class EventExtractionPipeline(object):
             texts = [texts]
 
         results = self.inference_backend.predict(
-            texts, batch_size=self._batch_size, max_length=self._max_seq_len,
+            texts, batch_size=self._batch_size, max_length=self._max_seq_len, max_tokens=self._max_tokens,
         )
 
         return results
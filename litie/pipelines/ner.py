@@ -1,14 +1,17 @@
+import inspect
 import itertools
 from collections import defaultdict
-from typing import List, Union, Dict, Set, Optional
+from typing import Any, List, Union, Dict, Set, Optional
 
 import numpy as np
 import torch
 
-from .base import BasePredictor
-from .utils import auto_splitter
+from .base import BasePredictor, StreamMixin, length_bucketed_batches
+from .pool import WorkerPoolMixin
+from .utils import auto_splitter, sliding_window_splitter, merge_window_spans, window_margin
 from ..datasets.ner.cnn import DataCollatorForCnnNer
 from ..datasets.ner.w2ner import DIST_TO_IDX, DataCollatorForW2Ner
+from ..nn.model_utils import SpanOutput
 from ..nn.ner import AutoNerTaskModel
 from ..utils.logger import tqdm, logger
 
@@ -32,6 +35,7 @@ class NerPredictor(BasePredictor):
         batch_size: int = 64,
         max_length: int = 512,
         return_dict: bool = True,
+        max_tokens: Optional[int] = None,
     ) -> Union[List[Set], List[Dict]]:
 
         if isinstance(inputs, str):
@@ -39,28 +43,33 @@ class NerPredictor(BasePredictor):
 
         infer_inputs = [t.replace(" ", "-") for t in inputs]  # 防止空格导致位置预测偏移
 
-        outputs = []
-        total_batch = len(infer_inputs) // batch_size + (1 if len(infer_inputs) % batch_size > 0 else 0)
-        for batch_id in tqdm(range(total_batch), desc="Predicting"):
-            batch_inputs = infer_inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
+        def iter_batches():
+            for batch_indices, batch_inputs in self._batch_encode(
+                infer_inputs, max_length=max_length, batch_size=batch_size, max_tokens=max_tokens,
+            ):
+                batch_inputs['texts'] = [inputs[i] for i in batch_indices]
+                yield batch_indices, batch_inputs
 
-            batch_inputs = self.tokenizer(
-                batch_inputs,
-                max_length=max_length,
-                truncation=True,
-                return_offsets_mapping=True,
-                padding=True,
-                return_tensors="pt",
-            )
+        outputs = [None] * len(inputs)
+        for batch_indices, batch_predictions in self._run_batches(iter_batches()):
+            for i, o in zip(batch_indices, batch_predictions):
+                outputs[i] = o
+
+        return outputs if not return_dict else [set2json(o) for o in outputs]
 
-            batch_inputs['texts'] = inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-            batch_inputs["offset_mapping"] = batch_inputs["offset_mapping"].tolist()
+    def _can_decode_outside_model(self) -> bool:
+        # CascadeCrf 解码时需要编码器输出与实体分类层，只能在模型内部解码
+        return "sequence_output" not in inspect.signature(self.model.decode).parameters
 
-            batch_inputs = self._prepare_inputs(batch_inputs)
-            batch_outputs = self.model(**batch_inputs)
-            outputs.extend(batch_outputs['predictions'])
+    def _decode(self, outputs, batch_inputs):
+        if isinstance(outputs, SpanOutput):
+            logits = [outputs.start_logits, outputs.end_logits]
+        else:
+            logits = [outputs.logits]
 
-        return outputs if not return_dict else [set2json(o) for o in outputs]
+        return self.model.decode(
+            *logits, batch_inputs["attention_mask"], batch_inputs["texts"], batch_inputs["offset_mapping"],
+        )
 
 
 class LearNerPredictor(NerPredictor):
@@ -71,6 +80,37 @@ class LearNerPredictor(NerPredictor):
         schema2prompt = schema2prompt or {}
         self.schema2prompt.update(schema2prompt)
         self.model.config.labels = self.schema2prompt
+        self._label_cache = {}
+
+    @torch.no_grad()
+    def _get_label_inputs(self, max_length: int = 64) -> Dict[str, torch.Tensor]:
+        """
+        编码标签描述并按 schema 缓存，标签表示只与模型和 schema 有关
+        """
+        key = hash((tuple(self.schema2prompt.items()), max_length))
+        if key not in self._label_cache:
+            label_inputs = self.tokenizer(
+                list(self.schema2prompt.values()),
+                padding=True,
+                truncation=True,
+                max_length=max_length,
+                return_token_type_ids=False,
+                return_tensors="pt",
+            )
+            label_inputs = self._prepare_input(label_inputs)
+            label_hidden_states = self.model.encode_labels(
+                label_inputs["input_ids"], label_inputs["attention_mask"]
+            )
+            self._label_cache[key] = {
+                "label_hidden_states": label_hidden_states,
+                "label_attention_mask": label_inputs["attention_mask"],
+            }
+        return self._label_cache[key]
+
+    def _prepare_inputs(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        # 缓存的标签表示已在设备上，在输入拷贝到设备之后再加入，不经过预取线程与锁页内存
+        inputs = super()._prepare_inputs(inputs)
+        return {**inputs, **self._get_label_inputs()}
 
     @torch.no_grad()
     def predict(
@@ -79,6 +119,7 @@ class LearNerPredictor(NerPredictor):
         batch_size: int = 8,
         max_length: int = 512,
         return_dict: bool = True,
+        max_tokens: Optional[int] = None,
     ) -> Union[List[Set], List[Dict]]:
 
         if isinstance(inputs, str):
@@ -86,41 +127,30 @@ class LearNerPredictor(NerPredictor):
 
         infer_inputs = [t.replace(" ", "-") for t in inputs]  # 防止空格导致位置预测偏移
 
-        outputs = []
-        label_annotations = list(self.schema2prompt.values())
-        label_inputs = self.tokenizer(
-            label_annotations,
-            padding=True,
-            truncation=True,
-            max_length=64,
-            return_token_type_ids=False,
-            return_tensors="pt",
-        )
-        label_inputs = {f"label_{k}": v for k, v in label_inputs.items()}
+        def iter_batches():
+            for batch_indices, batch_inputs in self._batch_encode(
+                infer_inputs, max_length=max_length, batch_size=batch_size, max_tokens=max_tokens,
+            ):
+                batch_inputs['texts'] = [inputs[i] for i in batch_indices]
+                yield batch_indices, batch_inputs
 
-        total_batch = len(infer_inputs) // batch_size + (1 if len(infer_inputs) % batch_size > 0 else 0)
-        for batch_id in tqdm(range(total_batch), desc="Predicting"):
-            batch_inputs = infer_inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-            batch_inputs = self.tokenizer(
-                batch_inputs,
-                max_length=max_length,
-                padding=True,
-                truncation=True,
-                return_offsets_mapping=True,
-                return_tensors="pt"
-            )
-
-            batch_inputs['texts'] = inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-            batch_inputs["offset_mapping"] = batch_inputs["offset_mapping"].tolist()
-
-            batch_inputs = {**batch_inputs, **label_inputs}
-            batch_inputs = self._prepare_inputs(batch_inputs)
-
-            batch_outputs = self.model(**batch_inputs)
-            outputs.extend(batch_outputs['predictions'])
+        outputs = [None] * len(inputs)
+        for batch_indices, batch_predictions in self._run_batches(iter_batches()):
+            for i, o in zip(batch_indices, batch_predictions):
+                outputs[i] = o
 
         return outputs if not return_dict else [set2json(o) for o in outputs]
 
+    def _decode(self, outputs, batch_inputs):
+        return self.model.decode(
+            outputs.start_logits,
+            outputs.end_logits,
+            outputs.span_logits,
+            batch_inputs["attention_mask"],
+            batch_inputs["texts"],
+            batch_inputs["offset_mapping"],
+        )
+
 
 class MrcNerPredictor(NerPredictor):
 
@@ -139,36 +169,51 @@ class MrcNerPredictor(NerPredictor):
         batch_size: int = 8,
         max_length: int = 512,
         return_dict: bool = True,
+        max_tokens: Optional[int] = None,
     ) -> Union[List[Set], List[Dict]]:
 
         if isinstance(inputs, str):
             inputs = [inputs]
 
-        return [self.single_sample_predict(sent, max_length, return_dict) for sent in inputs]
+        infer_inputs = [t.replace(" ", "-") for t in inputs]  # 防止空格导致位置预测偏移
 
-    def single_sample_predict(self, inputs: str, max_length: int = 512, return_dict: bool = True):
-        infer_inputs = inputs.replace(" ", "-")  # 防止空格导致位置预测偏移
-
-        first_sentences = list(self.schema2prompt.values())
-        second_sentences = [infer_inputs] * len(self.schema2prompt)
-
-        batch_inputs = self.tokenizer(
-            first_sentences,
-            second_sentences,
-            max_length=max_length,
-            padding=True,
-            truncation='only_second',
-            return_offsets_mapping=True,
-            return_tensors="pt"
-        )
+        # 每个句子与全部实体类型的问题组成 num_labels 条连续输入，解码时按 num_labels 合并回句子
+        prompts = list(self.schema2prompt.values())
+        first_sentences = prompts * len(infer_inputs)
+        second_sentences = [t for t in infer_inputs for _ in range(len(prompts))]
 
-        batch_inputs['texts'] = [inputs] * len(self.schema2prompt)
-        batch_inputs["offset_mapping"] = batch_inputs["offset_mapping"].tolist()
+        def iter_batches():
+            for batch_indices, batch_inputs in self._batch_encode(
+                first_sentences,
+                second_sentences,
+                max_length=max_length,
+                batch_size=batch_size,
+                max_tokens=max_tokens,
+                truncation='only_second',
+                group_size=len(prompts),
+            ):
+                batch_inputs['texts'] = [inputs[i] for i in batch_indices for _ in range(len(prompts))]
+                yield batch_indices, batch_inputs
+
+        outputs = [None] * len(inputs)
+        for batch_indices, batch_predictions in self._run_batches(iter_batches()):
+            for i, o in zip(batch_indices, batch_predictions):
+                outputs[i] = o
 
-        batch_inputs = self._prepare_inputs(batch_inputs)
-        outputs = self.model(**batch_inputs)['predictions']
+        return outputs if not return_dict else [set2json(o) for o in outputs]
 
-        return set2json(outputs[0]) if return_dict else outputs[0]
+    def _decode(self, outputs, batch_inputs):
+        return self.model.decode(
+            outputs.start_logits,
+            outputs.end_logits,
+            batch_inputs["token_type_ids"],
+            batch_inputs["attention_mask"],
+            batch_inputs["texts"],
+            batch_inputs["offset_mapping"],
+        )
+
+    def single_sample_predict(self, inputs: str, max_length: int = 512, return_dict: bool = True):
+        return self.predict([inputs], batch_size=1, max_length=max_length, return_dict=return_dict)[0]
 
 
 class W2NerPredictor(NerPredictor):
@@ -180,28 +225,32 @@ class W2NerPredictor(NerPredictor):
         batch_size: int = 8,
         max_length: int = 512,
         return_dict: bool = True,
+        max_tokens: Optional[int] = None,
     ) -> Union[List[Set], List[Dict]]:
 
         if isinstance(inputs, str):
             inputs = [inputs]
 
         infer_inputs = [t.replace(" ", "-") for t in inputs]  # 防止空格导致位置预测偏移
+        lengths = [min(len(t), max_length) for t in infer_inputs]  # 以字符数近似编码长度
 
-        outputs = []
-        total_batch = len(infer_inputs) // batch_size + (1 if len(infer_inputs) % batch_size > 0 else 0)
         collate_fn = DataCollatorForW2Ner()
-        for batch_id in tqdm(range(total_batch), desc="Predicting"):
-            batch_inputs = infer_inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-            batch_inputs = [self._process(example, max_length) for example in batch_inputs]
 
-            batch_inputs = collate_fn(batch_inputs)
-            batch_inputs = self._prepare_inputs(batch_inputs)
+        def iter_batches():
+            for batch_indices in tqdm(length_bucketed_batches(lengths, batch_size, max_tokens), desc="Predicting"):
+                batch_inputs = [self._process(infer_inputs[i], max_length) for i in batch_indices]
+                yield batch_indices, collate_fn(batch_inputs)
 
-            batch_outputs = self.model(**batch_inputs)
-            outputs.extend(batch_outputs['predictions'])
+        outputs = [None] * len(inputs)
+        for batch_indices, batch_predictions in self._run_batches(iter_batches()):
+            for i, o in zip(batch_indices, batch_predictions):
+                outputs[i] = o
 
         return outputs if not return_dict else [set2json(o) for o in outputs]
 
+    def _decode(self, outputs, batch_inputs):
+        return self.model.decode(outputs.logits, batch_inputs["input_lengths"], batch_inputs["texts"])
+
     def _process(self, text, max_length):
         tokens = [self.tokenizer.tokenize(word) for word in text[:max_length - 2]]
         pieces = [piece for pieces in tokens for piece in pieces]
@@ -247,28 +296,33 @@ class CnnNerPredictor(NerPredictor):
         batch_size: int = 8,
         max_length: int = 512,
         return_dict: bool = True,
+        max_tokens: Optional[int] = None,
     ) -> Union[List[Set], List[Dict]]:
 
         if isinstance(inputs, str):
             inputs = [inputs]
 
         infer_inputs = [t.replace(" ", "-") for t in inputs]  # 防止空格导致位置预测偏移
+        lengths = [min(len(t), max_length) for t in infer_inputs]  # 以字符数近似编码长度
 
-        outputs = []
-        total_batch = len(infer_inputs) // batch_size + (1 if len(infer_inputs) % batch_size > 0 else 0)
         collate_fn = DataCollatorForCnnNer()
-        for batch_id in tqdm(range(total_batch), desc="Predicting"):
-            batch_inputs = infer_inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-            batch_inputs = [self._process(example, max_length) for example in batch_inputs]
 
-            batch_inputs = collate_fn(batch_inputs)
-            batch_inputs = self._prepare_inputs(batch_inputs)
+        def iter_batches():
+            for batch_indices in tqdm(length_bucketed_batches(lengths, batch_size, max_tokens), desc="Predicting"):
+                batch_inputs = [self._process(infer_inputs[i], max_length) for i in batch_indices]
+                yield batch_indices, collate_fn(batch_inputs)
 
-            batch_outputs = self.model(**batch_inputs)
-            outputs.extend(batch_outputs['predictions'])
+        outputs = [None] * len(inputs)
+        for batch_indices, batch_predictions in self._run_batches(iter_batches()):
+            for i, o in zip(batch_indices, batch_predictions):
+                outputs[i] = o
 
         return outputs if not return_dict else [set2json(o) for o in outputs]
 
+    def _decode(self, outputs, batch_inputs):
+        lengths, _ = batch_inputs["indexes"].max(dim=-1)
+        return self.model.decode(outputs.logits, lengths, batch_inputs["texts"])
+
     def _process(self, text, max_length):
         _indexes = []
         _bpes = []
@@ -319,7 +373,7 @@ def get_auto_ner_predictor(
     return predictor_class(model=model, schema2prompt=schema2prompt, **kwargs)
 
 
-class NerPipeline(object):
+class NerPipeline(StreamMixin, WorkerPoolMixin):
     def __init__(
         self,
         task_model_name="crf",
@@ -334,6 +388,12 @@ class NerPipeline(object):
         split_sentence=False,
         schema2prompt=None,
         load_weights=True,
+        max_tokens=None,
+        backend="pytorch",
+        quantize=None,
+        window_overlap=0,
+        num_workers=0,
+        decode_workers=0,
     ) -> None:
 
         self._model_name = task_model_name
@@ -348,8 +408,15 @@ class NerPipeline(object):
         self._split_sentence = split_sentence
         self._schema2prompt = schema2prompt
         self._load_weights = load_weights
+        self._max_tokens = max_tokens
+        self._backend = backend
+        self._quantize = quantize
+        self._window_overlap = window_overlap
+        self._num_workers = num_workers
+        self._decode_workers = decode_workers
 
         self._prepare_predictor()
+        self._prepare_worker_pool()
 
     def _prepare_predictor(self):
         logger.info(f">>> [Pytorch InferBackend of {self._model_type}-{self._model_name}] Creating Engine ...")
@@ -363,6 +430,9 @@ class NerPipeline(object):
             device=self._device,
             use_fp16=self._use_fp16,
             load_weights=self._load_weights,
+            backend=self._backend,
+            quantize=self._quantize,
+            decode_workers=self._decode_workers,
         )
 
     def __call__(self, inputs):
@@ -371,19 +441,47 @@ class NerPipeline(object):
         if isinstance(texts, str):
             texts = [texts]
 
+        return self._dispatch(texts)
+
+    def _predict(self, texts):
         max_prompt_len = len(max(self._schema2prompt.values())) if (self._schema2prompt is not None) else -1
         max_predict_len = self._max_seq_len - max_prompt_len - 3
 
-        short_input_texts, self.input_mapping = auto_splitter(
-            texts, max_predict_len, split_sentence=self._split_sentence
-        )
+        if self._window_overlap > 0:
+            short_input_texts, self.input_mapping, self.input_offsets = sliding_window_splitter(
+                texts, max_predict_len, overlap=self._window_overlap, split_sentence=self._split_sentence
+            )
+        else:
+            short_input_texts, self.input_mapping = auto_splitter(
+                texts, max_predict_len, split_sentence=self._split_sentence
+            )
 
         results = self.inference_backend.predict(
-            short_input_texts, batch_size=self._batch_size, max_length=self._max_seq_len, return_dict=False
+            short_input_texts,
+            batch_size=self._batch_size,
+            max_length=self._max_seq_len,
+            return_dict=False,
+            max_tokens=self._max_tokens,
         )
-        results = self._auto_joiner(results, short_input_texts, self.input_mapping)
 
-        return results
+        if self._window_overlap > 0:
+            return self._window_joiner(results, short_input_texts, texts)
+        return self._auto_joiner(results, short_input_texts, self.input_mapping)
+
+    def _window_joiner(self, short_results, short_inputs, texts):
+        concat_results = []
+        for k, vs in self.input_mapping.items():
+            spans = []
+            for v in vs:
+                window_start = self.input_offsets[v]
+                window_end = window_start + len(short_inputs[v])
+                for res in short_results[v]:
+                    start, end = res[1] + window_start, res[2] + window_start
+                    margin = window_margin(start, end, window_start, window_end, len(texts[k]))
+                    spans.append((res[0], start, end, v, margin, (res[0], start, end, res[3])))
+            single_results = set(merge_window_spans(spans))
+            concat_results.append(set2json(single_results) if single_results else {})
+        return concat_results
 
     def _auto_joiner(self, short_results, short_inputs, input_mapping):
         concat_results = []
@@ -0,0 +1,160 @@
+import math
+import multiprocessing as mp
+import os
+from typing import Any, Dict, List, Optional
+
+import torch
+
+from ..utils.logger import logger
+
+# 子进程中的 pipeline，由 `_init_worker` 设置
+_WORKER_PIPELINE = None
+
+
+def _init_worker(pipeline, counter, num_threads, cores_per_worker):
+    global _WORKER_PIPELINE
+
+    # fork 方式下 initargs 由子进程直接继承，无需序列化动态构建的模型类；
+    # 重新创建的子进程同样使用所属进程池的 pipeline，不受之后创建的进程池影响
+    _WORKER_PIPELINE = pipeline
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    torch.set_num_threads(num_threads)
+
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+
+    # 将每个进程绑定到互不重叠的 CPU 核心上
+    if cores_per_worker > 0 and hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        pinned = cores[worker_id * cores_per_worker: (worker_id + 1) * cores_per_worker]
+        if pinned:
+            os.sched_setaffinity(0, pinned)
+
+
+def _run_shard(args):
+    texts, state = args
+    # 主进程中可修改的设置（schema、阈值等）随每个块一起发送，子进程不依赖 fork 时的快照
+    _WORKER_PIPELINE.__dict__.update(state)
+    # 直接调用单进程推理，不经过 `pipeline(texts)`，避免子进程再次进入继承来的进程池
+    return _WORKER_PIPELINE._predict(texts)
+
+
+class WorkerPool(object):
+    """
+    多进程 CPU 推理进程池：输入按块分发到各个进程，结果按原始顺序返回
+
+    + 📖 通过 fork 创建子进程，模型参数事先移动到共享内存（`share_memory_`），各进程不复制模型权重
+    + 📖 每个进程使用固定数量的 intra-op 线程并绑定到不同的 CPU 核心
+
+    Args:
+        pipeline: 单进程 pipeline，需要实现 `_predict(List[str]) -> List[Any]`
+        model: pipeline 使用的 `torch` 模型，用于共享参数
+        num_workers (int): 进程数
+        num_threads (int): 每个进程的 intra-op 线程数，默认平均分配 CPU 核心
+        pin_cores (bool): 是否将进程绑定到 CPU 核心
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        model: torch.nn.Module,
+        num_workers: int,
+        num_threads: Optional[int] = None,
+        pin_cores: bool = True,
+    ):
+        assert "fork" in mp.get_all_start_methods(), "The `num_workers` option requires the fork start method."
+
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        cores_per_worker = max(1, num_cores // num_workers)
+        num_threads = num_threads or cores_per_worker
+
+        model.share_memory()
+
+        self.num_workers = num_workers
+        self._pid = os.getpid()
+        ctx = mp.get_context("fork")
+        self._pool = ctx.Pool(
+            num_workers,
+            initializer=_init_worker,
+            initargs=(pipeline, ctx.Value("i", 0), num_threads, cores_per_worker if pin_cores else 0),
+        )
+
+        logger.info(f">>> [WorkerPool] Created {num_workers} workers with {num_threads} threads each ...")
+
+    def __call__(self, texts: List[str], state: Optional[Dict[str, Any]] = None) -> List[Any]:
+        """
+        Args:
+            texts (List[str]): 输入文本
+            state (dict): 推理前在子进程的 pipeline 上更新的属性
+        """
+        assert self._pool is not None, "The worker pool has been closed."
+
+        # 每个进程分到多个较小的块，使负载更均衡
+        chunk_size = max(1, math.ceil(len(texts) / (self.num_workers * 4)))
+        shards = [(texts[i: i + chunk_size], state or {}) for i in range(0, len(texts), chunk_size)]
+
+        results = []
+        for shard_results in self._pool.map(_run_shard, shards):
+            results.extend(shard_results)
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # 只在创建进程池的进程中结束子进程，fork 出的子进程会继承该对象
+        pool = getattr(self, "_pool", None)
+        if pool is not None and getattr(self, "_pid", None) == os.getpid():
+            pool.terminate()
+
+
+class WorkerPoolMixin(object):
+    """
+    为 pipeline 提供多进程推理：`num_workers > 1` 时由 `WorkerPool` 分块调用 `_predict`，否则在当前进程中调用
+    """
+
+    # 推理前同步到子进程的属性
+    _worker_state_keys = ("_max_seq_len", "_split_sentence")
+
+    def _prepare_worker_pool(self):
+        self._worker_pool = None
+        if self._num_workers > 1:
+            assert self._backend == "pytorch", "The `num_workers` option only supports pytorch backend."
+            assert self._device == "cpu", "The `num_workers` option only supports cpu inference."
+            self._worker_pool = WorkerPool(self, self._torch_model, self._num_workers)
+
+    @property
+    def _torch_model(self):
+        return self.inference_backend.model
+
+    def _predict(self, texts: List[str]) -> List[Any]:
+        raise NotImplementedError('Method [_predict] should be implemented.')
+
+    def _dispatch(self, texts: List[str]) -> List[Any]:
+        if getattr(self, "_worker_pool", None) is not None:
+            return self._worker_pool(texts, state={k: getattr(self, k) for k in self._worker_state_keys})
+        return self._predict(texts)
+
+    def close(self):
+        """
+        关闭多进程推理的进程池
+        """
+        if getattr(self, "_worker_pool", None) is not None:
+            self._worker_pool.close()
+            self._worker_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,12 +1,13 @@
 from collections import defaultdict
-from typing import List, Union, Dict, Set
+from typing import List, Union, Dict, Set, Optional
 
 import torch
 
-from .base import BasePredictor
-from .utils import auto_splitter
+from .base import BasePredictor, StreamMixin
+from .pool import WorkerPoolMixin
+from .utils import auto_splitter, sliding_window_splitter
 from ..nn.re import AutoReTaskModel
-from ..utils.logger import tqdm, logger
+from ..utils.logger import logger
 
 
 def set2json(labels: Set) -> Dict:
@@ -27,6 +28,7 @@ class RelationExtractionPredictor(BasePredictor):
         batch_size: int = 64,
         max_length: int = 512,
         return_dict: bool = True,
+        max_tokens: Optional[int] = None,
     ) -> Union[List[Set], List[Dict]]:
 
         if isinstance(inputs, str):
@@ -34,26 +36,16 @@ class RelationExtractionPredictor(BasePredictor):
 
         infer_inputs = [t.replace(" ", "-") for t in inputs]  # 防止空格导致位置预测偏移
 
-        outputs = []
-        total_batch = len(infer_inputs) // batch_size + (1 if len(infer_inputs) % batch_size > 0 else 0)
-        for batch_id in tqdm(range(total_batch), desc="Predicting"):
-            batch_inputs = infer_inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-
-            batch_inputs = self.tokenizer(
-                batch_inputs,
-                max_length=max_length,
-                truncation=True,
-                return_offsets_mapping=True,
-                padding=True,
-                return_tensors="pt",
-            )
-
-            batch_inputs['texts'] = inputs[batch_id * batch_size: (batch_id + 1) * batch_size]
-            batch_inputs["offset_mapping"] = batch_inputs["offset_mapping"].tolist()
+        outputs = [None] * len(inputs)
+        for batch_indices, batch_inputs in self._batch_encode(
+            infer_inputs, max_length=max_length, batch_size=batch_size, max_tokens=max_tokens,
+        ):
+            batch_inputs['texts'] = [inputs[i] for i in batch_indices]
 
             batch_inputs = self._prepare_inputs(batch_inputs)
             batch_outputs = self.model(**batch_inputs)
-            outputs.extend(batch_outputs['predictions'])
+            for i, o in zip(batch_indices, batch_outputs['predictions']):
+                outputs[i] = o
 
         return outputs if not return_dict else [set2json(o) for o in outputs]
 
@@ -71,7 +63,7 @@ def get_auto_re_predictor(
     return RelationExtractionPredictor(model=model, **kwargs)
 
 
-class RelationExtractionPipeline(object):
+class RelationExtractionPipeline(StreamMixin, WorkerPoolMixin):
     def __init__(
         self,
         task_model_name="casrel",
@@ -85,6 +77,11 @@ class RelationExtractionPipeline(object):
         batch_size=64,
         split_sentence=False,
         load_weights=True,
+        max_tokens=None,
+        backend="pytorch",
+        quantize=None,
+        window_overlap=0,
+        num_workers=0,
     ) -> None:
 
         self._model_name = task_model_name
@@ -98,8 +95,14 @@ class RelationExtractionPipeline(object):
         self._batch_size = batch_size
         self._split_sentence = split_sentence
         self._load_weights = load_weights
+        self._max_tokens = max_tokens
+        self._backend = backend
+        self._quantize = quantize
+        self._window_overlap = window_overlap
+        self._num_workers = num_workers
 
         self._prepare_predictor()
+        self._prepare_worker_pool()
 
     def _prepare_predictor(self):
         logger.info(f">>> [Pytorch InferBackend of {self._model_type}-{self._model_name}] Creating Engine ...")
@@ -112,6 +115,8 @@ class RelationExtractionPipeline(object):
             device=self._device,
             use_fp16=self._use_fp16,
             load_weights=self._load_weights,
+            backend=self._backend,
+            quantize=self._quantize,
         )
 
     def __call__(self, inputs):
@@ -120,13 +125,26 @@ class RelationExtractionPipeline(object):
         if isinstance(texts, str):
             texts = [texts]
 
+        return self._dispatch(texts)
+
+    def _predict(self, texts):
         max_predict_len = self._max_seq_len - 2
-        short_input_texts, self.input_mapping = auto_splitter(
-            texts, max_predict_len, split_sentence=self._split_sentence
-        )
+        if self._window_overlap > 0:
+            # 三元组不含位置信息，重叠窗口的结果在合并时直接去重
+            short_input_texts, self.input_mapping, _ = sliding_window_splitter(
+                texts, max_predict_len, overlap=self._window_overlap, split_sentence=self._split_sentence
+            )
+        else:
+            short_input_texts, self.input_mapping = auto_splitter(
+                texts, max_predict_len, split_sentence=self._split_sentence
+            )
 
         results = self.inference_backend.predict(
-            short_input_texts, batch_size=self._batch_size, max_length=self._max_seq_len, return_dict=False
+            short_input_texts,
+            batch_size=self._batch_size,
+            max_length=self._max_seq_len,
+            return_dict=False,
+            max_tokens=self._max_tokens,
         )
         results = self._auto_joiner(results, self.input_mapping)
 
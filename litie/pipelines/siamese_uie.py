@@ -0,0 +1,280 @@
+import re
+from collections import OrderedDict
+
+import torch
+
+from .base import length_bucketed_batches
+from .uie import UIEPipeline
+from ..datasets.uie.utils import get_id_and_prob
+from ..nn.decode_utils import extract_nearest_spans
+from ..utils.logger import logger, tqdm
+
+
+class SiameseUIEPipeline(UIEPipeline):
+    """
+    基于`SiameseUIE`的通用信息抽取流水线，沿用`UIEPipeline`的 schema 树递归抽取逻辑
+
+    + 📖 模型前 `N-n` 层为双流结构，文本只编码一次，同一文本的所有提示共享文本特征
+    + 📖 提示的双流编码结果按 (提示, 位置偏移) 缓存在 LRU 中，每个 (文本, 提示) 对只需要计算后 `n` 层的 `crossattention`
+
+    Args:
+        model_name_or_path (str): 模型路径
+        schema: 抽取目标
+        model_type (str): 预训练模型类型，用于构建`SiameseUIE`
+        prompt_cache_size (int): 提示编码结果 LRU 缓存的最大条目数
+        pad_to_multiple_of (int): 文本 padding 后的长度为该值的整数倍，减少提示位置偏移的种类以提高缓存命中率
+    """
+
+    def __init__(
+        self,
+        model_name_or_path,
+        schema,
+        model_type="bert",
+        schema_lang="zh",
+        device='cpu',
+        position_prob=0.5,
+        max_seq_len=512,
+        batch_size=64,
+        split_sentence=False,
+        use_fp16=False,
+        is_english_model=False,
+        max_tokens=None,
+        prompt_cache_size=1024,
+        pad_to_multiple_of=32,
+        quantize=None,
+        window_overlap=0,
+        num_workers=0,
+    ) -> None:
+        self._model_type = model_type
+        self._prompt_cache_size = prompt_cache_size
+        self._pad_to_multiple_of = pad_to_multiple_of
+        self._prompt_cache = OrderedDict()
+
+        super().__init__(
+            model_name_or_path,
+            schema,
+            schema_lang=schema_lang,
+            device=device,
+            position_prob=position_prob,
+            max_seq_len=max_seq_len,
+            batch_size=batch_size,
+            split_sentence=split_sentence,
+            use_fp16=use_fp16,
+            is_english_model=is_english_model,
+            max_tokens=max_tokens,
+            quantize=quantize,
+            window_overlap=window_overlap,
+            num_workers=num_workers,
+        )
+
+    def _prepare_predictor(self):
+        from transformers import AutoTokenizer
+        from ..nn.uie import get_auto_siamese_uie_model
+
+        logger.info(">>> [PyTorchInferBackend] Creating Engine ...")
+
+        self._tokenizer = AutoTokenizer.from_pretrained(self._model_name_or_path)
+
+        model = get_auto_siamese_uie_model(self._model_type)
+        self.model = model.from_pretrained(self._model_name_or_path)
+        self.model.eval()
+
+        if self._quantize is not None:
+            from ..nn.quantization import quantize_model
+
+            assert self._device == 'cpu', "The quantized model only supports cpu inference."
+            self.model = quantize_model(self.model, self._quantize)
+
+        if self._device == 'gpu':
+            logger.info(">>> [PyTorchInferBackend] Use GPU to inference ...")
+            if self._use_fp16:
+                logger.info(">>> [PyTorchInferBackend] Use FP16 to inference ...")
+                self.model = self.model.half()
+            self.model = self.model.cuda()
+        else:
+            logger.info(">>> [PyTorchInferBackend] Use CPU to inference ...")
+        logger.info(">>> [PyTorchInferBackend] Engine Created ...")
+
+    def set_schema(self, schema):
+        if isinstance(schema, (dict, str)):
+            schema = [schema]
+        schema_tree = self._build_tree(schema)
+        self._check_schema(schema_tree)
+        self._schema_tree = schema_tree
+
+    @classmethod
+    def _check_schema(cls, node):
+        """
+        文本与提示分开编码，答案只能是文本中的片段，无法从提示中选择 `[...]` 形式的分类选项
+        """
+        for child in node.children:
+            if re.search(r'\[.*?\]$', child.name):
+                raise ValueError(
+                    f"SiameseUIE does not support classification schema, but `{child.name}` received."
+                )
+            cls._check_schema(child)
+
+    @property
+    def _torch_model(self):
+        return self.model
+
+    @property
+    def _torch_device(self):
+        return "cuda" if self._device == "gpu" else "cpu"
+
+    def clear_prompt_cache(self):
+        self._prompt_cache.clear()
+
+    @torch.no_grad()
+    def _get_prompt_states(self, prompts, position_offsets, max_prompt_len):
+        """
+        获取提示的双流编码结果，未命中缓存的 (提示, 位置偏移) 批量编码后写入 LRU 缓存
+        Returns:
+            (torch.Tensor, torch.Tensor): [batch_size, prompt_len, hidden_size] 的提示特征与对应的 mask
+        """
+        keys = list(zip(prompts, position_offsets))
+        missing = [key for key in dict.fromkeys(keys) if key not in self._prompt_cache]
+        if missing:
+            encoded_prompts = self._tokenizer(
+                [p for p, _ in missing],
+                padding=True,
+                truncation=True,
+                max_length=max_prompt_len,
+                return_token_type_ids=False,
+                return_tensors="pt",
+            )
+            prompt_input_ids = encoded_prompts["input_ids"].to(self._torch_device)
+            prompt_mask = encoded_prompts["attention_mask"].to(self._torch_device)
+            prompt_states = self.model.get_prompt_sequence_output(
+                prompt_input_ids, prompt_mask, torch.tensor([o for _, o in missing])
+            )
+
+            # 复制而不是保存切片，切片会使整个批次的编码结果随任一缓存条目一直保留在内存中
+            for key, states, length in zip(missing, prompt_states, prompt_mask.sum(1).tolist()):
+                self._prompt_cache[key] = states[:length].clone()
+
+        states = []
+        for key in keys:
+            self._prompt_cache.move_to_end(key)
+            states.append(self._prompt_cache[key])
+
+        while len(self._prompt_cache) > self._prompt_cache_size:
+            self._prompt_cache.popitem(last=False)
+
+        prompt_len = max(s.shape[0] for s in states)
+        prompt_states = states[0].new_zeros((len(states), prompt_len, states[0].shape[-1]))
+        prompt_mask = torch.zeros((len(states), prompt_len), dtype=torch.long, device=self._torch_device)
+        for i, s in enumerate(states):
+            prompt_states[i, :s.shape[0]] = s
+            prompt_mask[i, :s.shape[0]] = 1
+
+        return prompt_states, prompt_mask
+
+    def _max_text_len(self, prompts):
+        # 提示的位置编码接在文本之后，偏移量取文本长度向上取整到 pad_to_multiple_of 的倍数，
+        # 使结果与批次组成无关，同时减少偏移量的种类以提高缓存命中率；拼接后的位置编码不能超过 max_seq_len
+        max_prompt_len = max(len(p) for p in prompts) + 2
+        max_text_len = (self._max_seq_len - max_prompt_len) // self._pad_to_multiple_of * self._pad_to_multiple_of
+        assert max_text_len > 2, "The `max_seq_len` is too short for the prompts."
+        return max_text_len
+
+    def _max_predict_len(self, prompts):
+        return self._max_text_len(prompts) - 2
+
+    def _split_inputs(self, inputs):
+        short_inputs, input_mapping, input_offsets = super()._split_inputs(inputs)
+        # 文本的截断长度由所属节点最长的提示决定
+        max_text_len = self._max_text_len([x["prompt"] for x in inputs])
+        for x in short_inputs:
+            x["max_text_len"] = max_text_len
+        return short_inputs, input_mapping, input_offsets
+
+    @torch.no_grad()
+    def _predict_short_inputs(self, short_inputs):
+        max_prompt_len = max(len(x["prompt"]) for x in short_inputs) + 2
+
+        # 相同的文本只编码一次
+        text2pairs = OrderedDict()
+        for i, x in enumerate(short_inputs):
+            text2pairs.setdefault((x["text"], x["max_text_len"]), []).append(i)
+        unique_texts = list(text2pairs.keys())
+
+        # 不同节点的截断长度可能不同，按截断长度分别编码
+        encoded_texts = {}
+        for max_text_len in sorted(set(length for _, length in unique_texts)):
+            indices = [i for i, (_, length) in enumerate(unique_texts) if length == max_text_len]
+            encoded = self._tokenizer(
+                [unique_texts[i][0] for i in indices],
+                truncation=True,
+                max_length=max_text_len,
+                return_offsets_mapping=True,
+            )
+            for key, values in encoded.items():
+                column = encoded_texts.setdefault(key, [None] * len(unique_texts))
+                for i, value in zip(indices, values):
+                    column[i] = value
+        offset_maps = encoded_texts.pop("offset_mapping")
+        lengths = [len(ids) for ids in encoded_texts["input_ids"]]
+
+        sentence_ids, probs = [None] * len(short_inputs), [None] * len(short_inputs)
+        batches = length_bucketed_batches(lengths, self._batch_size, self._max_tokens)
+        for text_indices in tqdm(batches, desc="Predicting", unit='batch'):
+            batch = self._tokenizer.pad(
+                [{key: value[i] for key, value in encoded_texts.items()} for i in text_indices],
+                padding=True,
+                pad_to_multiple_of=self._pad_to_multiple_of,
+                return_tensors="pt",
+            )
+            batch = {key: value.to(self._torch_device) for key, value in batch.items()}
+            text_states = self.model.get_text_sequence_output(**batch)[0]
+            seq_len = text_states.shape[1]
+
+            pairs = [(k, j) for k, i in enumerate(text_indices) for j in text2pairs[unique_texts[i]]]
+            pair_batch_size = self._batch_size
+            if self._max_tokens is not None:
+                pair_batch_size = max(1, min(pair_batch_size, self._max_tokens // (seq_len + max_prompt_len)))
+
+            for start in range(0, len(pairs), pair_batch_size):
+                rows = [k for k, _ in pairs[start: start + pair_batch_size]]
+                pair_ids = [j for _, j in pairs[start: start + pair_batch_size]]
+
+                prompt_states, prompt_mask = self._get_prompt_states(
+                    [short_inputs[j]["prompt"] for j in pair_ids],
+                    [self._round_up(lengths[text_indices[k]]) for k in rows],
+                    max_prompt_len,
+                )
+                start_logits, end_logits = self.model.get_fusion_output(
+                    text_states[rows], batch["attention_mask"][rows], prompt_states, prompt_mask
+                )
+                start_prob = torch.sigmoid(start_logits).float().cpu().numpy()
+                end_prob = torch.sigmoid(end_logits).float().cpu().numpy()
+
+                row_indices = [text_indices[k] for k in rows]
+                decoded = self._decode(
+                    start_prob, end_prob, [lengths[i] for i in row_indices], [offset_maps[i] for i in row_indices]
+                )
+                for j, (sentence_id, prob) in zip(pair_ids, decoded):
+                    sentence_ids[j], probs[j] = sentence_id, prob
+
+        return self._convert_ids_to_results(short_inputs, sentence_ids, probs)
+
+    def _round_up(self, length):
+        return (length + self._pad_to_multiple_of - 1) // self._pad_to_multiple_of * self._pad_to_multiple_of
+
+    def _decode(self, start_prob, end_prob, lengths, offset_maps):
+        """ 批量解码每一行的片段，跳过 [CLS] 与 [SEP]，返回每一行的 (sentence_id, prob) """
+        batch_ids, _, starts, ends = extract_nearest_spans(
+            start_prob > self._position_prob,
+            end_prob > self._position_prob,
+            lengths,
+            unique_end=True,
+        )
+        # 与逐行解码时一样以集合保存片段，保持结果的顺序不变
+        span_sets = [set() for _ in range(len(lengths))]
+        for k, start, end in zip(batch_ids.tolist(), starts.tolist(), ends.tolist()):
+            span_sets[k].add(((start, start_prob[k, start]), (end, end_prob[k, end])))
+
+        return [
+            get_id_and_prob(span_set, offset_map, with_prompt=False)
+            for span_set, offset_map in zip(span_sets, offset_maps)
+        ]
@@ -1,12 +1,13 @@
 from collections import Counter
-from typing import List, Union
+from typing import List, Union, Optional, Iterable, Iterator, Tuple
 
 import numpy as np
 import torch
 
-from .base import BasePredictor
+from .base import BasePredictor, StreamMixin
+from .utils import batch_iterator
 from ..nn.tc import AutoTextClassificationTaskModel
-from ..utils.logger import tqdm, logger
+from ..utils.logger import logger
 
 
 class TextClassificationPredictor(BasePredictor):
@@ -18,6 +19,7 @@ class TextClassificationPredictor(BasePredictor):
         text_b: Union[str, List[str]] = None,
         batch_size: int = 64,
         max_length: int = 512,
+        max_tokens: Optional[int] = None,
     ) -> Union[dict, List[dict]]:
 
         if isinstance(text_a, str):
@@ -25,34 +27,22 @@ class TextClassificationPredictor(BasePredictor):
             if text_b is not None and isinstance(text_b, str):
                 text_b = [text_b]
 
-        output_list = []
-        total_batch = len(text_a) // batch_size + (1 if len(text_a) % batch_size > 0 else 0)
-        for batch_id in tqdm(range(total_batch), desc="Predicting"):
-            batch_text_a = text_a[batch_id * batch_size: (batch_id + 1) * batch_size]
-            if text_b is not None:
-                batch_text_b = text_b[batch_id * batch_size: (batch_id + 1) * batch_size]
-                inputs = self.tokenizer(
-                    batch_text_a,
-                    batch_text_b,
-                    max_length=max_length,
-                    padding=True,
-                    truncation='only_second',
-                    return_tensors="pt",
-                )
-            else:
-                inputs = self.tokenizer(
-                    batch_text_a,
-                    max_length=max_length,
-                    truncation=True,
-                    padding=True,
-                    return_tensors="pt",
-                )
-
+        output_list = [None] * len(text_a)
+        for batch_indices, inputs in self._batch_encode(
+            text_a,
+            text_b,
+            max_length=max_length,
+            batch_size=batch_size,
+            max_tokens=max_tokens,
+            truncation='only_second' if text_b is not None else True,
+            return_offsets_mapping=False,
+        ):
             inputs = self._prepare_inputs(inputs)
             outputs = self.model(**inputs)
 
             outputs = np.asarray(outputs['logits'].cpu()).argmax(-1)
-            output_list.extend(outputs)
+            for i, o in zip(batch_indices, outputs):
+                output_list[i] = o
 
         if hasattr(self.model.config, "tc_label2id"):
             self.id2label = {int(v): k for k, v in self.model.config.tc_label2id.items()}
@@ -74,7 +64,7 @@ def get_auto_tc_predictor(
     return TextClassificationPredictor(model=model, **kwargs)
 
 
-class TextClassificationPipeline(object):
+class TextClassificationPipeline(StreamMixin):
     def __init__(
         self,
         task_model_name="tc",
@@ -87,6 +77,9 @@ class TextClassificationPipeline(object):
         max_seq_len=512,
         batch_size=64,
         load_weights=True,
+        max_tokens=None,
+        backend="pytorch",
+        quantize=None,
     ) -> None:
 
         self._model_name = task_model_name
@@ -99,6 +92,9 @@ class TextClassificationPipeline(object):
         self._max_seq_len = max_seq_len
         self._batch_size = batch_size
         self._load_weights = load_weights
+        self._max_tokens = max_tokens
+        self._backend = backend
+        self._quantize = quantize
 
         self._prepare_predictor()
 
@@ -113,6 +109,8 @@ class TextClassificationPipeline(object):
             device=self._device,
             use_fp16=self._use_fp16,
             load_weights=self._load_weights,
+            backend=self._backend,
+            quantize=self._quantize,
         )
 
     def __call__(self, text_a: Union[str, List[str]], text_b: Union[str, List[str]] = None):
@@ -120,9 +118,21 @@ class TextClassificationPipeline(object):
             text_a,
             text_b,
             batch_size=self._batch_size,
-            max_length=self._max_seq_len
+            max_length=self._max_seq_len,
+            max_tokens=self._max_tokens,
         )
 
+    def stream(self, inputs: Iterable[Union[str, Tuple[str, str]]], chunk_size: int = 1024) -> Iterator:
+        """
+        流式推理，输入为文本或 (text_a, text_b) 文本对
+        """
+        for chunk in batch_iterator(inputs, chunk_size):
+            if isinstance(chunk[0], (tuple, list)):
+                text_a, text_b = map(list, zip(*chunk))
+                yield from self(text_a, text_b)
+            else:
+                yield from self(chunk)
+
     @property
     def seqlen(self):
         return self._max_seq_len
@@ -6,14 +6,17 @@ import numpy as np
 import torch
 from transformers import BertTokenizerFast
 
+from .base import StreamMixin, length_bucketed_batches
+from .pool import WorkerPoolMixin
+from .utils import sliding_window_splitter, merge_window_spans, window_margin
 from ..datasets.uie.utils import get_id_and_prob
-from ..metrics.extraction.span import get_bool_ids_greater_than, get_span
+from ..nn.decode_utils import extract_nearest_spans
 from ..utils.common import cut_chinese_sent, dbc2sbc
 from ..utils.logger import logger, tqdm
 
 
 class PyTorchInferBackend:
-    def __init__(self, model_name_or_path, device='cpu', use_fp16=False):
+    def __init__(self, model_name_or_path, device='cpu', use_fp16=False, quantize=None):
         from ..nn.uie import UIEModel
 
         logger.info(">>> [PyTorchInferBackend] Creating Engine ...")
@@ -22,6 +25,12 @@ class PyTorchInferBackend:
         self.model.eval()
         self.device = device
 
+        if quantize is not None:
+            from ..nn.quantization import quantize_model
+
+            assert device == 'cpu', "The quantized model only supports cpu inference."
+            self.model = quantize_model(self.model, quantize)
+
         if self.device == 'gpu':
             logger.info(">>> [PyTorchInferBackend] Use GPU to inference ...")
             if use_fp16:
@@ -52,9 +61,33 @@ class PyTorchInferBackend:
         return start_prob, end_prob
 
 
-class UIEPipeline(object):
+class OnnxInferBackend:
+    def __init__(self, model_name_or_path, device='cpu', onnx_model_path=None):
+        from ..nn.onnx import create_onnx_session, export_uie_to_onnx
+
+        logger.info(">>> [OnnxInferBackend] Creating Engine ...")
+
+        if onnx_model_path is None:
+            onnx_model_path = os.path.join(model_name_or_path, "onnx", "model.onnx")
+        if not os.path.exists(onnx_model_path):
+            from ..nn.uie import UIEModel
+
+            export_uie_to_onnx(UIEModel.from_pretrained(model_name_or_path), onnx_model_path)
+
+        self.session = create_onnx_session(onnx_model_path, device=device)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        logger.info(">>> [OnnxInferBackend] Engine Created ...")
+
+    def infer(self, input_dict):
+        input_dict = {k: v for k, v in input_dict.items() if k in self.input_names}
+        start_prob, end_prob = self.session.run(["start_prob", "end_prob"], input_dict)
+        return start_prob, end_prob
+
+
+class UIEPipeline(StreamMixin, WorkerPoolMixin):
 
     keys_to_ignore_on_gpu = ['offset_mapping', 'texts']  # batch不存放在gpu中的变量
+    _worker_state_keys = ("_schema_tree", "_position_prob", "_max_seq_len", "_split_sentence")
 
     def __init__(
         self,
@@ -67,11 +100,20 @@ class UIEPipeline(object):
         batch_size=64,
         split_sentence=False,
         use_fp16=False,
-        is_english_model=False
+        is_english_model=False,
+        max_tokens=None,
+        backend="pytorch",
+        quantize=None,
+        window_overlap=0,
+        num_workers=0,
     ) -> None:
 
         assert isinstance(device, str), "The type of device must be string."
         assert device in ['cpu', 'gpu'], "The device must be cpu or gpu."
+        assert backend in ['pytorch', 'onnx'], "The backend must be pytorch or onnx."
+
+        if backend == "onnx" and (quantize is not None or use_fp16):
+            raise ValueError("The `quantize` and `use_fp16` options only support pytorch backend.")
 
         self._is_en = is_english_model
         if model_name_or_path in ["uie-base-en"] or schema_lang == "en":
@@ -82,13 +124,19 @@ class UIEPipeline(object):
         self._position_prob = position_prob
         self._max_seq_len = max_seq_len
         self._batch_size = batch_size
+        self._max_tokens = max_tokens
         self._split_sentence = split_sentence
         self._use_fp16 = use_fp16
+        self._backend = backend
+        self._quantize = quantize
+        self._window_overlap = window_overlap
+        self._num_workers = num_workers
 
         self._schema_tree = None
         self.set_schema(schema)
 
         self._prepare_predictor()
+        self._prepare_worker_pool()
 
     def _prepare_predictor(self):
         try:
@@ -107,11 +155,15 @@ class UIEPipeline(object):
 
         self._tokenizer = BertTokenizerFast.from_pretrained(self._model_name_or_path)
 
-        self.inference_backend = PyTorchInferBackend(
-            self._model_name_or_path,
-            device=self._device,
-            use_fp16=self._use_fp16,
-        )
+        if self._backend == "onnx":
+            self.inference_backend = OnnxInferBackend(self._model_name_or_path, device=self._device)
+        else:
+            self.inference_backend = PyTorchInferBackend(
+                self._model_name_or_path,
+                device=self._device,
+                use_fp16=self._use_fp16,
+                quantize=self._quantize,
+            )
 
     def set_schema(self, schema):
         if isinstance(schema, (dict, str)):
@@ -122,6 +174,9 @@ class UIEPipeline(object):
         texts = inputs
         if isinstance(texts, str):
             texts = [texts]
+        return self._dispatch(texts)
+
+    def _predict(self, texts):
         return self._multi_stage_predict(texts)
 
     def _multi_stage_predict(self, datas):
@@ -137,94 +192,118 @@ class UIEPipeline(object):
         if len(datas) < 1 or self._schema_tree is None:
             return results
 
+        # 按层遍历 schema 树，同一层的节点互不依赖，合并为一次批量推理
         schema_list = self._schema_tree.children[:]
         while len(schema_list) > 0:
-            node = schema_list.pop(0)
-            examples = []
-            input_map = {}
-            cnt = 0
-            idx = 0
-            if not node.prefix:
-                for data in datas:
-                    examples.append({"text": data, "prompt": dbc2sbc(node.name)})
-                    input_map[cnt] = [idx]
-                    idx += 1
-                    cnt += 1
-            else:
-                for pre, data in zip(node.prefix, datas):
-                    if len(pre) == 0:
-                        input_map[cnt] = []
-                    else:
-                        for p in pre:
-                            if self._is_en:
-                                if re.search(r'\[.*?\]$', node.name):
-                                    prompt_prefix = node.name[:node.name.find(
-                                        "[", 1)].strip()
-                                    cls_options = re.search(
-                                        r'\[.*?\]$', node.name).group()
-                                    # Sentiment classification of xxx [positive, negative]
-                                    prompt = prompt_prefix + p + " " + cls_options
-                                else:
-                                    prompt = node.name + p
-                            else:
-                                prompt = p + node.name
-                            examples.append({
-                                "text": data,
-                                "prompt": dbc2sbc(prompt)
-                            })
-                        input_map[cnt] = [i + idx for i in range(len(pre))]
-                        idx += len(pre)
-                    cnt += 1
-
-            result_list = self._single_stage_predict(examples) if examples else []
-            if not node.parent_relations:
-                relations = [[] for _ in range(len(datas))]
-                for k, v in input_map.items():
-                    for idx in v:
-                        if len(result_list[idx]) == 0:
-                            continue
-                        if node.name not in results[k].keys():
-                            results[k][node.name] = result_list[idx]
-                        else:
-                            results[k][node.name].extend(result_list[idx])
-                    if node.name in results[k].keys():
-                        relations[k].extend(results[k][node.name])
-            else:
-                relations = node.parent_relations
-                for k, v in input_map.items():
-                    for i in range(len(v)):
-                        if len(result_list[v[i]]) == 0:
-                            continue
-                        if "relations" not in relations[k][i].keys():
-                            relations[k][i]["relations"] = {node.name: result_list[v[i]]}
-                        elif node.name not in relations[k][i]["relations"].keys():
-                            relations[k][i]["relations"][node.name] = result_list[v[i]]
-                        else:
-                            relations[k][i]["relations"][node.name].extend(result_list[v[i]])
+            level_examples, level_inputs = [], []
+            for node in schema_list:
+                examples, input_map = self._build_examples(node, datas)
+                level_inputs.append((node, input_map, len(level_examples), len(examples)))
+                level_examples.extend(examples)
+
+            # 切分长度与结果合并按节点分别进行，各节点的提示长度与任务类型（抽取或分类）可能不同
+            groups = [(offset, num_examples) for _, _, offset, num_examples in level_inputs]
+            level_results = self._single_stage_predict(level_examples, groups=groups) if level_examples else []
+
+            next_schema_list = []
+            for node, input_map, offset, num_examples in level_inputs:
+                result_list = level_results[offset: offset + num_examples]
+                self._update_results(node, datas, input_map, result_list, results)
+                next_schema_list.extend(node.children)
+            schema_list = next_schema_list
 
-                new_relations = [[] for _ in range(len(datas))]
-                for i in range(len(relations)):
-                    for j in range(len(relations[i])):
-                        if "relations" in relations[i][j].keys() and node.name in relations[i][j]["relations"].keys():
-                            for k in range(len(relations[i][j]["relations"][node.name])):
-                                new_relations[i].append(relations[i][j]["relations"][node.name][k])
-                relations = new_relations
+        return results
 
-            prefix = [[] for _ in range(len(datas))]
-            for k, v in input_map.items():
-                for idx in v:
-                    for i in range(len(result_list[idx])):
+    def _build_examples(self, node, datas):
+        """
+        Build the prompt examples of a schema node.
+        """
+        examples = []
+        input_map = {}
+        cnt = 0
+        idx = 0
+        if not node.prefix:
+            for data in datas:
+                examples.append({"text": data, "prompt": dbc2sbc(node.name)})
+                input_map[cnt] = [idx]
+                idx += 1
+                cnt += 1
+        else:
+            for pre, data in zip(node.prefix, datas):
+                if len(pre) == 0:
+                    input_map[cnt] = []
+                else:
+                    for p in pre:
                         if self._is_en:
-                            prefix[k].append(" of " + result_list[idx][i]["text"])
+                            if re.search(r'\[.*?\]$', node.name):
+                                prompt_prefix = node.name[:node.name.find(
+                                    "[", 1)].strip()
+                                cls_options = re.search(
+                                    r'\[.*?\]$', node.name).group()
+                                # Sentiment classification of xxx [positive, negative]
+                                prompt = prompt_prefix + p + " " + cls_options
+                            else:
+                                prompt = node.name + p
                         else:
-                            prefix[k].append(result_list[idx][i]["text"] + "的")
-
-            for child in node.children:
-                child.prefix = prefix
-                child.parent_relations = relations
-                schema_list.append(child)
+                            prompt = p + node.name
+                        examples.append({
+                            "text": data,
+                            "prompt": dbc2sbc(prompt)
+                        })
+                    input_map[cnt] = [i + idx for i in range(len(pre))]
+                    idx += len(pre)
+                cnt += 1
+        return examples, input_map
+
+    def _update_results(self, node, datas, input_map, result_list, results):
+        """
+        Merge the predictions of a schema node into `results` and set up its children.
+        """
+        if not node.parent_relations:
+            relations = [[] for _ in range(len(datas))]
+            for k, v in input_map.items():
+                for idx in v:
+                    if len(result_list[idx]) == 0:
+                        continue
+                    if node.name not in results[k].keys():
+                        results[k][node.name] = result_list[idx]
+                    else:
+                        results[k][node.name].extend(result_list[idx])
+                if node.name in results[k].keys():
+                    relations[k].extend(results[k][node.name])
+        else:
+            relations = node.parent_relations
+            for k, v in input_map.items():
+                for i in range(len(v)):
+                    if len(result_list[v[i]]) == 0:
+                        continue
+                    if "relations" not in relations[k][i].keys():
+                        relations[k][i]["relations"] = {node.name: result_list[v[i]]}
+                    elif node.name not in relations[k][i]["relations"].keys():
+                        relations[k][i]["relations"][node.name] = result_list[v[i]]
+                    else:
+                        relations[k][i]["relations"][node.name].extend(result_list[v[i]])
+
+            new_relations = [[] for _ in range(len(datas))]
+            for i in range(len(relations)):
+                for j in range(len(relations[i])):
+                    if "relations" in relations[i][j].keys() and node.name in relations[i][j]["relations"].keys():
+                        for k in range(len(relations[i][j]["relations"][node.name])):
+                            new_relations[i].append(relations[i][j]["relations"][node.name][k])
+            relations = new_relations
+
+        prefix = [[] for _ in range(len(datas))]
+        for k, v in input_map.items():
+            for idx in v:
+                for i in range(len(result_list[idx])):
+                    if self._is_en:
+                        prefix[k].append(" of " + result_list[idx][i]["text"])
+                    else:
+                        prefix[k].append(result_list[idx][i]["text"] + "的")
 
-        return results
+        for child in node.children:
+            child.prefix = prefix
+            child.parent_relations = relations
 
     def _convert_ids_to_results(self, examples, sentence_ids, probs):
         """
@@ -264,6 +343,12 @@ class UIEPipeline(object):
             short_input_texts (List[str]): the short input texts for model inference.
             input_mapping (dict): mapping between raw text and short input texts.
         """
+        if self._window_overlap > 0:
+            short_input_texts, input_mapping, self.input_offsets = sliding_window_splitter(
+                input_texts, max_text_len, overlap=self._window_overlap, split_sentence=split_sentence
+            )
+            return short_input_texts, input_mapping
+
         input_mapping = {}
         short_input_texts = []
         cnt_short = 0
@@ -291,66 +376,114 @@ class UIEPipeline(object):
                         input_mapping[cnt_org] = temp_text_id
         return short_input_texts, input_mapping
 
-    def _single_stage_predict(self, inputs):
+    def _single_stage_predict(self, inputs, groups=None):
+        """
+        Args:
+            inputs (List[dict]): 包含 `text` 与 `prompt` 的输入
+            groups (List[Tuple[int, int]]): 每个 schema 节点的输入在 `inputs` 中的 (起始位置, 数量)，
+                切分与结果合并按节点分别进行，模型推理对所有节点的输入一次完成；为 None 时视为同一个节点
+        Returns:
+            list: 每个输入的预测结果
+        """
+        if groups is None:
+            groups = [(0, len(inputs))]
+
+        short_inputs, splits = [], []
+        for offset, num_examples in groups:
+            if num_examples == 0:
+                continue
+            node_inputs, input_mapping, input_offsets = self._split_inputs(inputs[offset: offset + num_examples])
+            splits.append((len(short_inputs), len(node_inputs), input_mapping, input_offsets))
+            short_inputs.extend(node_inputs)
+
+        short_results = self._predict_short_inputs(short_inputs)
+
+        results = []
+        for start, num_short, input_mapping, input_offsets in splits:
+            self.input_mapping, self.input_offsets = input_mapping, input_offsets
+            results.extend(self._auto_joiner(
+                short_results[start: start + num_short],
+                [x["text"] for x in short_inputs[start: start + num_short]],
+                input_mapping,
+            ))
+        return results
+
+    def _max_predict_len(self, prompts):
+        # max predict length should exclude the length of prompt and summary tokens
+        return self._max_seq_len - max(len(p) for p in prompts) - 3
+
+    def _split_inputs(self, inputs):
+        """
+        按同一节点中最长的提示确定切分长度，将原文切分为短文本
+        Returns:
+            short_inputs (List[dict]): 切分后的输入
+            input_mapping (dict): 原文与短文本的对应关系
+            input_offsets (List[int]): 滑动窗口切分时每个短文本在原文中的起始位置，否则为 None
+        """
         input_texts = []
         prompts = []
         for i in range(len(inputs)):
             input_texts.append(inputs[i]["text"])
             prompts.append(inputs[i]["prompt"])
-        # max predict length should exclude the length of prompt and summary tokens
-        max_predict_len = self._max_seq_len - len(max(prompts)) - 3
 
-        short_input_texts, self.input_mapping = self._auto_splitter(
-            input_texts, max_predict_len, split_sentence=self._split_sentence)
+        self.input_offsets = None
+        short_input_texts, input_mapping = self._auto_splitter(
+            input_texts, self._max_predict_len(prompts), split_sentence=self._split_sentence)
 
         short_texts_prompts = []
-        for k, v in self.input_mapping.items():
+        for k, v in input_mapping.items():
             short_texts_prompts.extend([prompts[k] for _ in range(len(v))])
         short_inputs = [{
             "text": short_input_texts[i],
             "prompt": short_texts_prompts[i]
         } for i in range(len(short_input_texts))]
 
+        return short_inputs, input_mapping, self.input_offsets
+
+    def _predict_short_inputs(self, short_inputs):
+        """
+        对切分后的输入批量推理，返回每个短文本的预测结果
+        """
         encoded_inputs = self._tokenizer(
-            text=short_texts_prompts,
-            text_pair=short_input_texts,
+            text=[x["prompt"] for x in short_inputs],
+            text_pair=[x["text"] for x in short_inputs],
             stride=2,
             truncation=True,
             max_length=self._max_seq_len,
-            padding="longest",
             add_special_tokens=True,
             return_offsets_mapping=True,
-            return_tensors="np")
-        offset_maps = encoded_inputs["offset_mapping"]
-
-        start_prob_concat, end_prob_concat = [], []
-        batch_iterator = tqdm(range(0, len(short_input_texts), self._batch_size), desc="Predicting", unit='batch')
-        for batch_start in batch_iterator:
-            batch = {key: np.array(value[batch_start: batch_start + self._batch_size], dtype="int64") for key, value
-                     in encoded_inputs.items() if key not in self.keys_to_ignore_on_gpu}
-            outputs = self.inference_backend.infer(batch)
-
-            start_prob, end_prob = outputs[0], outputs[1]
-            start_prob_concat.append(start_prob)
-            end_prob_concat.append(end_prob)
-
-        start_prob_concat = np.concatenate(start_prob_concat)
-        end_prob_concat = np.concatenate(end_prob_concat)
-
-        start_ids_list = get_bool_ids_greater_than(start_prob_concat, limit=self._position_prob, return_prob=True)
-        end_ids_list = get_bool_ids_greater_than(end_prob_concat, limit=self._position_prob, return_prob=True)
-
-        input_ids = encoded_inputs['input_ids'].tolist()
-        sentence_ids, probs = [], []
-        for start_ids, end_ids, ids, offset_map in zip(start_ids_list, end_ids_list, input_ids, offset_maps):
-            span_list = get_span(start_ids, end_ids, with_prob=True)
-            sentence_id, prob = get_id_and_prob(span_list, offset_map.tolist())
-            sentence_ids.append(sentence_id)
-            probs.append(prob)
-
-        results = self._convert_ids_to_results(short_inputs, sentence_ids, probs)
-        results = self._auto_joiner(results, short_input_texts, self.input_mapping)
-        return results
+        )
+        offset_maps = encoded_inputs.pop("offset_mapping")
+        lengths = [len(ids) for ids in encoded_inputs["input_ids"]]
+
+        sentence_ids, probs = [None] * len(short_inputs), [None] * len(short_inputs)
+        batches = length_bucketed_batches(lengths, self._batch_size, self._max_tokens)
+        for batch_indices in tqdm(batches, desc="Predicting", unit='batch'):
+            batch = self._tokenizer.pad(
+                [{key: value[i] for key, value in encoded_inputs.items()} for i in batch_indices],
+                padding=True,
+                return_tensors="np",
+            )
+            batch = {key: np.array(value, dtype="int64") for key, value in batch.items()
+                     if key not in self.keys_to_ignore_on_gpu}
+            start_prob, end_prob = self.inference_backend.infer(batch)
+
+            # 按真实长度截断，避免 padding 位置产生无效的 span
+            batch_ids, _, starts, ends = extract_nearest_spans(
+                start_prob > self._position_prob,
+                end_prob > self._position_prob,
+                [lengths[i] for i in batch_indices],
+                exclude_special_tokens=False,
+                unique_end=True,
+            )
+            span_lists = [set() for _ in batch_indices]
+            for k, start, end in zip(batch_ids.tolist(), starts.tolist(), ends.tolist()):
+                span_lists[k].add(((start, start_prob[k, start]), (end, end_prob[k, end])))
+
+            for k, i in enumerate(batch_indices):
+                sentence_ids[i], probs[i] = get_id_and_prob(span_lists[k], [list(o) for o in offset_maps[i]])
+
+        return self._convert_ids_to_results(short_inputs, sentence_ids, probs)
 
     def _auto_joiner(self, short_results, short_inputs, input_mapping):
         concat_results = []
@@ -383,6 +516,8 @@ class UIEPipeline(object):
 
                 else:
                     concat_results.append([])
+            elif self._window_overlap > 0:
+                concat_results.append(self._window_joiner(short_results, short_inputs, vs))
             else:
                 offset = 0
                 for v in vs:
@@ -400,6 +535,24 @@ class UIEPipeline(object):
                 concat_results.append(single_results)
         return concat_results
 
+    def _window_joiner(self, short_results, short_inputs, vs):
+        """
+        将同一原文各窗口的结果映射回原文位置，并合并重叠区域的重复结果
+        """
+        text_len = max(self.input_offsets[v] + len(short_inputs[v]) for v in vs)
+        spans = []
+        for v in vs:
+            window_start = self.input_offsets[v]
+            window_end = window_start + len(short_inputs[v])
+            for res in short_results[v]:
+                if 'start' not in res or 'end' not in res:
+                    continue
+                res['start'] += window_start
+                res['end'] += window_start
+                margin = window_margin(res['start'], res['end'], window_start, window_end, text_len)
+                spans.append((None, res['start'], res['end'], v, margin, res))
+        return merge_window_spans(spans)
+
     def predict(self, input_data):
         return self._multi_stage_predict(input_data)
 
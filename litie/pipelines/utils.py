@@ -1,3 +1,5 @@
+import itertools
+import json
 import math
 import re
 
@@ -70,3 +72,143 @@ def auto_splitter(input_texts, max_text_len, split_sentence=False):
                 else:
                     input_mapping[cnt_org] = temp_text_id
     return short_input_texts, input_mapping
+
+
+SENTENCE_DELIMITERS = "。！？!?；;\n"
+
+
+def sliding_window_splitter(input_texts, max_text_len, overlap=0, split_sentence=False, delimiters=SENTENCE_DELIMITERS):
+    """
+    Split the raw texts into overlapping windows for model inference, preferring sentence boundaries as window ends.
+    Args:
+        input_texts (List[str]): input raw texts.
+        max_text_len (int): max window length.
+        overlap (int): number of characters shared by two adjacent windows, the stride is `max_text_len - overlap`.
+        split_sentence (bool): If True, sentence-level split will be performed before windowing.
+        delimiters (str): characters treated as sentence boundaries.
+    return:
+        short_input_texts (List[str]): the short input texts for model inference.
+        input_mapping (dict): mapping between raw text and short input texts.
+        input_offsets (List[int]): the start offset of each short input text in its raw text.
+    """
+    assert 0 <= overlap < max_text_len, "The `overlap` must be in [0, max_text_len)."
+
+    input_mapping = {}
+    short_input_texts, input_offsets = [], []
+    for cnt_org, text in enumerate(input_texts):
+        input_mapping[cnt_org] = []
+
+        sens, cursor = [], 0
+        for sen in (cut_chinese_sent(text) if split_sentence else [text]):
+            cursor = text.find(sen, cursor)
+            sens.append((sen, cursor))
+            cursor += len(sen)
+
+        for sen, sen_offset in sens:
+            start = 0
+            while True:
+                end = min(start + max_text_len, len(sen))
+                if end < len(sen):
+                    # 在窗口后半段寻找句子边界，保证窗口向前推进
+                    lower = start + max(overlap, max_text_len // 2)
+                    boundary = max(sen.rfind(d, lower, end) for d in delimiters)
+                    if boundary != -1:
+                        end = boundary + 1
+
+                input_mapping[cnt_org].append(len(short_input_texts))
+                short_input_texts.append(sen[start: end])
+                input_offsets.append(sen_offset + start)
+
+                if end >= len(sen):
+                    break
+                start = end - overlap
+
+    return short_input_texts, input_mapping, input_offsets
+
+
+def merge_window_spans(spans):
+    """
+    合并滑动窗口的预测结果：完全相同的片段只保留一次；不同窗口预测的同类型片段相互重叠，
+    且距离切分边界较近的片段紧贴所在窗口的切分边界（可能被截断）时，保留距离切分边界更远（上下文更完整）的片段，
+    否则两者都保留（例如嵌套的同类型实体），与单个窗口的解码结果一致
+    Args:
+        spans (List[tuple]): (label, start, end, window_id, margin, item)，start/end 为原文中的位置，
+            margin 为片段到所在窗口切分边界的最小距离
+    Returns:
+        List[Any]: 保留的 item，保持输入顺序
+    """
+    order = sorted(range(len(spans)), key=lambda i: -spans[i][4])
+
+    kept, seen, kept_spans = set(), set(), {}
+    for i in order:
+        label, start, end, window_id, margin = spans[i][:5]
+        if (label, start, end) in seen:
+            continue
+        # 按 margin 降序处理，已保留的片段距离切分边界不比当前片段近
+        if margin <= 0 and any(w != window_id and s < end and start < e for s, e, w in kept_spans.get(label, [])):
+            continue
+        seen.add((label, start, end))
+        kept_spans.setdefault(label, []).append((start, end, window_id))
+        kept.add(i)
+
+    return [spans[i][5] for i in range(len(spans)) if i in kept]
+
+
+def window_margin(start, end, window_start, window_end, text_len):
+    """ 片段到窗口切分边界的最小距离，原文的首尾不算切分边界 """
+    margin = float("inf")
+    if window_start > 0:
+        margin = min(margin, start - window_start)
+    if window_end < text_len:
+        margin = min(margin, window_end - end)
+    return margin
+
+
+def batch_iterator(iterable, chunk_size):
+    """ 惰性地将可迭代对象按 chunk_size 分块 """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _to_serializable(obj):
+    if hasattr(obj, "item"):  # numpy / torch 标量
+        return obj.item()
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def stream_jsonl(pipeline, input_file, output_file, text_key="text", output_key="predictions", chunk_size=1024):
+    """
+    流式处理 jsonl 文件：逐块读取 `text_key` 字段进行推理，将结果写入 `output_key` 字段后逐行输出，
+    适用于无法一次载入内存的大文件
+    Args:
+        pipeline: 任意 pipeline，需要支持 `pipeline(List[str]) -> List[Any]`
+        input_file (str): 输入的 jsonl 文件
+        output_file (str): 输出的 jsonl 文件
+        text_key (str): 输入文本字段
+        output_key (str): 输出结果字段
+        chunk_size (int): 每次送入 pipeline 的样本数
+    Returns:
+        int: 处理的样本数
+    """
+    def read_records():
+        with open(input_file, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    num_records = 0
+    with open(output_file, "w", encoding="utf-8") as f:
+        for records in batch_iterator(read_records(), chunk_size):
+            results = pipeline([record[text_key] for record in records])
+            for record, result in zip(records, results):
+                record[output_key] = result
+                f.write(json.dumps(record, ensure_ascii=False, default=_to_serializable) + "\n")
+            num_records += len(records)
+
+    return num_records
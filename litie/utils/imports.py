@@ -7,3 +7,4 @@ BOLTS_GREATER_EQUAL_0_5_0 = module_available("pl_bolts") and compare_version("pl
 WANDB_AVAILABLE = module_available("wandb")
 ACCELERATE_AVAILABLE = module_available("accelerate")
 TORCH_SCATTER_AVAILABLE = module_available("torch_scatter")
+ONNXRUNTIME_AVAILABLE = module_available("onnxruntime")
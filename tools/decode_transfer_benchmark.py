@@ -0,0 +1,84 @@
+"""
+比较解码时将整个得分矩阵拷贝到 CPU 后筛选，与在设备上筛选后只拷贝稀疏候选（`extract_sparse_candidates`）的耗时与拷贝量
+
+得分矩阵的形状为 [batch_size, num_heads, seq_len, seq_len]（GlobalPointer、GPLinker 等指针/表格解码器的输出），
+随机将 `density` 比例的位置置为超过阈值的得分。
+
+Example:
+    python decode_transfer_benchmark.py --device cuda --batch_size 16 --num_heads 10 --seq_len 512
+"""
+import argparse
+import time
+
+import torch
+
+from litie.nn.decode_utils import extract_sparse_candidates
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def dense_transfer(scores, attention_mask, threshold):
+    """ 拷贝整个得分矩阵后在 CPU 上筛选 """
+    scores, seq_lens = scores.cpu(), attention_mask.sum(1).cpu()
+    batch_ids, heads, starts, ends = torch.nonzero(scores > threshold, as_tuple=True)
+    seq_lens = seq_lens[batch_ids]
+    keep = (starts > 0) & (starts <= ends) & (ends < seq_lens - 1)
+    return tuple(x[keep].numpy() for x in (batch_ids, heads, starts, ends)), scores.numel() * scores.element_size()
+
+
+def sparse_transfer(scores, attention_mask, threshold):
+    """ 在设备上筛选，只拷贝稀疏候选 """
+    candidates = extract_sparse_candidates(scores, threshold, attention_mask=attention_mask, upper_triangular=True)
+    return candidates, sum(x.nbytes for x in candidates)
+
+
+def benchmark(fn, scores, attention_mask, threshold, repeats):
+    fn(scores, attention_mask, threshold)  # warmup
+    synchronize(scores.device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        outputs, num_bytes = fn(scores, attention_mask, threshold)
+    synchronize(scores.device)
+    return outputs, {
+        "ms/batch": (time.perf_counter() - start) / repeats * 1000,
+        "copied(MB)": num_bytes / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_heads", type=int, default=10)
+    parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument("--density", type=float, default=1e-4)
+    parser.add_argument("--threshold", type=float, default=0.0)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    shape = (args.batch_size, args.num_heads, args.seq_len, args.seq_len)
+    hits = torch.rand(shape, device=device) < args.density
+    scores = torch.where(hits, 1.0, -1.0).to(getattr(torch, args.dtype))
+
+    lengths = torch.randint(args.seq_len // 2, args.seq_len + 1, (args.batch_size,), device=device)
+    attention_mask = (torch.arange(args.seq_len, device=device)[None] < lengths[:, None]).long()
+
+    report = {}
+    dense, report["dense"] = benchmark(dense_transfer, scores, attention_mask, args.threshold, args.repeats)
+    sparse, report["sparse"] = benchmark(sparse_transfer, scores, attention_mask, args.threshold, args.repeats)
+    assert all((x == y).all() for x, y in zip(dense, sparse)), "dense and sparse candidates differ"
+
+    print(f"scores: {list(shape)} {args.dtype} on {device}, candidates: {len(sparse[0])}")
+    keys = list(report["dense"].keys())
+    print(f"{'':<12}" + "".join(f"{k:>14}" for k in keys))
+    for name, values in report.items():
+        print(f"{name:<12}" + "".join(f"{values[k]:>14.4f}" for k in keys))
+
+
+if __name__ == "__main__":
+    main()
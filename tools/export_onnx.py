@@ -0,0 +1,51 @@
+"""
+导出 ONNX 模型，供 pipeline 的 `backend="onnx"` 使用
+
+Example:
+    python export_onnx.py --task ner --task_model_name global_pointer --model_name_or_path checkpoint/ner
+    python export_onnx.py --task uie --model_name_or_path uie_base_pytorch
+"""
+import argparse
+import os
+
+from litie.nn import (
+    AutoNerTaskModel,
+    AutoReTaskModel,
+    AutoEventExtractionTaskModel,
+    AutoTextClassificationTaskModel,
+    UIEModel,
+)
+from litie.nn.onnx import export_backbone_to_onnx, export_uie_to_onnx
+
+TASK_MODEL_MAP = {
+    "ner": AutoNerTaskModel,
+    "re": AutoReTaskModel,
+    "ee": AutoEventExtractionTaskModel,
+    "tc": AutoTextClassificationTaskModel,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", type=str, required=True, choices=["ner", "re", "ee", "tc", "uie"])
+    parser.add_argument("--task_model_name", type=str, default=None)
+    parser.add_argument("--model_type", type=str, default="bert")
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, default=None)
+    parser.add_argument("--opset_version", type=int, default=14)
+    args = parser.parse_args()
+
+    if args.task == "uie":
+        output_path = args.output_path or os.path.join(args.model_name_or_path, "onnx", "model.onnx")
+        model = UIEModel.from_pretrained(args.model_name_or_path)
+        export_uie_to_onnx(model, output_path, opset_version=args.opset_version)
+    else:
+        assert args.task_model_name is not None, "The `task_model_name` should be specified."
+        output_path = args.output_path or os.path.join(args.model_name_or_path, "onnx", "backbone.onnx")
+        model = TASK_MODEL_MAP[args.task].create(args.task_model_name, model_type=args.model_type)
+        model = model.from_pretrained(args.model_name_or_path)
+        export_backbone_to_onnx(model, output_path, opset_version=args.opset_version)
+
+
+if __name__ == "__main__":
+    main()
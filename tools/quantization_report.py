@@ -0,0 +1,123 @@
+"""
+比较 INT8 动态量化模型与 FP32 模型在验证集上的效果与速度
+
+验证集为 jsonl 文件，格式与训练数据一致：
+    + ner: {"text": "...", "entities": [{"label": "...", "start_offset": 0, "end_offset": 2, "entity": "..."}]}
+    + re: {"text": "...", "spo_list": [{"predicate": "...", "subject": "...", "object": "..."}]}
+
+Example:
+    python quantization_report.py --task ner --task_model_name global_pointer \
+        --model_name_or_path checkpoint/ner --validation_file datasets/cmeee/dev.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import torch
+
+from litie.metrics.extraction.score import ExtractionScore
+from litie.nn.quantization import QUANTIZE_TYPES
+from litie.pipelines.ner import get_auto_ner_predictor
+from litie.pipelines.re import get_auto_re_predictor
+
+
+def load_validation_file(task, validation_file):
+    texts, targets = [], []
+    with open(validation_file, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            example = json.loads(line)
+            texts.append(example["text"])
+            if task == "ner":
+                targets.append({
+                    (ent["label"], int(ent["start_offset"]), int(ent["end_offset"]), ent["entity"])
+                    for ent in example["entities"]
+                })
+            else:
+                targets.append({
+                    (spo["predicate"], spo["subject"], spo["object"]) for spo in example["spo_list"]
+                })
+    return texts, targets
+
+
+def normalize(task, predictions):
+    if task == "ner":
+        return [{(p[0], int(p[1]), int(p[2]), p[3]) for p in pred} for pred in predictions]
+    return [set(pred) for pred in predictions]
+
+
+def model_size(model):
+    """ 以 MB 为单位的模型参数大小 """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "model.pt")
+        torch.save(model.state_dict(), path)
+        return os.path.getsize(path) / 1024 / 1024
+
+
+def smoke_check(predictor, text):
+    """ 不传入 token_type_ids 运行编码器，确认量化后的模型可以处理缺省的输入 """
+    inputs = predictor.tokenizer([text], return_token_type_ids=False, return_tensors="pt")
+    with torch.no_grad():
+        predictor.model.base_model(**inputs)
+
+
+def evaluate(task, predictor, texts, targets, batch_size, max_length):
+    start = time.perf_counter()
+    predictions = predictor.predict(texts, batch_size=batch_size, max_length=max_length, return_dict=False)
+    elapsed = time.perf_counter() - start
+
+    metric = ExtractionScore()
+    metric.update(targets, normalize(task, predictions))
+    precision, recall, f1 = metric.value()
+    return {
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "seconds": elapsed,
+        "samples/s": len(texts) / elapsed,
+        "size(MB)": model_size(predictor.model),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", type=str, default="ner", choices=["ner", "re"])
+    parser.add_argument("--task_model_name", type=str, required=True)
+    parser.add_argument("--model_type", type=str, default="bert")
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--validation_file", type=str, required=True)
+    parser.add_argument("--quantize", type=str, default="dynamic_int8", choices=QUANTIZE_TYPES)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_seq_len", type=int, default=512)
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    texts, targets = load_validation_file(args.task, args.validation_file)
+    get_predictor = get_auto_ner_predictor if args.task == "ner" else get_auto_re_predictor
+
+    report = {}
+    for name, quantize in [("fp32", None), (args.quantize, args.quantize)]:
+        predictor = get_predictor(
+            args.task_model_name,
+            args.model_type,
+            model_name_or_path=args.model_name_or_path,
+            device="cpu",
+            quantize=quantize,
+        )
+        smoke_check(predictor, texts[0])
+        report[name] = evaluate(args.task, predictor, texts, targets, args.batch_size, args.max_seq_len)
+
+    keys = list(report["fp32"].keys())
+    print(f"{'':<24}" + "".join(f"{k:>14}" for k in keys))
+    for name, values in report.items():
+        print(f"{name:<24}" + "".join(f"{values[k]:>14.4f}" for k in keys))
+
+
+if __name__ == "__main__":
+    main()